@@ -1,12 +1,10 @@
 # Required import statements
-from flask import Flask, render_template, request, jsonify
+import time
+IMPORT_STARTED = time.perf_counter()  # start of the import, for the startup timings
+from flask import Flask, Request, render_template, request, jsonify, Response, stream_with_context, g
 import subprocess
 import tempfile
 import os
-from langchain.llms import Ollama
-from langchain.prompts import PromptTemplate
-from langchain.chains import LLMChain
-from langchain.memory import ConversationBufferMemory
 from datetime import datetime
 import json
 from typing import Dict, List
@@ -14,361 +12,3242 @@ import sqlite3
 from contextlib import contextmanager
 import re
 import os
+import threading
+import queue
+import hashlib
+import struct
+import sys
+import shutil
+import atexit
+import signal
+import socket
+import uuid
+import math
+import ast
+import traceback
+import codecs
+import zipfile
+import bisect
+import zlib
+import argparse
+from html import escape
+from collections import OrderedDict, deque
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
+
+# Uploads are analyzed from memory: .py files (or .zip archives of them) up to UPLOAD_MAX_BYTES of source
+# in total, with request bodies over UPLOAD_SPOOL_BYTES spilled to a temporary file while they are parsed
+ALLOWED_EXTENSIONS = {'py'}
+UPLOAD_MAX_BYTES = int(os.environ.get('FIGR_UPLOAD_MAX_BYTES', 2 * 1024 * 1024))
+UPLOAD_MAX_FILES = int(os.environ.get('FIGR_UPLOAD_MAX_FILES', 50))
+UPLOAD_SPOOL_BYTES = int(os.environ.get('FIGR_UPLOAD_SPOOL_BYTES', 1024 * 1024))
+# Body limit of every other endpoint; a chat message can carry a whole uploaded file, so it is well above
+# UPLOAD_MAX_BYTES, which upload_file applies to its own requests
+REQUEST_MAX_BYTES = int(os.environ.get('FIGR_REQUEST_MAX_BYTES', 16 * 1024 * 1024))
+
+
+# Keeps uploaded files in memory unless they are bigger than UPLOAD_SPOOL_BYTES
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES, mode='w+b')
+
 
 # Initialisation of the flask app
 app = Flask(__name__)
-
-# Upload folder to contain .py files
-UPLOAD_FOLDER = 'uploads'
-ALLOWED_EXTENSIONS = {'py'}
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+app.request_class = UploadRequest
+app.config['MAX_CONTENT_LENGTH'] = REQUEST_MAX_BYTES
 
 # Database configuration
-DATABASE_PATH = 'chat_database.db'
+DATABASE_PATH = os.environ.get('FIGR_DATABASE_PATH', 'chat_database.db')
+DB_POOL_SIZE = int(os.environ.get('FIGR_DB_POOL_SIZE', 8))
+DB_POOL_TIMEOUT = 30  # seconds to wait for a free connection (and for a locked db)
+DB_CACHE_SIZE_KB = int(os.environ.get('FIGR_DB_CACHE_SIZE_KB', 16384))
+DB_MMAP_SIZE = int(os.environ.get('FIGR_DB_MMAP_SIZE', 256 * 1024 * 1024))
+# Group commit: chat turns finishing within this many milliseconds of each other share one transaction (0 = off)
+GROUP_COMMIT_MS = float(os.environ.get('FIGR_GROUP_COMMIT_MS', 0))
+GROUP_COMMIT_MAX_BATCH = 64
 
-# Mistral:7b using Ollama
-llm = Ollama(model="mistral:7b")
+# Number of chat sessions kept in memory and how long (seconds) an idle one stays cached
+SESSION_CACHE_SIZE = int(os.environ.get('FIGR_SESSION_CACHE_SIZE', 256))
+SESSION_CACHE_TTL = float(os.environ.get('FIGR_SESSION_CACHE_TTL', 1800))
 
+# Conversation memory sent to the model: 'buffer' keeps every turn, 'window' keeps the recent turns
+# that fit the token budget and 'summary' also folds older turns into a rolling summary
+MEMORY_STRATEGIES = ('buffer', 'window', 'summary')
+MEMORY_STRATEGY = os.environ.get('FIGR_MEMORY_STRATEGY', 'summary')
+MEMORY_TOKEN_BUDGET = int(os.environ.get('FIGR_MEMORY_TOKEN_BUDGET', 1500))
+# Important info: how many entries go into the prompt and how fast an entry's weight halves once it stops coming up
+IMPORTANT_INFO_PROMPT_LIMIT = int(os.environ.get('FIGR_IMPORTANT_INFO_LIMIT', 8))
+IMPORTANT_INFO_HALF_LIFE = float(os.environ.get('FIGR_IMPORTANT_INFO_HALF_LIFE', 24 * 3600))  # seconds
+IMPORTANT_INFO_COMPACT_BATCH = 500
 
+# Retention: chats idle for RETENTION_ARCHIVE_DAYS have their messages compressed into archived_chats (restored
+# when the chat is opened again), archived chats idle for RETENTION_DELETE_DAYS and empty chats idle for
+# RETENTION_EMPTY_CHAT_DAYS are deleted; 0 turns a policy off. The worker runs every RETENTION_INTERVAL seconds.
+RETENTION_ARCHIVE_DAYS = float(os.environ.get('FIGR_ARCHIVE_AFTER_DAYS', 30))
+RETENTION_DELETE_DAYS = float(os.environ.get('FIGR_DELETE_AFTER_DAYS', 0))
+RETENTION_EMPTY_CHAT_DAYS = float(os.environ.get('FIGR_EMPTY_CHAT_DAYS', 7))
+RETENTION_INTERVAL = float(os.environ.get('FIGR_RETENTION_INTERVAL', 3600))
+RETENTION_BATCH = 20  # chats per transaction
+VACUUM_STEP_PAGES = 2000  # pages given back to the file system per transaction
 
-@contextmanager # To manage the entire lifecycle of the db connection
-def get_db_connection():
-    conn = sqlite3.connect(DATABASE_PATH)
-    conn.row_factory = sqlite3.Row
+# Export and import stream every chat as NDJSON, gzip compressed unless asked otherwise, a chunk at a time.
+# Imports insert up to IMPORT_BATCH_ROWS records per transaction and take bodies up to IMPORT_MAX_BYTES.
+EXPORT_FORMAT_VERSION = 1
+EXPORT_COMPRESSION_LEVEL = int(os.environ.get('FIGR_EXPORT_COMPRESSION_LEVEL', 6))
+EXPORT_CHUNK_BYTES = 256 * 1024
+IMPORT_BATCH_ROWS = int(os.environ.get('FIGR_IMPORT_BATCH_ROWS', 10000))
+IMPORT_MAX_BYTES = int(os.environ.get('FIGR_IMPORT_MAX_BYTES', 16 * 1024 ** 3))
+IMPORT_MAX_LINE_BYTES = 64 * 1024 * 1024
+
+# Number of rendered messages kept in memory, keyed by content hash
+RENDER_CACHE_SIZE = int(os.environ.get('FIGR_RENDER_CACHE_SIZE', 2048))
+
+# Sandbox workers that run the code tested from the interface
+SANDBOX_WORKERS = int(os.environ.get('FIGR_SANDBOX_WORKERS', 4))
+SANDBOX_MAX_RUNS = int(os.environ.get('FIGR_SANDBOX_MAX_RUNS', 1))  # runs before a worker is replaced
+SANDBOX_TIMEOUT = 5  # second timeout for safety
+SANDBOX_QUEUE_TIMEOUT = float(os.environ.get('FIGR_SANDBOX_QUEUE_TIMEOUT', 10))
+SANDBOX_MEMORY_MB = int(os.environ.get('FIGR_SANDBOX_MEMORY_MB', 1024))
+SANDBOX_MAX_FILES = 64
+SANDBOX_MAX_OUTPUT = 64 * 1024  # characters of stdout / stderr sent back
+# Results of deterministic snippets are reused for TEST_CACHE_TTL seconds; a batch of /api/test-code/batch
+# runs up to TEST_BATCH_PARALLELISM of its TEST_BATCH_MAX snippets at once
+TEST_CACHE_SIZE = int(os.environ.get('FIGR_TEST_CACHE_SIZE', 1024))
+TEST_CACHE_TTL = float(os.environ.get('FIGR_TEST_CACHE_TTL', 3600))
+TEST_BATCH_MAX = 20
+TEST_BATCH_PARALLELISM = int(os.environ.get('FIGR_TEST_BATCH_PARALLELISM', SANDBOX_WORKERS))
+
+# LLM job scheduler: generations sent to Ollama at once, jobs allowed to wait and how long
+# (seconds) a finished job stays available for polling
+LLM_CONCURRENCY = int(os.environ.get('FIGR_LLM_CONCURRENCY', 1))
+LLM_QUEUE_SIZE = int(os.environ.get('FIGR_LLM_QUEUE_SIZE', 32))
+LLM_JOB_TTL = float(os.environ.get('FIGR_LLM_JOB_TTL', 300))
+
+# Responses cached for repeated questions: entries kept, how long (seconds) they stay valid and how
+# similar (cosine of the trigram vectors) a question must be to reuse an answer, 1.0 for exact matches only
+RESPONSE_CACHE_PATH = os.environ.get(
+    'FIGR_RESPONSE_CACHE_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(DATABASE_PATH)), 'response_cache.db')
+)
+RESPONSE_CACHE_SIZE = int(os.environ.get('FIGR_RESPONSE_CACHE_SIZE', 2048))
+RESPONSE_CACHE_TTL = float(os.environ.get('FIGR_RESPONSE_CACHE_TTL', 7 * 24 * 3600))
+RESPONSE_CACHE_SIMILARITY = float(os.environ.get('FIGR_RESPONSE_CACHE_SIMILARITY', 1.0))
+
+# Uploaded files bigger than UPLOAD_CHUNK_TOKENS are analyzed one function or class at a time,
+# with up to UPLOAD_PARALLELISM chunks of an upload queued for and analyzed by the LLM at once
+UPLOAD_CHUNK_TOKENS = int(os.environ.get('FIGR_UPLOAD_CHUNK_TOKENS', 1200))
+UPLOAD_PARALLELISM = int(os.environ.get('FIGR_UPLOAD_PARALLELISM', 4))
+
+# Page sizes of /api/chat-history, /api/chat-list and /api/search
+HISTORY_PAGE_SIZE = 50
+CHAT_LIST_PAGE_SIZE = 50
+SEARCH_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 200
+
+# Search ranks the matches of each index in windows of this many, newest first, so a word found in half of the
+# messages costs the same as a rare one; paging goes on to the next older window once one is used up
+SEARCH_RANK_WINDOW = int(os.environ.get('FIGR_SEARCH_RANK_WINDOW', 2000))
+
+# Production server: requests allowed in flight per process before answering 503, and the defaults of
+# the launch options of main()
+MAX_INFLIGHT = int(os.environ.get('FIGR_MAX_INFLIGHT', 256))
+SERVER_HOST = os.environ.get('FIGR_HOST', '127.0.0.1')
+SERVER_PORT = int(os.environ.get('FIGR_PORT', 5000))
+SERVER_WORKERS = int(os.environ.get('FIGR_WORKERS', 2))
+SERVER_THREADS = int(os.environ.get('FIGR_THREADS', 32))
+
+# Metrics served on /metrics, and an optional file that gets one JSON line with the stage timings of every request
+METRICS_ENABLED = os.environ.get('FIGR_METRICS', '1') != '0'
+TRACE_LOG_PATH = os.environ.get('FIGR_TRACE_LOG')
+
+# Bump whenever format_response changes so stored HTML is rebuilt the next time a chat is loaded
+RENDERER_VERSION = 3
+
+# Ollama server, how long it keeps a model loaded after a request, the HTTP timeout (seconds) and whether
+# the served models are loaded when the server starts instead of on the first request
+OLLAMA_URL = os.environ.get('FIGR_OLLAMA_URL', 'http://localhost:11434')
+OLLAMA_KEEP_ALIVE = os.environ.get('FIGR_OLLAMA_KEEP_ALIVE', '30m')
+OLLAMA_TIMEOUT = float(os.environ.get('FIGR_OLLAMA_TIMEOUT', 300))
+OLLAMA_WARMUP = os.environ.get('FIGR_OLLAMA_WARMUP', '1') != '0'
+PREWARM = os.environ.get('FIGR_PREWARM', '1') != '0'  # load the lazy imports before serving
+
+# Model of each kind of LLM call. Chat questions up to SHORT_QUESTION_TOKENS go to the chat_short model,
+# e.g. FIGR_MODEL_SHORT=qwen2.5-coder:1.5b, while uploads can use a larger one with FIGR_MODEL_UPLOAD
+DEFAULT_MODEL = os.environ.get('FIGR_MODEL', 'mistral:7b')
+MODEL_ROUTES = {
+    "chat": os.environ.get('FIGR_MODEL_CHAT', DEFAULT_MODEL),
+    "chat_short": os.environ.get('FIGR_MODEL_SHORT', os.environ.get('FIGR_MODEL_CHAT', DEFAULT_MODEL)),
+    "summary": os.environ.get('FIGR_MODEL_SUMMARY', DEFAULT_MODEL),
+    "upload": os.environ.get('FIGR_MODEL_UPLOAD', DEFAULT_MODEL),
+}
+SHORT_QUESTION_TOKENS = int(os.environ.get('FIGR_SHORT_QUESTION_TOKENS', 40))
+# Follow-up chat turns continue from the context (token ids) Ollama returned for the session's previous turn,
+# so only the new request is prefilled, until the context and a reply of LLM_REPLY_TOKENS would outgrow the
+# model's window of LLM_CONTEXT_TOKENS
+LLM_CONTEXT_REUSE = os.environ.get('FIGR_LLM_CONTEXT_REUSE', '1') != '0'
+LLM_CONTEXT_TOKENS = int(os.environ.get('FIGR_LLM_CONTEXT_TOKENS', 4096))
+LLM_REPLY_TOKENS = 1024
+# Generations each model may run at once, as "model=n,model=n"; unlisted models get LLM_CONCURRENCY
+MODEL_CONCURRENCY = {
+    name.strip(): int(limit)
+    for name, limit in (
+        item.rsplit('=', 1) for item in os.environ.get('FIGR_MODEL_CONCURRENCY', '').split(',') if '=' in item
+    )
+}
+
+
+# Upper bounds (seconds) of the latency histogram buckets, from a cached lookup up to a long generation
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _label_text(labelnames, values):
+    if not labelnames:
+        return ""
+    pairs = (f'{name}="{str(value)}"'.replace("\n", " ") for name, value in zip(labelnames, values))
+    return "{" + ",".join(pairs) + "}"
+
+
+# Monotonic counter, one value per combination of label values
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        if not METRICS_ENABLED:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, labels, value) for labels, value in self._values.items()]
+
+
+# Latency distribution with cumulative buckets, as Prometheus expects them
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._values = {}  # labels -> [count per bucket..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        if not METRICS_ENABLED:
+            return
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+            counts[position] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = {labels: list(counts) for labels, counts in self._values.items()}
+        samples = []
+        for labels, counts in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", labels + (bound,), cumulative))
+            samples.append((f"{self.name}_count", labels, cumulative))
+            samples.append((f"{self.name}_sum", labels, counts[-1]))
+        return samples
+
+    def sample_labelnames(self, sample_name):
+        return self.labelnames + ("le",) if sample_name.endswith("_bucket") else self.labelnames
+
+
+# Values read when /metrics is scraped, for state other parts of the app already keep (cache sizes, hit counts)
+class CallbackMetric:
+    def __init__(self, name, help_text, kind, labelnames, collect):
+        self.name = name
+        self.help_text = help_text
+        self.kind = kind
+        self.labelnames = labelnames
+        self.collect = collect
+
+    def samples(self):
+        return [(self.name, tuple(labels), value) for labels, value in self.collect()]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._register(Counter(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def callback(self, name, help_text, kind, labelnames, collect):
+        return self._register(CallbackMetric(name, help_text, kind, labelnames, collect))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Every metric in the Prometheus text exposition format"""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for sample_name, labels, value in metric.samples():
+                labelnames = (metric.sample_labelnames(sample_name) if isinstance(metric, Histogram)
+                              else metric.labelnames)
+                lines.append(f"{sample_name}{_label_text(labelnames, labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+stage_seconds = metrics.histogram(
+    "figr_stage_seconds", "Time spent in each stage of the request pipeline", ("stage",)
+)
+http_requests = metrics.counter("figr_http_requests_total", "HTTP requests handled", ("endpoint", "status"))
+http_seconds = metrics.histogram("figr_http_request_seconds", "HTTP request latency", ("endpoint",))
+llm_calls = metrics.counter("figr_llm_calls_total", "LLM generations", ("kind", "model"))
+llm_prompt_tokens = metrics.counter(
+    "figr_llm_prompt_tokens_total", "Estimated prompt tokens sent to the LLM", ("kind", "model")
+)
+llm_completion_tokens = metrics.counter(
+    "figr_llm_completion_tokens_total", "Estimated tokens generated by the LLM", ("kind", "model")
+)
+llm_prefill_tokens = metrics.counter(
+    "figr_llm_prefill_tokens_total", "Prompt tokens the LLM evaluated, as reported by Ollama", ("kind", "model")
+)
+db_roundtrips = metrics.counter("figr_db_roundtrips_total", "SQLite statements executed")
+sandbox_runs = metrics.counter("figr_sandbox_runs_total", "Code runs of /api/test-code", ("outcome",))
+retention_actions = metrics.counter(
+    "figr_retention_total", "Chats archived, restored and deleted and rows and pages reclaimed by retention", ("action",)
+)
+
+_trace_local = threading.local()
+
+
+# Stage timings of one request, collected into figr_stage_seconds and the optional trace log
+class RequestTrace:
+    def __init__(self, method, path):
+        self.method = method
+        self.path = path
+        self.started = time.perf_counter()
+        self.spans = []
+
+    def to_dict(self, status):
+        return {
+            "trace_id": uuid.uuid4().hex,
+            "time": ms_to_iso(now_ms()),
+            "method": self.method,
+            "path": self.path,
+            "status": status,
+            "duration_ms": round((time.perf_counter() - self.started) * 1000, 3),
+            "spans": [{"stage": stage, "ms": round(seconds * 1000, 3)} for stage, seconds in self.spans]
+        }
+
+
+def current_trace():
+    return getattr(_trace_local, "trace", None)
+
+
+@contextmanager
+def use_trace(trace):
+    """Attribute spans recorded by this thread to trace, for work done on behalf of a request"""
+    previous = current_trace()
+    _trace_local.trace = trace
     try:
-        yield conn
+        yield
     finally:
-        conn.close()
+        _trace_local.trace = previous
 
-# Create the 3 tables in which I store the necessary details for chat history
-def init_db():
-    with get_db_connection() as conn:
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS chats (
-                id TEXT PRIMARY KEY,
-                title TEXT,
-                date TEXT,
-                last_message TEXT
-            )
-        ''')
 
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id TEXT,
-                role TEXT,
-                content TEXT,
-                timestamp TEXT,
-                FOREIGN KEY (chat_id) REFERENCES chats (id)
-            )
-        ''')
+def record_span(stage, seconds):
+    stage_seconds.observe(seconds, stage)
+    trace = current_trace()
+    if trace is not None:
+        trace.spans.append((stage, seconds))
+
+
+# Times a stage of the request pipeline: `with span("prompt_build"): ...`
+class span:
+    __slots__ = ("stage", "started")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        if METRICS_ENABLED:
+            record_span(self.stage, time.perf_counter() - self.started)
+
+
+_trace_log_lock = threading.Lock()
+
+
+def write_trace(trace, status):
+    line = json.dumps(trace.to_dict(status))
+    with _trace_log_lock, open(TRACE_LOG_PATH, "a") as f:
+        f.write(line + "\n")
+
+
+# sqlite3 connection whose commit() is deferred while a db_transaction() is open,
+# so the helpers that commit on their own can be grouped into one transaction
+class PooledConnection(sqlite3.Connection):
+    transaction_depth = 0
+
+    def commit(self):
+        if self.transaction_depth == 0:
+            super().commit()
+
+    def execute(self, *args):
+        db_roundtrips.inc()
+        return super().execute(*args)
+
+    def executemany(self, *args):
+        db_roundtrips.inc()
+        return super().executemany(*args)
+
+
+# Pool of long lived connections in WAL mode, so requests stop paying connect and page cache warmup
+# and readers never wait behind a writer. Each connection keeps its own prepared statement cache.
+class ConnectionPool:
+    def __init__(self, path, size=DB_POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._pid = os.getpid()
+        self._inherited = []
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=DB_POOL_TIMEOUT,
+            factory=PooledConnection,
+            check_same_thread=False,
+            cached_statements=256
+        )
+        conn.row_factory = sqlite3.Row
+        # Only takes effect on a new database, before journal_mode writes its header (see enable_incremental_vacuum)
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')  # WAL stays consistent, only the last commits may roll back on power loss
+        conn.execute(f'PRAGMA cache_size=-{DB_CACHE_SIZE_KB}')
+        conn.execute(f'PRAGMA mmap_size={DB_MMAP_SIZE}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA foreign_keys=OFF')
+        return conn
+
+    def _after_fork(self):
+        # Connections opened before a fork belong to the parent: they are set aside, never used or closed here
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            while True:
+                try:
+                    self._inherited.append(self._idle.get_nowait())
+                except queue.Empty:
+                    break
+            self._created = 0
+            self._local = threading.local()
+            self._pid = os.getpid()
+
+    def _acquire(self):
+        if self._pid != os.getpid():
+            self._after_fork()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+        if can_create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        try:
+            return self._idle.get(timeout=DB_POOL_TIMEOUT)
+        except queue.Empty:
+            raise sqlite3.OperationalError("Timed out waiting for a database connection")
+
+    def _release(self, conn):
+        # Never hand a half finished transaction to the next user
+        if conn.in_transaction:
+            conn.rollback()
+        conn.transaction_depth = 0
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection; nested use in the same thread shares it"""
+        conn = getattr(self._local, 'conn', None) if self._pid == os.getpid() else None
+        if conn is not None:
+            yield conn
+            return
+
+        conn = self._acquire()
+        self._local.conn = conn
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            self._release(conn)
+
+    @contextmanager
+    def transaction(self):
+        """Run everything inside the block as one write transaction"""
+        with self.connection() as conn:
+            if conn.transaction_depth == 0 and not conn.in_transaction:
+                conn.execute('BEGIN IMMEDIATE')
+            conn.transaction_depth += 1
+            try:
+                yield conn
+            except BaseException:
+                conn.transaction_depth -= 1
+                if conn.transaction_depth == 0:
+                    conn.rollback()
+                raise
+            conn.transaction_depth -= 1
+            if conn.transaction_depth == 0:
+                conn.commit()
+
+    def close_all(self):
+        """Close the idle connections, used when the db file is swapped out"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+
+db_pool = ConnectionPool(DATABASE_PATH)
+
+
+# To borrow a pooled connection for the lifetime of the with block
+def get_db_connection():
+    return db_pool.connection()
+
+
+# To group several writes (and their commits) of one request into a single transaction
+def db_transaction():
+    return db_pool.transaction()
+
+# Timestamps are stored as integer milliseconds since the epoch so they sort and compare as numbers
+def now_ms():
+    return int(time.time() * 1000)
+
+
+def ms_to_iso(ms):
+    return datetime.fromtimestamp(ms / 1000).isoformat() if ms is not None else None
+
+
+def iso_to_ms(value):
+    """Convert the ISO-8601 text timestamps written before migration 2"""
+    if value is None:
+        return None
+    try:
+        return int(datetime.fromisoformat(value).timestamp() * 1000)
+    except (TypeError, ValueError):
+        return None
+
+
+# Migration 1: the original tables in which I store the necessary details for chat history
+def _migration_initial_schema(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS chats (
+            id TEXT PRIMARY KEY,
+            title TEXT,
+            date TEXT,
+            last_message TEXT
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id TEXT,
+            role TEXT,
+            content TEXT,
+            timestamp TEXT,
+            FOREIGN KEY (chat_id) REFERENCES chats (id)
+        )
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS important_info (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id TEXT,
+            content TEXT,
+            FOREIGN KEY (chat_id) REFERENCES chats (id)
+        )
+    ''')
+
+    # Rolling summary of the turns that dropped out of the memory window
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS chat_summaries (
+            chat_id TEXT PRIMARY KEY,
+            summary TEXT,
+            summarized_upto INTEGER,
+            FOREIGN KEY (chat_id) REFERENCES chats (id)
+        )
+    ''')
+
+
+# Migration 2: integer timestamps and indexes for the per chat and chat list queries
+def _migration_indexes_and_integer_timestamps(conn):
+    conn.create_function('iso_to_ms', 1, iso_to_ms, deterministic=True)
+
+    conn.execute('''
+        CREATE TABLE chats_new (
+            id TEXT PRIMARY KEY,
+            title TEXT,
+            date INTEGER,
+            last_message TEXT
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO chats_new (id, title, date, last_message)
+        SELECT id, title, iso_to_ms(date), last_message FROM chats
+    ''')
+    conn.execute('DROP TABLE chats')
+    conn.execute('ALTER TABLE chats_new RENAME TO chats')
+
+    conn.execute('''
+        CREATE TABLE messages_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id TEXT NOT NULL,
+            role TEXT,
+            content TEXT,
+            timestamp INTEGER,
+            FOREIGN KEY (chat_id) REFERENCES chats (id)
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO messages_new (id, chat_id, role, content, timestamp)
+        SELECT id, chat_id, role, content, iso_to_ms(timestamp) FROM messages
+    ''')
+    conn.execute('DROP TABLE messages')
+    conn.execute('ALTER TABLE messages_new RENAME TO messages')
 
-        conn.execute('''
-            CREATE TABLE IF NOT EXISTS important_info (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id TEXT,
-                content TEXT,
-                FOREIGN KEY (chat_id) REFERENCES chats (id)
+    conn.execute('CREATE INDEX idx_messages_chat_id ON messages (chat_id, id)')
+    conn.execute('CREATE INDEX idx_important_info_chat_id ON important_info (chat_id, id)')
+    conn.execute('CREATE INDEX idx_chats_date ON chats (date)')
+
+
+# Migration 3: keep the raw model output in content and the rendered HTML next to it
+def _migration_rendered_html(conn):
+    conn.execute('ALTER TABLE messages ADD COLUMN html TEXT')
+    conn.execute('ALTER TABLE messages ADD COLUMN render_version INTEGER NOT NULL DEFAULT 0')
+    # User messages are displayed as typed, there is nothing to render
+    conn.execute("UPDATE messages SET render_version = 1 WHERE role = 'user'")
+
+
+# Migration 4: chat list cursor pagination on (date, id) and a change stamp for its ETag
+def _migration_chat_list_pagination(conn):
+    conn.execute('ALTER TABLE chats ADD COLUMN updated_at INTEGER')
+    conn.execute('UPDATE chats SET updated_at = date')
+    conn.execute('DROP INDEX idx_chats_date')
+    conn.execute('CREATE INDEX idx_chats_date ON chats (date, id)')
+    conn.execute('CREATE INDEX idx_chats_updated_at ON chats (updated_at)')
+
+
+# Analyses of uploaded code chunks keyed by content hash, so re-uploads only analyze what changed
+def _migration_chunk_analyses(conn):
+    conn.execute('''
+        CREATE TABLE chunk_analyses (
+            hash TEXT PRIMARY KEY,
+            analysis TEXT NOT NULL,
+            created_at INTEGER NOT NULL
+        )
+    ''')
+
+
+# Full text indexes over message and important info content, kept in sync by triggers
+def _migration_full_text_search(conn):
+    for table in ('messages', 'important_info'):
+        conn.execute(f'''
+            CREATE VIRTUAL TABLE {table}_fts USING fts5(
+                content, content='{table}', content_rowid='id', tokenize='porter unicode61', prefix='2 3 4'
             )
         ''')
-        conn.commit()
+        conn.execute(f'''
+            CREATE TRIGGER {table}_fts_insert AFTER INSERT ON {table} BEGIN
+                INSERT INTO {table}_fts (rowid, content) VALUES (new.id, new.content);
+            END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER {table}_fts_delete AFTER DELETE ON {table} BEGIN
+                INSERT INTO {table}_fts ({table}_fts, rowid, content) VALUES ('delete', old.id, old.content);
+            END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER {table}_fts_update AFTER UPDATE OF content ON {table} BEGIN
+                INSERT INTO {table}_fts ({table}_fts, rowid, content) VALUES ('delete', old.id, old.content);
+                INSERT INTO {table}_fts (rowid, content) VALUES (new.id, new.content);
+            END
+        ''')
+        conn.execute(f"INSERT INTO {table}_fts ({table}_fts) VALUES ('rebuild')")
 
 
-# Initialize database on startup of app
-init_db()
+# Migration 7: dedup key and ranking columns for important info. Rows written before it have no norm_hash
+# and are hashed and merged by compact_important_info in the background instead of here.
+def _migration_important_info_ranking(conn):
+    conn.execute('ALTER TABLE important_info ADD COLUMN norm_hash TEXT')
+    conn.execute('ALTER TABLE important_info ADD COLUMN hits INTEGER NOT NULL DEFAULT 1')
+    conn.execute('ALTER TABLE important_info ADD COLUMN last_seen INTEGER')
+    conn.execute('CREATE INDEX idx_important_info_norm_hash ON important_info (chat_id, norm_hash)')
 
 
-# Defines a custom class to manage a chat session by initialising it and loading previous chat from the db which is initialised earlier.
-class ChatSession:
-    def __init__(self, session_id):
-        self.session_id = session_id
-        self.memory = ConversationBufferMemory(
-            memory_key="chat_history",
-            return_messages=True
+# Migration 8: cold storage for the messages of idle chats
+def _migration_archived_chats(conn):
+    conn.execute('ALTER TABLE chats ADD COLUMN archived_at INTEGER')
+    conn.execute('''
+        CREATE TABLE archived_chats (
+            chat_id TEXT PRIMARY KEY,
+            messages BLOB NOT NULL,
+            message_count INTEGER NOT NULL,
+            archived_at INTEGER NOT NULL
         )
-        self._load_chat_history()
-        self._load_important_info()
+    ''')
 
-    def _load_chat_history(self):
-        """Load chat history from database"""
-        with get_db_connection() as conn:
-            messages = conn.execute(
-                'SELECT role, content, timestamp FROM messages WHERE chat_id = ? ORDER BY timestamp',
-                (self.session_id,)
-            ).fetchall()
 
-            self.chat_history = []
-            for msg in messages:
-                self.chat_history.append({
-                    "role": msg['role'],
-                    "content": msg['content'],
-                    "timestamp": msg['timestamp']
-                })
-                if msg['role'] == "user":
-                    self.memory.chat_memory.add_user_message(msg['content'])
-                else:
-                    self.memory.chat_memory.add_ai_message(msg['content'])
-                    
-    # Function to load the important info given my model in earlier responses
-    def _load_important_info(self):
-        """Load important info from database"""
-        with get_db_connection() as conn:
-            info = conn.execute(
-                'SELECT content FROM important_info WHERE chat_id = ?',
-                (self.session_id,)
-            ).fetchall()
-            self.important_info = [row['content'] for row in info]
+# Ordered schema migrations; PRAGMA user_version records how many have been applied
+SCHEMA_MIGRATIONS = [
+    _migration_initial_schema,
+    _migration_indexes_and_integer_timestamps,
+    _migration_rendered_html,
+    _migration_chat_list_pagination,
+    _migration_chunk_analyses,
+    _migration_full_text_search,
+    _migration_important_info_ranking,
+    _migration_archived_chats,
+]
 
-    def add_message(self, role, content):
-        timestamp = datetime.now().isoformat()
-        message = {
-            "role": role,
-            "content": content,
-            "timestamp": timestamp
-        }
 
-        # Store in database
-        with get_db_connection() as conn:
-            conn.execute(
-                'INSERT INTO messages (chat_id, role, content, timestamp) VALUES (?, ?, ?, ?)',
-                (self.session_id, role, content, timestamp)
-            )
-            conn.commit()
+def apply_migrations(conn, target=None):
+    """Bring the schema up to date, one migration at a time"""
+    target = len(SCHEMA_MIGRATIONS) if target is None else target
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for number in range(version + 1, target + 1):
+        SCHEMA_MIGRATIONS[number - 1](conn)
+        conn.execute(f'PRAGMA user_version = {number}')
+    return max(version, target)
 
-        self.chat_history.append(message)
 
-        # Update memory
-        if role == "user":
-            self.memory.chat_memory.add_user_message(content)
-        else:
-            self.memory.chat_memory.add_ai_message(content)
+# Incremental auto vacuum lets the retention worker give freed pages back in small steps. A new database gets it
+# for free as the pool sets it before the first write; switching an existing one takes a full VACUUM, which blocks
+# every writer for as long as it runs, so it is left to `python app.py vacuum`.
+def enable_incremental_vacuum(conn):
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+        return False
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    conn.execute('VACUUM')
+    return True
 
-    # Adds the important info of current response
-    def add_important_info(self, content):
-        """Add important information to database"""
-        with get_db_connection() as conn:
-            conn.execute(
-                'INSERT INTO important_info (chat_id, content) VALUES (?, ?)',
-                (self.session_id, content)
-            )
-            conn.commit()
-        self.important_info.append(content)
 
-    def get_memory_variables(self):
-        return self.memory.load_memory_variables({})
+db_ready = False
+db_init_lock = threading.Lock()
 
-    # Function to clear all memory
-    def clear_memory(self):
-        """Clear all memory from database"""
-        with get_db_connection() as conn:
-            conn.execute('DELETE FROM messages WHERE chat_id = ?', (self.session_id,))
-            conn.execute('DELETE FROM important_info WHERE chat_id = ?', (self.session_id,))
-            conn.commit()
 
-        self.memory.clear()
-        self.chat_history = []
-        self.important_info = []
+# Run by main() before serving or a CLI command, and by the first request under any other WSGI server,
+# so importing the app (a benchmark, a server worker) doesn't touch the database
+def init_db():
+    global db_ready
+    if db_ready:
+        return
+    with db_init_lock:
+        if db_ready:
+            return
+        # The write lock makes concurrent workers wait for whichever one migrates first
+        with db_transaction() as conn:
+            apply_migrations(conn)
+        db_ready = True
+    # Important info stored before migration 7 is deduplicated without holding up startup
+    start_important_info_compaction()
 
-    def clear_chat_history(self):
-        """Clear chat history from database"""
-        with get_db_connection() as conn:
-            conn.execute('DELETE FROM messages WHERE chat_id = ?', (self.session_id,))
-            conn.commit()
 
-        self.chat_history = []
-        self.memory.chat_memory.clear()
+@app.before_request
+def ensure_db():
+    init_db()
 
-    def clear_important_info(self):
-        """Clear important info from database"""
-        with get_db_connection() as conn:
-            conn.execute('DELETE FROM important_info WHERE chat_id = ?', (self.session_id,))
-            conn.commit()
 
-        self.important_info = []
+# Rough token count (about 4 characters per token) used to keep the prompt within budget
+def estimate_tokens(text):
+    return len(text) // 4 + 1 if text else 0
 
 
-# Custom designed prompt template to achieve best results
-prompt_template = """
-Role: You are Figr Code Assistant, specializing in providing clear, error-free Python code solutions.
+# Conversation memory with a fixed token budget: a window of recent messages plus a rolling summary of older ones
+class BudgetedMemory:
+    def __init__(self, strategy=MEMORY_STRATEGY, token_budget=MEMORY_TOKEN_BUDGET):
+        if strategy not in MEMORY_STRATEGIES:
+            raise ValueError(f"Unknown memory strategy: {strategy}")
+        self.strategy = strategy
+        self.token_budget = token_budget
+        self.summary = ""
+        self.messages = deque()
+        self.window_tokens = 0
 
-Context:
-{important_info}
+    def add_message(self, message_id, role, content):
+        tokens = estimate_tokens(content)
+        self.messages.append({"id": message_id, "role": role, "content": content, "tokens": tokens})
+        self.window_tokens += tokens
 
-Previous Conversation:
-{chat_history}
+    def evict_over_budget(self):
+        """Remove the oldest messages until the window and summary fit the token budget"""
+        evicted = []
+        if self.strategy == 'buffer':
+            return evicted
 
-Current Request:
-{user_request}
+        budget = self.token_budget - estimate_tokens(self.summary)
+        while len(self.messages) > 1 and self.window_tokens > budget:
+            message = self.messages.popleft()
+            self.window_tokens -= message["tokens"]
+            evicted.append(message)
+        return evicted
 
-Output Guidelines:
-1. Code Format:
-   - Use ```python for code blocks
-   - Use `code` for inline code references
-   - Provide raw text without HTML formatting
-   - Strictly include explanation only after code blocks
+    def restore(self, messages):
+        """Put evicted messages back at the front of the window"""
+        for message in reversed(messages):
+            self.messages.appendleft(message)
+            self.window_tokens += message["tokens"]
 
-2. Code Organization:
-   - Default to single, focused code snippets for clarity
-   - Only split into multiple snippets(each individually runnable) if:
-     a) Multiple distinct concepts are requested
-     b) Complex functionality requires modular explanation
-     
-   - Mark critical information with [IMPORTANT] prefix and give small explanations with some bold headings if required and in white font always.
-"""
+    def load_memory_variables(self, inputs):
+        lines = []
+        if self.summary:
+            lines.append(f"Summary of earlier conversation: {self.summary}")
+        for message in self.messages:
+            speaker = "User" if message["role"] == "user" else "Assistant"
+            lines.append(f"{speaker}: {message['content']}")
+        return {"chat_history": "\n".join(lines)}
 
-prompt = PromptTemplate(
-    input_variables=["user_request", "chat_history", "important_info"],
-    template=prompt_template
-)
-llm_chain = LLMChain(llm=llm, prompt=prompt)
+    def clear(self):
+        self.summary = ""
+        self.messages.clear()
+        self.window_tokens = 0
 
 
-# Using pandac to convert raw text to HTML markdown and in order to segregate code blocks to place copy code and test code buttons
-def convert_to_html(raw_text):
-    """Convert markdown to HTML while preserving code blocks with custom buttons"""
-    try:
-        # Create a temporary markdown file
-        with tempfile.NamedTemporaryFile(delete=False, mode="w", suffix=".md") as temp_input:
-            temp_input.write(raw_text)
-            temp_input_path = temp_input.name
-
-        # Use pandoc with specific options to preserve code blocks for better UI
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".html") as temp_output:
-            temp_output_path = temp_output.name
-
-        # Use pandoc with specific options
-        cmd = [
-            "pandoc",
-            temp_input_path,
-            "-f", "markdown",
-            "-t", "html",
-            "--highlight-style=pygments",
-            "--no-highlight",
-            "-o", temp_output_path
-        ]
+# Important info lines that differ only in case, punctuation or spacing are the same entry
+def important_info_hash(content):
+    words = re.findall(r"[a-z0-9_]+", content.lower())
+    return content_hash(" ".join(words) if words else content.strip().lower())
+
 
-        result = subprocess.run(cmd, capture_output=True, text=True)
-
-        if result.returncode == 0:
-            with open(temp_output_path, "r") as f:
-                html_content = f.read()
-
-            # Add custom buttons to code blocks
-            import re
-            def replace_code_block(match):
-                code_class = match.group(1) or ''
-                code_content = match.group(2)
-                return f'''
-                    <div class="code-block-wrapper">
-                        <button class="test-button">Test Code</button>
-                        <button class="copy-button">Copy Code</button>
-                        <pre><code class="hljs {code_class}">{code_content}</code></pre>
-                        <div class="test-results"></div>
-                    </div>
-                '''
-
-            # Replace <pre><code> blocks with our custom wrapper (i have done this to achieve good code blocks in the interface.)
-            pattern = r'<pre><code class="([^"]*)">(.*?)</code></pre>'
-            html_content = re.sub(pattern, replace_code_block, html_content, flags=re.DOTALL)
+# Deduplicated important info of a chat, ranked by hits * 0.5 ** (age / half life). The ratio of two scores
+# doesn't depend on the current time, so the order is stable and the score is kept as a logarithm.
+class ImportantInfoStore:
+    def __init__(self, limit=IMPORTANT_INFO_PROMPT_LIMIT, half_life=IMPORTANT_INFO_HALF_LIFE):
+        self.limit = limit
+        self.half_life = half_life
+        self.entries = {}
+        self._sequence = 0
 
+    def add(self, content, hits=1, last_seen=None):
+        """Add an entry or count a repeat of it"""
+        key = important_info_hash(content)
+        last_seen = last_seen if last_seen is not None else now_ms()
+        self._sequence += 1
+        entry = self.entries.get(key)
+        if entry is None:
+            self.entries[key] = {"content": content, "hits": hits, "last_seen": last_seen, "sequence": self._sequence}
         else:
-            html_content = f"Error: {result.stderr}"
+            entry["hits"] += hits
+            entry["last_seen"] = max(entry["last_seen"], last_seen)
+            entry["sequence"] = self._sequence
+        return key
+
+    def score(self, entry):
+        return math.log(max(entry["hits"], 1)) + entry["last_seen"] / 1000 / self.half_life * math.log(2)
+
+    def ranked(self, limit=None):
+        """Entry contents, highest score first"""
+        entries = sorted(self.entries.values(), key=lambda entry: (self.score(entry), entry["sequence"]), reverse=True)
+        return [entry["content"] for entry in entries[:limit]]
+
+    def prompt_entries(self):
+        return self.ranked(self.limit)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# Counts a repeat of an important info entry, or stores it if the chat doesn't have it yet
+def store_important_info(conn, chat_id, content, seen):
+    key = important_info_hash(content)
+    cursor = conn.execute(
+        '''UPDATE important_info SET hits = hits + 1, last_seen = ?
+           WHERE id = (SELECT MIN(id) FROM important_info WHERE chat_id = ? AND norm_hash = ?)''',
+        (seen, chat_id, key)
+    )
+    if cursor.rowcount == 0:
+        conn.execute(
+            'INSERT INTO important_info (chat_id, content, norm_hash, hits, last_seen) VALUES (?, ?, ?, 1, ?)',
+            (chat_id, content, key, seen)
+        )
+
+
+# Hashes the important info rows written before migration 7 and merges the duplicates of every chat into
+# their oldest row. Runs in short transactions so chat turns only ever wait for one batch.
+def compact_important_info(batch_size=IMPORTANT_INFO_COMPACT_BATCH, pause=0.01):
+    """Deduplicate stored important info; returns the number of rows removed"""
+    while True:
+        with db_transaction() as conn:
+            rows = conn.execute(
+                'SELECT id, content FROM important_info WHERE norm_hash IS NULL LIMIT ?', (batch_size,)
+            ).fetchall()
+            # The chat's last activity is the best guess of when a legacy entry was last seen
+            conn.executemany(
+                '''UPDATE important_info SET norm_hash = ?,
+                   last_seen = COALESCE(last_seen, (SELECT updated_at FROM chats WHERE chats.id = important_info.chat_id), 0)
+                   WHERE id = ?''',
+                [(important_info_hash(row['content'] or ""), row['id']) for row in rows]
+            )
+        if len(rows) < batch_size:
+            break
+        time.sleep(pause)
+
+    removed = 0
+    while True:
+        with db_transaction() as conn:
+            groups = conn.execute(
+                '''SELECT chat_id, norm_hash, MIN(id) AS keep, SUM(hits) AS hits, MAX(last_seen) AS last_seen
+                   FROM important_info WHERE norm_hash IS NOT NULL
+                   GROUP BY chat_id, norm_hash HAVING COUNT(*) > 1 LIMIT ?''',
+                (batch_size,)
+            ).fetchall()
+            for group in groups:
+                conn.execute('UPDATE important_info SET hits = ?, last_seen = ? WHERE id = ?',
+                             (group['hits'], group['last_seen'], group['keep']))
+                removed += conn.execute(
+                    'DELETE FROM important_info WHERE chat_id = ? AND norm_hash = ? AND id != ?',
+                    (group['chat_id'], group['norm_hash'], group['keep'])
+                ).rowcount
+        if len(groups) < batch_size:
+            return removed
+        time.sleep(pause)
+
+
+def start_important_info_compaction():
+    """Compact legacy important info in a background thread if there is any"""
+    with get_db_connection() as conn:
+        pending = conn.execute('SELECT 1 FROM important_info WHERE norm_hash IS NULL LIMIT 1').fetchone()
+    if pending is None:
+        return None
+    thread = threading.Thread(target=compact_important_info, daemon=True, name="important-info-compaction")
+    thread.start()
+    return thread
+
+
+# Moves the messages of chats idle since before cutoff (epoch ms) into archived_chats as compressed JSON.
+# The chats row and important info stay, so the chat is still listed and restore_archived_chat brings it back.
+def archive_idle_chats(cutoff, pool=None, batch_size=RETENTION_BATCH, pause=0.01):
+    """Archive idle chats in short transactions; returns the number of chats archived"""
+    pool = pool or db_pool
+    archived = 0
+    while True:
+        with pool.transaction() as conn:
+            chat_ids = [row['id'] for row in conn.execute(
+                '''SELECT id FROM chats WHERE updated_at < ? AND archived_at IS NULL
+                   AND EXISTS (SELECT 1 FROM messages WHERE chat_id = chats.id) LIMIT ?''',
+                (cutoff, batch_size)
+            )]
+            for chat_id in chat_ids:
+                rows = conn.execute(
+                    'SELECT id, role, content, timestamp, html, render_version FROM messages WHERE chat_id = ? ORDER BY id',
+                    (chat_id,)
+                ).fetchall()
+                conn.execute(
+                    'INSERT INTO archived_chats (chat_id, messages, message_count, archived_at) VALUES (?, ?, ?, ?)',
+                    (chat_id, zlib.compress(json.dumps([tuple(row) for row in rows]).encode('utf-8')), len(rows), now_ms())
+                )
+                conn.execute('DELETE FROM messages WHERE chat_id = ?', (chat_id,))
+                conn.execute('UPDATE chats SET archived_at = ? WHERE id = ?', (now_ms(), chat_id))
+        archived += len(chat_ids)
+        retention_actions.inc("archived", amount=len(chat_ids))
+        if len(chat_ids) < batch_size:
+            return archived
+        time.sleep(pause)
+
+
+# Puts the messages of an archived chat back, called before a chat is loaded or displayed
+def restore_archived_chat(chat_id):
+    """Restore an archived chat; returns False when it isn't archived"""
+    with get_db_connection() as conn:
+        if conn.execute('SELECT 1 FROM archived_chats WHERE chat_id = ?', (chat_id,)).fetchone() is None:
+            return False
+    with span("chat_restore"), db_transaction() as conn:
+        row = conn.execute('SELECT messages FROM archived_chats WHERE chat_id = ?', (chat_id,)).fetchone()
+        if row is None:
+            return False
+        conn.executemany(
+            '''INSERT OR IGNORE INTO messages (id, chat_id, role, content, timestamp, html, render_version)
+               VALUES (?, ?, ?, ?, ?, ?, ?)''',
+            [(message_id, chat_id, role, content, timestamp, html, render_version)
+             for message_id, role, content, timestamp, html, render_version in json.loads(zlib.decompress(row['messages']))]
+        )
+        conn.execute('DELETE FROM archived_chats WHERE chat_id = ?', (chat_id,))
+        # Opening a chat counts as activity, so it isn't archived again on the next run
+        conn.execute('UPDATE chats SET archived_at = NULL, updated_at = ? WHERE id = ?', (now_ms(), chat_id))
+    retention_actions.inc("restored")
+    return True
+
+
+# Deletes chats and everything stored for them, in batches of ids picked by select
+def _delete_chats(pool, select, params, action, batch_size, pause):
+    deleted = 0
+    while True:
+        with pool.transaction() as conn:
+            chat_ids = [(row[0],) for row in conn.execute(select, params + (batch_size,))]
+            for table, column in (('messages', 'chat_id'), ('important_info', 'chat_id'),
+                                  ('chat_summaries', 'chat_id'), ('archived_chats', 'chat_id'), ('chats', 'id')):
+                conn.executemany(f'DELETE FROM {table} WHERE {column} = ?', chat_ids)
+        deleted += len(chat_ids)
+        retention_actions.inc(action, amount=len(chat_ids))
+        if len(chat_ids) < batch_size:
+            return deleted
+        time.sleep(pause)
+
+
+def delete_expired_chats(archived_cutoff, empty_cutoff, pool=None, batch_size=RETENTION_BATCH, pause=0.01):
+    """Delete archived chats idle since archived_cutoff and empty chats idle since empty_cutoff"""
+    pool = pool or db_pool
+    deleted = 0
+    if archived_cutoff is not None:
+        deleted += _delete_chats(
+            pool, 'SELECT id FROM chats WHERE archived_at IS NOT NULL AND updated_at < ? LIMIT ?',
+            (archived_cutoff,), "expired", batch_size, pause
+        )
+    if empty_cutoff is not None:
+        # Chats that were never used or had their memory cleared
+        deleted += _delete_chats(
+            pool, '''SELECT id FROM chats WHERE updated_at < ? AND archived_at IS NULL
+                     AND NOT EXISTS (SELECT 1 FROM messages WHERE chat_id = chats.id)
+                     AND NOT EXISTS (SELECT 1 FROM important_info WHERE chat_id = chats.id) LIMIT ?''',
+            (empty_cutoff,), "empty", batch_size, pause
+        )
+    return deleted
+
+
+# Removes rows whose chat no longer exists. The lookups only read, so they don't hold up writers.
+def delete_orphans(pool=None, batch_size=RETENTION_BATCH):
+    """Delete messages, important info, summaries and archives without a chat; returns the rows removed"""
+    pool = pool or db_pool
+    removed = 0
+    for table in ('messages', 'important_info', 'chat_summaries', 'archived_chats'):
+        with pool.connection() as conn:
+            orphans = [(row[0],) for row in conn.execute(
+                f'SELECT DISTINCT chat_id FROM {table} t WHERE NOT EXISTS (SELECT 1 FROM chats WHERE chats.id = t.chat_id)'
+            )]
+        for start in range(0, len(orphans), batch_size):
+            with pool.transaction() as conn:
+                removed += conn.executemany(f'DELETE FROM {table} WHERE chat_id = ?', orphans[start:start + batch_size]).rowcount
+    retention_actions.inc("orphans", amount=removed)
+    return removed
+
+
+# Deleting from an FTS5 index only adds tombstones to it; merging its segments a few pages at a time drops them
+# and frees the pages of the removed entries
+def merge_search_index(pool=None, step_pages=100, pause=0.01):
+    """Merge the full text index segments; returns the number of merge steps run"""
+    pool = pool or db_pool
+    steps = 0
+    for table in ('messages_fts', 'important_info_fts'):
+        while True:
+            with pool.transaction() as conn:
+                before = conn.total_changes
+                conn.execute(f"INSERT INTO {table} ({table}, rank) VALUES ('merge', ?)", (-step_pages,))
+                # Per the FTS5 docs, the merge is done once a step changes fewer than two rows
+                done = conn.total_changes - before < 2
+            steps += 1
+            if done:
+                break
+            time.sleep(pause)
+    return steps
+
+
+# Gives the free pages back to the file system a few at a time, so writers wait at most one step
+def incremental_vacuum(pool=None, step_pages=VACUUM_STEP_PAGES, pause=0.01):
+    """Shrink the database file; returns the number of pages released"""
+    pool = pool or db_pool
+    released = 0
+    with pool.connection() as conn:
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            return released
+        while True:
+            free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            if free == 0:
+                break
+            # execute() steps the pragma once, which frees a single page; a script runs it to completion
+            conn.executescript(f'BEGIN IMMEDIATE; PRAGMA incremental_vacuum({min(free, step_pages)}); COMMIT;')
+            released += min(free, step_pages)
+            time.sleep(pause)
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+    retention_actions.inc("vacuumed_pages", amount=released)
+    return released
+
+
+def run_retention(pool=None, now=None):
+    """Apply every retention policy once"""
+    now = now if now is not None else now_ms()
+
+    def days_ago(days):
+        return now - int(days * 86400 * 1000) if days > 0 else None
+
+    stats = {
+        "deleted": delete_expired_chats(days_ago(RETENTION_DELETE_DAYS), days_ago(RETENTION_EMPTY_CHAT_DAYS), pool),
+        "archived": archive_idle_chats(days_ago(RETENTION_ARCHIVE_DAYS), pool) if RETENTION_ARCHIVE_DAYS > 0 else 0,
+        "orphans": delete_orphans(pool),
+        "index_merges": merge_search_index(pool),
+    }
+    stats["vacuumed_pages"] = incremental_vacuum(pool)
+    return stats
+
+
+def start_retention_worker(interval=RETENTION_INTERVAL):
+    """Run the retention policies every interval seconds on a connection of their own"""
+    def run():
+        pool = ConnectionPool(DATABASE_PATH, size=1)
+        while True:
+            try:
+                run_retention(pool)
+            except Exception as e:
+                print(f"Retention run failed: {e}", file=sys.stderr)
+            # Closed between runs, so server workers forked meanwhile don't inherit it
+            pool.close_all()
+            time.sleep(interval)
+    thread = threading.Thread(target=run, daemon=True, name="retention")
+    thread.start()
+    return thread
+
+
+# Raised for an import that is not an export of this app or is cut short
+class ExportFormatError(ValueError):
+    pass
+
+
+# An export is a header line, then every chat, message (the messages of archived chats included), important info
+# and summary, one record per line, and an end line with the counts. Message ids are not kept, so a summary
+# records how many of its chat's messages it covers instead of the id of the last one.
+def export_records(pool=None):
+    """Yield the records of an export one at a time, all read from one snapshot of the database"""
+    pool = pool or db_pool
+    counts = {"chats": 0, "messages": 0, "important_info": 0, "summaries": 0}
+    with pool.connection() as conn:
+        # One read transaction: a consistent export while the app keeps writing, without blocking it
+        conn.execute('BEGIN')
+        try:
+            yield {"type": "header", "format": "figr-export", "version": EXPORT_FORMAT_VERSION,
+                   "schema_version": conn.execute('PRAGMA user_version').fetchone()[0], "exported_at": now_ms()}
+            for row in conn.execute('SELECT id, title, date, last_message, updated_at FROM chats ORDER BY id'):
+                counts["chats"] += 1
+                yield {"type": "chat", **dict(row)}
+
+            # In id order the table is read sequentially; the messages of a chat keep their order
+            for row in conn.execute('SELECT chat_id, role, content, timestamp, html, render_version FROM messages ORDER BY id'):
+                counts["messages"] += 1
+                yield {"type": "message", **dict(row)}
+            archived_covered = {}  # messages covered by the summary of each archived chat
+            for row in conn.execute(
+                '''SELECT a.chat_id, a.messages, s.summarized_upto FROM archived_chats a
+                   LEFT JOIN chat_summaries s ON s.chat_id = a.chat_id ORDER BY a.chat_id'''
+            ):
+                messages = json.loads(zlib.decompress(row['messages']))
+                archived_covered[row['chat_id']] = sum(1 for message in messages if message[0] <= (row['summarized_upto'] or 0))
+                for _, role, content, timestamp, html, render_version in messages:
+                    counts["messages"] += 1
+                    yield {"type": "message", "chat_id": row['chat_id'], "role": role, "content": content,
+                           "timestamp": timestamp, "html": html, "render_version": render_version}
+
+            for row in conn.execute('SELECT chat_id, content, hits, last_seen, norm_hash FROM important_info ORDER BY id'):
+                counts["important_info"] += 1
+                yield {"type": "important_info", **dict(row)}
+
+            for row in conn.execute(
+                '''SELECT chat_id, summary,
+                          (SELECT COUNT(*) FROM messages m WHERE m.chat_id = s.chat_id AND m.id <= s.summarized_upto) AS messages
+                   FROM chat_summaries s ORDER BY chat_id'''
+            ):
+                counts["summaries"] += 1
+                yield {"type": "summary", "chat_id": row['chat_id'], "summary": row['summary'],
+                       "messages": archived_covered.get(row['chat_id'], row['messages'])}
+        finally:
+            conn.rollback()
+    yield {"type": "end", "counts": counts}
+
+
+def encode_ndjson(records, compress=True, level=EXPORT_COMPRESSION_LEVEL, chunk_bytes=EXPORT_CHUNK_BYTES):
+    """Serialize records as NDJSON, gzip compressed when compress is set, in chunks of about chunk_bytes"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31) if compress else None  # wbits 31: a gzip stream
+    encode = json.JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode
+    lines, size = [], 0
+    for record in records:
+        line = encode(record)
+        lines.append(line)
+        size += len(line) + 1
+        if size >= chunk_bytes:
+            data = ('\n'.join(lines) + '\n').encode('utf-8')
+            lines, size = [], 0
+            data = compressor.compress(data) if compressor else data
+            if data:
+                yield data
+    data = ('\n'.join(lines) + '\n').encode('utf-8') if lines else b''
+    if compressor:
+        data = compressor.compress(data) + compressor.flush()
+    if data:
+        yield data
+
+
+def decode_ndjson(chunks, max_line=IMPORT_MAX_LINE_BYTES):
+    """Yield the records of an NDJSON byte stream given in chunks, gzip compressed or not"""
+    chunks = iter(chunks)
+    head = b''
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= 2:
+            break
+    decompressor = zlib.decompressobj(31) if head[:2] == b'\x1f\x8b' else None  # starts with the gzip magic number
+
+    def body():
+        yield head
+        yield from chunks
+
+    def inflate():
+        for chunk in body():
+            if decompressor is None:
+                yield chunk
+                continue
+            # A bounded amount at a time, so a small body cannot expand into a huge buffer
+            data = decompressor.decompress(chunk, EXPORT_CHUNK_BYTES)
+            while data:
+                yield data
+                data = decompressor.decompress(decompressor.unconsumed_tail, EXPORT_CHUNK_BYTES)
+        if decompressor is not None:
+            yield decompressor.flush()
+            if not decompressor.eof:
+                raise ExportFormatError("The compressed export is cut short")
+
+    def parse(line):
+        try:
+            return json.loads(line)
+        except ValueError as e:
+            raise ExportFormatError(f"Line {number} is not valid JSON: {e}")
+
+    # The start of a line that has not ended yet, kept in pieces so a long line is joined once
+    pending, pending_bytes = [], 0
+    number = 0
+    for data in inflate():
+        if b'\n' not in data:
+            pending.append(data)
+            pending_bytes += len(data)
+            if pending_bytes > max_line:
+                raise ExportFormatError(f"Line {number + 1} is longer than {max_line} bytes")
+            continue
+        lines = data.split(b'\n')
+        lines[0] = b''.join(pending) + lines[0]
+        pending = [lines.pop()]
+        pending_bytes = len(pending[0])
+        for line in lines:
+            number += 1
+            if line.strip():
+                yield parse(line)
+    line = b''.join(pending)
+    if line.strip():
+        number += 1
+        yield parse(line)
+
+
+# Writes one batch of imported records in a single transaction, one executemany per table. Chats already in the
+# database are left alone with all their records (mode "skip") or replaced by the imported ones (mode "replace").
+# Only records of the chats this import inserted are kept: an export can hold rows whose chat was deleted, and
+# those would otherwise be added again on every import.
+def _import_batch(conn, batch, mode, imported, counts):
+    chats = []
+    for record in batch["chat"]:
+        chat_id = record["id"]
+        if conn.execute('SELECT 1 FROM chats WHERE id = ?', (chat_id,)).fetchone() is not None:
+            if mode == "skip":
+                counts["skipped_chats"] += 1
+                continue
+            for table in ('messages', 'important_info', 'chat_summaries', 'archived_chats', 'chats'):
+                conn.execute(f'DELETE FROM {table} WHERE {"id" if table == "chats" else "chat_id"} = ?', (chat_id,))
+            session_cache.invalidate(chat_id)
+            counts["replaced_chats"] += 1
+        chats.append((chat_id, record.get("title"), record.get("date"), record.get("last_message"),
+                      record.get("updated_at", record.get("date"))))
+    conn.executemany('INSERT INTO chats (id, title, date, last_message, updated_at) VALUES (?, ?, ?, ?, ?)', chats)
+    imported.update(chat[0] for chat in chats)
+    counts["chats"] += len(chats)
+    counts["skipped_records"] += sum(
+        1 for kind in ("message", "important_info", "summary") for record in batch[kind] if record["chat_id"] not in imported
+    )
+
+    messages = [(record["chat_id"], record.get("role"), record.get("content"), record.get("timestamp"),
+                 record.get("html"), record.get("render_version", 0))
+                for record in batch["message"] if record["chat_id"] in imported]
+    conn.executemany(
+        'INSERT INTO messages (chat_id, role, content, timestamp, html, render_version) VALUES (?, ?, ?, ?, ?, ?)',
+        messages
+    )
+    counts["messages"] += len(messages)
+
+    info = [(record["chat_id"], record["content"], record.get("norm_hash") or important_info_hash(record["content"]),
+             record.get("hits", 1), record.get("last_seen"))
+            for record in batch["important_info"] if record["chat_id"] in imported]
+    conn.executemany(
+        'INSERT INTO important_info (chat_id, content, norm_hash, hits, last_seen) VALUES (?, ?, ?, ?, ?)', info
+    )
+    counts["important_info"] += len(info)
+
+    # Summaries come after every message, so the messages they cover are in by now
+    for record in batch["summary"]:
+        if record["chat_id"] not in imported:
+            continue
+        covered = record.get("messages", 0)
+        row = conn.execute(
+            'SELECT id FROM messages WHERE chat_id = ? ORDER BY id LIMIT 1 OFFSET ?', (record["chat_id"], covered - 1)
+        ).fetchone() if covered > 0 else None
+        conn.execute(
+            'INSERT OR REPLACE INTO chat_summaries (chat_id, summary, summarized_upto) VALUES (?, ?, ?)',
+            (record["chat_id"], record.get("summary"), row[0] if row else 0)
+        )
+        counts["summaries"] += 1
+
+
+def import_records(records, mode="skip", pool=None, batch_rows=IMPORT_BATCH_ROWS):
+    """Import the records of an export in transactions of batch_rows records; returns what was imported"""
+    if mode not in ("skip", "replace"):
+        raise ValueError(f"Unknown import mode: {mode}")
+    pool = pool or db_pool
+    records = iter(records)
+    header = next(records, None)
+    if not isinstance(header, dict) or header.get("format") != "figr-export":
+        raise ExportFormatError("Not an export of this app")
+    if header.get("version", 0) > EXPORT_FORMAT_VERSION:
+        raise ExportFormatError(f"Export format version {header.get('version')} is newer than this app")
+
+    counts = {"chats": 0, "messages": 0, "important_info": 0, "summaries": 0,
+              "skipped_chats": 0, "replaced_chats": 0, "skipped_records": 0, "complete": False}
+    imported = set()  # ids of the chats inserted so far
+    batch = {"chat": [], "message": [], "important_info": [], "summary": []}
+    size = 0
+    try:
+        for record in records:
+            kind = record.get("type") if isinstance(record, dict) else None
+            if kind == "end":
+                counts["complete"] = True
+                break
+            if kind not in batch:
+                raise ExportFormatError(f"Unknown record type: {kind}")
+            batch[kind].append(record)
+            size += 1
+            if size >= batch_rows:
+                with pool.transaction() as conn:
+                    _import_batch(conn, batch, mode, imported, counts)
+                batch = {kind: [] for kind in batch}
+                size = 0
+        if size:
+            with pool.transaction() as conn:
+                _import_batch(conn, batch, mode, imported, counts)
+    except (KeyError, TypeError) as e:
+        raise ExportFormatError(f"Malformed record: {e!r}")
+    return counts
+
+
+# Commits the writes of concurrent requests together: each write runs in its own savepoint of one shared
+# transaction, so a batch costs one commit and a failing write only rolls back itself
+class GroupCommitter:
+    def __init__(self, window_ms=GROUP_COMMIT_MS, max_batch=GROUP_COMMIT_MAX_BATCH):
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.batches = 0
+        self.writes = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, write):
+        """Run write(conn) in the next batch and return its result once the batch is committed"""
+        item = {"write": write, "done": threading.Event(), "result": None, "error": None}
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True, name="group-commit")
+                self._thread.start()
+        self._queue.put(item)
+        item["done"].wait()
+        if item["error"] is not None:
+            raise item["error"]
+        return item["result"]
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                with db_transaction() as conn:
+                    for item in batch:
+                        conn.execute('SAVEPOINT turn')
+                        try:
+                            item["result"] = item["write"](conn)
+                            conn.execute('RELEASE turn')
+                        except Exception as e:
+                            conn.execute('ROLLBACK TO turn')
+                            conn.execute('RELEASE turn')
+                            item["error"] = e
+            except Exception as e:
+                for item in batch:
+                    item["error"] = item["error"] or e
+            self.batches += 1
+            self.writes += len(batch)
+            for item in batch:
+                item["done"].set()
+
+
+group_committer = GroupCommitter() if GROUP_COMMIT_MS > 0 else None
+
+
+# Changes of one chat turn, kept in memory until ChatSession.commit_turn writes them in a single transaction
+class TurnUnitOfWork:
+    def __init__(self, session):
+        self.session = session
+        self.messages = []  # (role, content, html, timestamp)
+        self.important_info = []
+        self.last_message = None
+
+    def add_message(self, role, content, html=None):
+        self.messages.append((role, content, html, now_ms()))
+        if role == "user":
+            self.last_message = content
+
+    def add_important_info(self, content):
+        self.important_info.append(content)
+
+    def commit(self):
+        self.session.commit_turn(self)
+
+
+# Changes whenever a chat's messages or important info change, whichever process wrote them (ids are never reused)
+def chat_stamp(conn, chat_id):
+    return tuple(conn.execute(
+        '''SELECT (SELECT MAX(id) FROM messages WHERE chat_id = ?),
+                  (SELECT MAX(id) FROM important_info WHERE chat_id = ?),
+                  (SELECT SUM(hits) FROM important_info WHERE chat_id = ?)''',
+        (chat_id, chat_id, chat_id)
+    ).fetchone())
+
+
+# Deletes the stored history (messages, summary and archive) and/or important info of a chat.
+# Archived messages are part of the history too, or opening the chat would restore them.
+def clear_chat_data(conn, chat_id, history=True, important_info=True):
+    if history:
+        conn.execute('DELETE FROM messages WHERE chat_id = ?', (chat_id,))
+        conn.execute('DELETE FROM chat_summaries WHERE chat_id = ?', (chat_id,))
+        conn.execute('DELETE FROM archived_chats WHERE chat_id = ?', (chat_id,))
+        conn.execute('UPDATE chats SET archived_at = NULL WHERE id = ?', (chat_id,))
+    if important_info:
+        conn.execute('DELETE FROM important_info WHERE chat_id = ?', (chat_id,))
+
+
+# Defines a custom class to manage a chat session by initialising it and loading previous chat from the db which is initialised earlier.
+class ChatSession:
+    def __init__(self, session_id, strategy=MEMORY_STRATEGY, token_budget=MEMORY_TOKEN_BUDGET):
+        self.session_id = session_id
+        self.memory = BudgetedMemory(strategy, token_budget)
+        self.summarized_upto = 0
+        self.info = ImportantInfoStore()
+        self.llm_context = None  # {"model": ..., "tokens": [...]} returned by the last generated turn
+        restore_archived_chat(session_id)
+        # Taken before loading, so a write that lands meanwhile makes the next lookup reload
+        with get_db_connection() as conn:
+            self.stamp = chat_stamp(conn, session_id)
+        self._load_summary()
+        self._load_chat_history()
+        self._load_important_info()
+
+    @property
+    def important_info(self):
+        """Deduplicated important info, highest ranked first"""
+        return self.info.ranked()
+
+    @property
+    def prompt_important_info(self):
+        """The top ranked important info entries that go into the prompt"""
+        return self.info.prompt_entries()
+
+    @property
+    def has_history(self):
+        """Whether earlier turns of the chat go into the prompt"""
+        return bool(self.memory.messages or self.memory.summary)
+
+    @property
+    def chat_history(self):
+        return [
+            {"role": message["role"], "content": message["content"]}
+            for message in self.memory.messages
+        ]
+
+    def _load_summary(self):
+        """Load the rolling summary so only the messages after it are replayed"""
+        if self.memory.strategy == 'buffer':
+            return
+        with get_db_connection() as conn:
+            row = conn.execute(
+                'SELECT summary, summarized_upto FROM chat_summaries WHERE chat_id = ?',
+                (self.session_id,)
+            ).fetchone()
+        if row:
+            self.memory.summary = row['summary'] or ""
+            self.summarized_upto = row['summarized_upto'] or 0
+
+    def _load_chat_history(self):
+        """Load chat history from database"""
+        with get_db_connection() as conn:
+            messages = conn.execute(
+                'SELECT id, role, content FROM messages WHERE chat_id = ? AND id > ? ORDER BY id',
+                (self.session_id, self.summarized_upto)
+            ).fetchall()
+
+        # Not compacted here: summarizing asks the LLM, so it is left to the next chat turn on the scheduler
+        for msg in messages:
+            self.memory.add_message(msg['id'], msg['role'], msg['content'])
+                    
+    # Function to load the important info given my model in earlier responses
+    def _load_important_info(self):
+        """Load important info from database"""
+        with get_db_connection() as conn:
+            info = conn.execute(
+                '''SELECT i.content, i.hits, COALESCE(i.last_seen, c.updated_at, 0) AS last_seen
+                   FROM important_info i LEFT JOIN chats c ON c.id = i.chat_id
+                   WHERE i.chat_id = ? ORDER BY i.id''',
+                (self.session_id,)
+            ).fetchall()
+        # Rows not compacted yet may still repeat each other
+        for row in info:
+            self.info.add(row['content'], hits=row['hits'], last_seen=row['last_seen'])
+
+    def add_message(self, role, content, html=None):
+        """Store a message; assistant messages pass their rendered HTML along with the raw text"""
+        timestamp = now_ms()
+
+        # Store in database
+        with get_db_connection() as conn:
+            cursor = conn.execute(
+                'INSERT INTO messages (chat_id, role, content, timestamp, html, render_version) VALUES (?, ?, ?, ?, ?, ?)',
+                (self.session_id, role, content, timestamp, html, RENDERER_VERSION)
+            )
+            conn.commit()
+
+        # Update memory
+        self.memory.add_message(cursor.lastrowid, role, content)
+
+    def begin_turn(self):
+        """Start buffering the writes of a chat turn"""
+        return TurnUnitOfWork(self)
+
+    def commit_turn(self, turn):
+        """Write the messages, important info and chat metadata of a turn atomically, then update memory"""
+        seen = now_ms()
+
+        def write(conn):
+            before = chat_stamp(conn, self.session_id)
+            message_ids = []
+            for role, content, html, timestamp in turn.messages:
+                cursor = conn.execute(
+                    'INSERT INTO messages (chat_id, role, content, timestamp, html, render_version) VALUES (?, ?, ?, ?, ?, ?)',
+                    (self.session_id, role, content, timestamp, html, RENDERER_VERSION)
+                )
+                message_ids.append(cursor.lastrowid)
+            for content in turn.important_info:
+                store_important_info(conn, self.session_id, content, seen)
+            if turn.last_message is not None:
+                update_chat_metadata(self.session_id, turn.last_message)
+            return message_ids, before, chat_stamp(conn, self.session_id)
+
+        if group_committer is not None:
+            message_ids, before, after = group_committer.submit(write)
+        else:
+            with db_transaction() as conn:
+                message_ids, before, after = write(conn)
+        self._restamp(before, after)
+
+        for message_id, (role, content, _, _) in zip(message_ids, turn.messages):
+            self.memory.add_message(message_id, role, content)
+        for content in turn.important_info:
+            self.info.add(content, last_seen=seen)
+
+    # Called outside of db transactions as summarizing asks the LLM
+    def compact_memory(self):
+        """Fold the messages that no longer fit the token budget into the rolling summary"""
+        evicted = self.memory.evict_over_budget()
+        if not evicted:
+            return
+
+        if self.memory.strategy == 'summary':
+            try:
+                # Summarize in budget sized batches so a long backlog never overflows the model context
+                batch, batch_tokens = [], 0
+                for message in evicted:
+                    if batch and batch_tokens + message["tokens"] > self.memory.token_budget:
+                        self.memory.summary = summarize_conversation(self.memory.summary, batch, self.memory.token_budget)
+                        batch, batch_tokens = [], 0
+                    batch.append(message)
+                    batch_tokens += message["tokens"]
+                self.memory.summary = summarize_conversation(self.memory.summary, batch, self.memory.token_budget)
+            except Exception:
+                # Keep the messages in the window and try again on the next turn
+                self.memory.restore(evicted)
+                return
+
+        self.summarized_upto = evicted[-1]["id"]
+        with get_db_connection() as conn:
+            conn.execute(
+                '''INSERT INTO chat_summaries (chat_id, summary, summarized_upto) VALUES (?, ?, ?)
+                   ON CONFLICT(chat_id) DO UPDATE SET summary = excluded.summary,
+                   summarized_upto = excluded.summarized_upto''',
+                (self.session_id, self.memory.summary, self.summarized_upto)
+            )
+            conn.commit()
+
+    # Adds the important info of current response
+    def add_important_info(self, content):
+        """Add important information to database"""
+        seen = now_ms()
+        with db_transaction() as conn:
+            before = chat_stamp(conn, self.session_id)
+            store_important_info(conn, self.session_id, content, seen)
+            after = chat_stamp(conn, self.session_id)
+        self.info.add(content, last_seen=seen)
+        self._restamp(before, after)
+
+    def _restamp(self, before, after):
+        # The session stays current only if no other process wrote to the chat since it was loaded;
+        # otherwise the cache reloads it on the next lookup
+        self.stamp = after if before == self.stamp else None
+
+    def get_memory_variables(self):
+        return self.memory.load_memory_variables({})
+
+    def reusable_llm_context(self, model, user_input):
+        """The context of the previous turn if the next one can continue from it, else None"""
+        context = self.llm_context
+        if not LLM_CONTEXT_REUSE or context is None or context["model"] != model:
+            return None
+        new_tokens = estimate_tokens(followup_prompt.format(user_request=user_input)) + LLM_REPLY_TOKENS
+        if len(context["tokens"]) + new_tokens > LLM_CONTEXT_TOKENS:
+            return None
+        return context["tokens"]
+
+    # Function to clear all memory
+    def clear_memory(self):
+        """Clear all memory from database"""
+        with db_transaction() as conn:
+            clear_chat_data(conn, self.session_id)
+            self.stamp = chat_stamp(conn, self.session_id)
+
+        self.memory.clear()
+        self.summarized_upto = 0
+        self.info.clear()
+        self.llm_context = None
+
+    def clear_chat_history(self):
+        """Clear chat history from database"""
+        with db_transaction() as conn:
+            before = chat_stamp(conn, self.session_id)
+            clear_chat_data(conn, self.session_id, important_info=False)
+            after = chat_stamp(conn, self.session_id)
+
+        self.memory.clear()
+        self.summarized_upto = 0
+        self.llm_context = None
+        self._restamp(before, after)
+
+    def clear_important_info(self):
+        """Clear important info from database"""
+        with db_transaction() as conn:
+            before = chat_stamp(conn, self.session_id)
+            clear_chat_data(conn, self.session_id, history=False)
+            after = chat_stamp(conn, self.session_id)
+
+        self.info.clear()
+        self.llm_context = None
+        self._restamp(before, after)
+
+
+# Keeps recently used chat sessions in memory so a turn doesn't replay the whole chat from the db.
+# Sessions write through to the db, so dropping one from the cache never loses data.
+class SessionCache:
+    def __init__(self, max_size=SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._sessions = OrderedDict()  # session_id -> (ChatSession, last used)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, session_id):
+        """Return the cached session or load it from the database"""
+        session = self._lookup(session_id)
+        if session is not None:
+            # Other server processes write to the same chats: a session they changed is loaded again
+            with get_db_connection() as conn:
+                current = chat_stamp(conn, session_id)
+            if session.stamp == current:
+                self.hits += 1
+                return session
+            self.invalidate(session_id)
+        self.misses += 1
+
+        # Load outside the lock so a long chat doesn't stall other sessions
+        with span("session_load"):
+            loaded = ChatSession(session_id)
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            session = entry[0] if entry is not None else loaded
+            self._sessions[session_id] = (session, time.monotonic())
+            self._sessions.move_to_end(session_id)
+            self._evict()
+        return session
+
+    def _lookup(self, session_id):
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            now = time.monotonic()
+            if now - entry[1] > self.ttl:
+                del self._sessions[session_id]
+                return None
+            self._sessions[session_id] = (entry[0], now)
+            self._sessions.move_to_end(session_id)
+            return entry[0]
+
+    def _evict(self):
+        """Drop idle sessions and then the least recently used ones above the size limit"""
+        now = time.monotonic()
+        while self._sessions:
+            oldest_id, (_, last_used) = next(iter(self._sessions.items()))
+            if len(self._sessions) <= self.max_size and now - last_used <= self.ttl:
+                break
+            del self._sessions[oldest_id]
+
+    def invalidate(self, session_id):
+        """Forget a session so the next request reloads it from the database"""
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+
+
+session_cache = SessionCache()
+
+
+# Custom designed prompt template to achieve best results
+# The fixed role and guidelines come first and the per turn parts last, so every prompt starts with the same
+# prefix the model server can keep evaluated
+prompt_template = """
+Role: You are Figr Code Assistant, specializing in providing clear, error-free Python code solutions.
+
+Output Guidelines:
+1. Code Format:
+   - Use ```python for code blocks
+   - Use `code` for inline code references
+   - Provide raw text without HTML formatting
+   - Strictly include explanation only after code blocks
+
+2. Code Organization:
+   - Default to single, focused code snippets for clarity
+   - Only split into multiple snippets(each individually runnable) if:
+     a) Multiple distinct concepts are requested
+     b) Complex functionality requires modular explanation
+     
+   - Mark critical information with [IMPORTANT] prefix and give small explanations with some bold headings if required and in white font always.
+
+Context:
+{important_info}
+
+Previous Conversation:
+{chat_history}
+
+Current Request:
+{user_request}
+"""
+
+# A follow-up turn on a reused context: the role, guidelines and earlier turns are already in it
+followup_prompt = """
+Current Request:
+{user_request}
+"""
+
+
+# Prompt used to fold older turns into the rolling conversation summary
+summary_prompt_template = """
+Summarize the conversation between a user and Figr Code Assistant so it can be continued later.
+
+Existing summary:
+{summary}
+
+New conversation lines:
+{conversation}
+
+Write an updated summary of at most {max_words} words. Keep the user's goals, decisions, names of
+functions and variables, and any open questions. Return only the summary text.
+"""
+
+
+def summarize_conversation(previous_summary, messages, token_budget=MEMORY_TOKEN_BUDGET):
+    """Fold a batch of evicted messages into the rolling summary"""
+    conversation = "\n".join(
+        f"{'User' if message['role'] == 'user' else 'Assistant'}: {message['content']}"
+        for message in messages
+    )
+    summary_prompt = summary_prompt_template.format(
+        summary=previous_summary or "None",
+        conversation=conversation,
+        max_words=max(token_budget // 4, 50)
+    )
+    return llm_predict(summary_prompt, "summary").strip()
+
+
+class LLMBackendError(Exception):
+    pass
+
+
+# Client for the Ollama HTTP API. Requests share one session, so connections to the server are kept alive
+# and reused, and each model has its own limit on the generations sent to it at once.
+class OllamaBackend:
+    def __init__(self, base_url=OLLAMA_URL, keep_alive=OLLAMA_KEEP_ALIVE, timeout=OLLAMA_TIMEOUT,
+                 concurrency=None, default_concurrency=LLM_CONCURRENCY):
+        self.base_url = base_url.rstrip('/')
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        self.concurrency = dict(MODEL_CONCURRENCY if concurrency is None else concurrency)
+        self.default_concurrency = default_concurrency
+        self._limits = {}
+        self._lock = threading.Lock()
+        self._session = None
+
+    @property
+    def session(self):
+        """The pooled HTTP session, created (and requests imported) on first use"""
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    import requests
+                    session = requests.Session()
+                    pool_size = max([self.default_concurrency, *self.concurrency.values()]) * len(set(MODEL_ROUTES.values())) + 2
+                    adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    self._session = session
+        return self._session
+
+    def limit(self, model):
+        with self._lock:
+            if model not in self._limits:
+                self._limits[model] = threading.BoundedSemaphore(self.concurrency.get(model, self.default_concurrency))
+            return self._limits[model]
+
+    def _post(self, path, payload, stream=False):
+        import requests
+        try:
+            response = self.session.post(f"{self.base_url}{path}", json=payload, stream=stream, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise LLMBackendError(f"Ollama is not reachable at {self.base_url}: {e}") from e
+        if response.status_code != 200:
+            message = response.text[:200]
+            response.close()
+            raise LLMBackendError(f"Ollama answered {response.status_code}: {message}")
+        return response
+
+    def stream(self, prompt, model=DEFAULT_MODEL, context=None, on_done=None):
+        """Yield the generated text as Ollama streams it; on_done gets the final line with the
+        timings and the context to continue from"""
+        payload = {"model": model, "prompt": prompt, "stream": True, "keep_alive": self.keep_alive}
+        if context is not None:
+            payload["context"] = context
+        with self.limit(model):
+            response = self._post('/api/generate', payload, stream=True)
+            try:
+                # Read to the end of the body, even past the done line, so the connection goes back to the pool
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    chunk = json.loads(line)
+                    if chunk.get("error"):
+                        raise LLMBackendError(chunk["error"])
+                    if chunk.get("response"):
+                        yield chunk["response"]
+                    if chunk.get("done") and on_done is not None:
+                        on_done(chunk)
+            finally:
+                response.close()
+
+    def predict(self, prompt, model=DEFAULT_MODEL, on_done=None):
+        return "".join(self.stream(prompt, model, on_done=on_done))
+
+    def warmup(self, model):
+        """Load a model into memory without generating anything"""
+        self._post('/api/generate', {"model": model, "keep_alive": self.keep_alive}).close()
+
+
+llm = OllamaBackend()
+
+
+def warm_models():
+    """Load every routed model in the background so the first requests don't wait for a cold load"""
+    def warm():
+        # A session of its own, so no pooled connection is inherited by forked server workers
+        backend = OllamaBackend()
+        for model in dict.fromkeys(MODEL_ROUTES.values()):
+            try:
+                backend.warmup(model)
+            except LLMBackendError as e:
+                print(f"Could not warm up {model}: {e}", file=sys.stderr)
+        backend.session.close()
+    thread = threading.Thread(target=warm, daemon=True, name="model-warmup")
+    thread.start()
+    return thread
+
+
+# Seconds spent in each startup phase: import, prewarm, and ready (from the start of the import to serving)
+startup_timings = {}
+
+
+def prewarm():
+    """Load what is otherwise set up lazily (the HTTP session) before the first request needs it"""
+    started = time.perf_counter()
+    llm.session  # no connection is opened yet, so forked server workers don't share one
+    startup_timings["prewarm"] = time.perf_counter() - started
+
+
+# Records the prompt evaluation (prefill) time and tokens Ollama reports at the end of a generation
+def prefill_recorder(kind, model, callback=None):
+    def done(stats):
+        if stats.get("prompt_eval_duration") is not None:
+            record_span("llm_prefill", stats["prompt_eval_duration"] / 1e9)
+        llm_prefill_tokens.inc(kind, model, amount=stats.get("prompt_eval_count", 0))
+        if callback is not None:
+            callback(stats)
+    return done
+
+
+# LLM calls go through these two so generation time and token counts are recorded per kind of call,
+# and so every kind of call goes to the model MODEL_ROUTES picks for it
+def llm_predict(text, kind):
+    model = MODEL_ROUTES.get(kind, DEFAULT_MODEL)
+    llm_calls.inc(kind, model)
+    llm_prompt_tokens.inc(kind, model, amount=estimate_tokens(text))
+    with span(f"llm_{kind}"):
+        result = llm.predict(text, model=model, on_done=prefill_recorder(kind, model))
+    llm_completion_tokens.inc(kind, model, amount=estimate_tokens(result))
+    return result
+
+
+def llm_stream(text, kind, context=None, on_done=None):
+    model = MODEL_ROUTES.get(kind, DEFAULT_MODEL)
+    llm_calls.inc(kind, model)
+    llm_prompt_tokens.inc(kind, model, amount=estimate_tokens(text))
+    chunks = 0
+    started = time.perf_counter()
+    try:
+        for chunk in llm.stream(text, model=model, context=context, on_done=prefill_recorder(kind, model, on_done)):
+            chunks += 1
+            yield chunk
+    finally:
+        # Each streamed chunk is one generated token
+        llm_completion_tokens.inc(kind, model, amount=chunks)
+        record_span(f"llm_{kind}", time.perf_counter() - started)
+
+
+# Small thread-safe LRU cache with optional expiry, keyed by content hash
+class LRUCache:
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (value, stored at)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[1] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get_or_compute(self, key, compute):
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.set(key, value)
+        return value
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def content_hash(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+render_cache = LRUCache(RENDER_CACHE_SIZE)
+
+
+# Words that don't change what a coding question asks for
+FILLER_WORDS = {
+    'a', 'an', 'the', 'please', 'can', 'could', 'would', 'you', 'i', 'me', 'my', 'how', 'do', 'does',
+    'to', 'some', 'in', 'python', 'help', 'want', 'need', 'is', 'what'
+}
+
+
+# Lower case, drop punctuation and filler words so rephrasings of a question share a key
+def normalize_question(text):
+    words = re.findall(r"[a-z0-9_]+", text.lower())
+    kept = [word for word in words if word not in FILLER_WORDS]
+    return " ".join(kept or words)
+
+
+# Local embedding of a normalized question: l2 normalized counts of its character trigrams.
+# Numbers change the answer while barely moving the vector, so they are returned separately.
+def question_embedding(normalized):
+    return trigram_vector(normalized), frozenset(re.findall(r"[0-9]+", normalized))
+
+
+def trigram_vector(normalized):
+    padded = f"  {normalized} "
+    counts = {}
+    for i in range(len(padded) - 2):
+        trigram = padded[i:i + 3]
+        counts[trigram] = counts.get(trigram, 0) + 1
+    norm = sum(count * count for count in counts.values()) ** 0.5 or 1.0
+    return {trigram: count / norm for trigram, count in counts.items()}
+
+
+def cosine_similarity(left, right):
+    if len(left) > len(right):
+        left, right = right, left
+    return sum(weight * right.get(trigram, 0.0) for trigram, weight in left.items())
+
+
+# Raw LLM responses keyed by normalized question and important info, persisted in a sqlite file next to
+# the chat database. Exact matches are a dictionary lookup; with a threshold below 1.0 the closest stored
+# question with the same important info is reused when it is similar enough.
+class ResponseCache:
+    def __init__(self, path, max_size=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL,
+                 threshold=RESPONSE_CACHE_SIMILARITY):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.threshold = threshold
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (info hash, embedding, stored at ms), least recent first
+        self._by_info = {}  # info hash -> keys
+        self._lock = threading.Lock()
+        self.path = path
+        self._conn = None
+        self._pid = None
+        self._inherited = []
+        self._db.execute('''
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                info_hash TEXT NOT NULL,
+                question TEXT NOT NULL,
+                response TEXT NOT NULL,
+                created_at INTEGER NOT NULL,
+                last_used INTEGER NOT NULL
+            )
+        ''')
+        self._db.execute('CREATE INDEX IF NOT EXISTS idx_responses_last_used ON responses(last_used)')
+        self._load()
+
+    @property
+    def _db(self):
+        """The backing store connection of this process, opened again after a fork"""
+        if self._conn is None or self._pid != os.getpid():
+            if self._conn is not None:
+                self._inherited.append(self._conn)  # the parent's, never used or closed here
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._pid = os.getpid()
+        return self._conn
+
+    def close(self):
+        """Close the backing store connection; the next lookup opens a new one"""
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.close()
+            self._conn = None
+
+    @staticmethod
+    def key_for(question, info_hash):
+        return content_hash(normalize_question(question), info_hash)
+
+    def _load(self):
+        """Index the most recently used unexpired entries of the backing store"""
+        self._db.execute('DELETE FROM responses WHERE created_at < ?', (now_ms() - int(self.ttl * 1000),))
+        rows = self._db.execute(
+            'SELECT key, info_hash, question, created_at FROM responses ORDER BY last_used DESC LIMIT ?',
+            (self.max_size,)
+        ).fetchall()
+        for key, info_hash, question, created_at in reversed(rows):
+            self._index(key, info_hash, question, created_at)
+
+    def _index(self, key, info_hash, question, created_at):
+        self._entries[key] = (info_hash, question_embedding(question), created_at)
+        self._entries.move_to_end(key)
+        self._by_info.setdefault(info_hash, set()).add(key)
+
+    def _forget(self, key):
+        info_hash = self._entries.pop(key)[0]
+        keys = self._by_info[info_hash]
+        keys.discard(key)
+        if not keys:
+            del self._by_info[info_hash]
+        self._db.execute('DELETE FROM responses WHERE key = ?', (key,))
+
+    def _expired(self, key):
+        return now_ms() - self._entries[key][2] > self.ttl * 1000
+
+    def _closest(self, question, info_hash):
+        vector, numbers = question_embedding(normalize_question(question))
+        best_key, best_score = None, self.threshold
+        for key in self._by_info.get(info_hash, ()):
+            other_vector, other_numbers = self._entries[key][1]
+            if numbers != other_numbers:
+                continue
+            score = cosine_similarity(vector, other_vector)
+            if score >= best_score:
+                best_key, best_score = key, score
+        return best_key
+
+    def get(self, question, info_hash):
+        """Cached response for the question, or None"""
+        key = self.key_for(question, info_hash)
+        with self._lock:
+            similar = False
+            if key not in self._entries and self.threshold < 1.0:
+                key, similar = self._closest(question, info_hash), True
+            if key is not None and key in self._entries and self._expired(key):
+                self._forget(key)
+                key = None
+            if key is None or key not in self._entries:
+                self.misses += 1
+                return None
+
+            row = self._db.execute('SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self._forget(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._db.execute('UPDATE responses SET last_used = ? WHERE key = ?', (now_ms(), key))
+            self.hits += 1
+            if similar:
+                self.similar_hits += 1
+            return row[0]
+
+    def set(self, question, info_hash, response):
+        key = self.key_for(question, info_hash)
+        normalized = normalize_question(question)
+        created_at = now_ms()
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO responses (key, info_hash, question, response, created_at, last_used) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (key, info_hash, normalized, response, created_at, created_at)
+            )
+            self._index(key, info_hash, normalized, created_at)
+            while len(self._entries) > self.max_size:
+                self._forget(next(iter(self._entries)))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "similar_hits": self.similar_hits,
+                "misses": self.misses
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_info.clear()
+            self._db.execute('DELETE FROM responses')
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_PATH)
+
+
+# Code block markup with the copy code and test code buttons used by the interface
+def code_block_html(code, language=''):
+    # Newlines are written as entities so a blank line in the code doesn't end the HTML block
+    # when the browser runs marked over the stored HTML
+    code = escape(code, quote=False).replace('\n', '&#10;')
+    return (
+        '<div class="code-block-wrapper">\n'
+        '<button class="test-button">Test Code</button>\n'
+        '<button class="copy-button">Copy Code</button>\n'
+        f'<pre><code class="hljs {language}">{code}</code></pre>\n'
+        '<div class="test-results"></div>\n'
+        '</div>'
+    )
+
+
+FENCED_CODE_PATTERN = re.compile(r'^[ \t]*```[ \t]*([\w+#.-]*)[^\n]*\n(.*?)^[ \t]*```[ \t]*$', re.DOTALL | re.MULTILINE)
+HEADING_PATTERN = re.compile(r'(#{1,6})\s+(.*?)\s*#*$')
+LIST_ITEM_PATTERN = re.compile(r'([-*+]|\d+[.)])\s+(.*)')
+RULE_PATTERN = re.compile(r'(?:(?:\*\s*){3,}|(?:-\s*){3,}|(?:_\s*){3,})')
+
+
+def _render_inline(text):
+    """Inline markdown: code spans, bold, italics and links"""
+    parts = re.split(r'(`[^`\n]+`)', text)
+    rendered = []
+    for part in parts:
+        if len(part) > 1 and part.startswith('`') and part.endswith('`'):
+            rendered.append(f'<code class="inline-code">{escape(part[1:-1], quote=False)}</code>')
+            continue
+        part = escape(part, quote=False)
+        part = re.sub(r'\*\*(.+?)\*\*|__(.+?)__', lambda m: f'<strong>{m.group(1) or m.group(2)}</strong>', part)
+        part = re.sub(r'(?<![\w*])\*(?![\s*])(.+?)(?<![\s*])\*(?![\w*])', r'<em>\1</em>', part)
+        # Quotes and angle brackets end the URL, so it can't close the href attribute
+        part = re.sub(r'\[([^\]]+)\]\((https?://[^)\s"\'<>]+)\)', r'<a href="\2">\1</a>', part)
+        rendered.append(part)
+    return ''.join(rendered)
+
+
+def _render_blocks(text):
+    """Block markdown: headings, lists, quotes, rules and paragraphs"""
+    blocks = []
+    paragraph, quote, items = [], [], []
+    list_tag = None
+
+    def flush():
+        nonlocal list_tag
+        if paragraph:
+            blocks.append(f'<p>{_render_inline(" ".join(paragraph))}</p>')
+            paragraph.clear()
+        if quote:
+            blocks.append(f'<blockquote><p>{_render_inline(" ".join(quote))}</p></blockquote>')
+            quote.clear()
+        if items:
+            rendered_items = ''.join(f'<li>{_render_inline(item)}</li>' for item in items)
+            blocks.append(f'<{list_tag}>{rendered_items}</{list_tag}>')
+            items.clear()
+            list_tag = None
+
+    for line in text.split('\n'):
+        stripped = line.strip()
+        if not stripped:
+            flush()
+            continue
+
+        heading = HEADING_PATTERN.fullmatch(stripped)
+        if heading:
+            flush()
+            level = len(heading.group(1))
+            blocks.append(f'<h{level}>{_render_inline(heading.group(2))}</h{level}>')
+            continue
+
+        if RULE_PATTERN.fullmatch(stripped):
+            flush()
+            blocks.append('<hr />')
+            continue
+
+        item = LIST_ITEM_PATTERN.fullmatch(stripped)
+        if item:
+            tag = 'ul' if item.group(1) in '-*+' else 'ol'
+            if tag != list_tag or paragraph or quote:
+                flush()
+                list_tag = tag
+            items.append(item.group(2))
+            continue
+
+        if stripped.startswith('>'):
+            if paragraph or items:
+                flush()
+            quote.append(stripped.lstrip('>').strip())
+            continue
+
+        # Indented lines continue the current list item
+        if items and line[:1].isspace():
+            items[-1] += ' ' + stripped
+            continue
+
+        if items or quote:
+            flush()
+        paragraph.append(stripped)
+
+    flush()
+    return '\n'.join(blocks)
+
+
+def render_markdown(raw_text):
+    """Render markdown to HTML, wrapping fenced code blocks with the copy and test buttons"""
+    html_parts = []
+    position = 0
+    for match in FENCED_CODE_PATTERN.finditer(raw_text):
+        html_parts.append(_render_blocks(raw_text[position:match.start()]))
+        html_parts.append(code_block_html(match.group(2).rstrip('\n'), match.group(1)))
+        position = match.end()
+    html_parts.append(_render_blocks(raw_text[position:]))
+    return '\n'.join(part for part in html_parts if part)
+
+
+# Converts raw text to HTML markdown and segregates code blocks to place copy code and test code buttons.
+# This used to fork pandoc for every call, now it is rendered in process and cached by content hash.
+def convert_to_html(raw_text):
+    """Convert markdown to HTML while preserving code blocks with custom buttons"""
+    return render_cache.get_or_compute(
+        content_hash('html', raw_text),
+        lambda: render_markdown(raw_text)
+    )
+
+
+# To allow only .py files in the upload
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+
+def extract_important_info(response):
+    important_items = []
+    for line in response.split('\n'):
+        if '[IMPORTANT]' in line:
+            important_items.append(line.replace('[IMPORTANT]', '').strip())
+    return important_items
+
+# To create new chat in the left panel
+def create_new_chat(session_id: str):
+    """Create a new chat session with metadata in database"""
+    date = now_ms()
+    with get_db_connection() as conn:
+        conn.execute(
+            'INSERT INTO chats (id, title, date, last_message, updated_at) VALUES (?, ?, ?, ?, ?)',
+            (session_id, "New Chat", date, None, date)
+        )
+        conn.commit()
+
+    return {
+        "id": session_id,
+        "title": "New Chat",
+        "date": ms_to_iso(date),
+        "last_message": None
+    }
+
+
+def update_chat_metadata(session_id: str, last_message: str):
+    """Update chat metadata in database"""
+    title = last_message[:30] + "..." if len(last_message) > 30 else last_message
+    with get_db_connection() as conn:
+        conn.execute(
+            'UPDATE chats SET title = ?, last_message = ?, updated_at = ? WHERE id = ?',
+            (title, last_message, now_ms(), session_id)
+        )
+        conn.commit()
+
+# Function to structure the code snippets into specific blocks of code
+def format_response(response):
+    """Format response with proper code block structure"""
+    return convert_to_html(response)
+
+
+# HTML stored for a message; user messages are displayed as typed
+def render_message(role, content):
+    return format_response(content) if role == 'assistant' else None
+
+
+# Builds the prompt inputs for the current turn from the session memory
+def build_chat_inputs(session, user_input):
+    """Collect the prompt variables for a chat turn"""
+    memory_vars = session.get_memory_variables()
+    return {
+        "user_request": user_input,
+        "chat_history": memory_vars.get("chat_history", ""),
+        "important_info": "\n".join(session.prompt_important_info)
+    }
+
+
+# Stores the important info and the raw and formatted assistant reply once the response is complete,
+# committing them together with the rest of the turn
+def finish_chat_turn(raw_response, turn):
+    """Extract important info, format the assistant response and commit the turn"""
+    with span("extract_important_info"):
+        new_important_info = extract_important_info(raw_response)
+    with span("format_response"):
+        formatted_response = format_response(raw_response)
+
+    for info in new_important_info:
+        turn.add_important_info(info)
+    turn.add_message("assistant", raw_response, html=formatted_response)
+    with span("db_write"):
+        turn.commit()
+    # The memory is compacted at the start of the next turn, so summarizing never holds up this reply
+    return formatted_response
+
+
+# Program run by the sandbox processes. A worker reads length prefixed JSON requests from the parent,
+# runs the code like `python file.py` would and sends the result back. The snippet's own stdout and
+# stderr file descriptors point at scratch files so nothing it prints can corrupt the protocol.
+# In zygote mode the program stays booted and forks a fresh worker whenever the parent asks for one.
+SANDBOX_WORKER_SOURCE = r"""
+import json, linecache, os, signal, socket, struct, sys, tempfile, traceback
+try:
+    import resource
+except ImportError:
+    resource = None
+
+cpu_seconds, memory_bytes, max_files, max_output = (int(arg) for arg in sys.argv[1:5])
+
+
+def worker_loop(request_fd, reply_fd):
+    requests_in = os.fdopen(os.dup(request_fd), 'rb')
+    replies_out = os.fdopen(os.dup(reply_fd), 'wb')
+    stdout_file = tempfile.TemporaryFile()
+    stderr_file = tempfile.TemporaryFile()
+    for fd in {request_fd, reply_fd} - {0, 1}:
+        os.close(fd)
+    os.dup2(os.open(os.devnull, os.O_RDONLY), 0)
+    os.dup2(stdout_file.fileno(), 1)
+    os.dup2(stderr_file.fileno(), 2)
+
+    if resource is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_bytes, memory_bytes))
+        resource.setrlimit(resource.RLIMIT_NOFILE, (max_files, max_files))
+
+    def read_message():
+        header = requests_in.read(4)
+        if len(header) < 4:
+            return None
+        return json.loads(requests_in.read(struct.unpack('>I', header)[0]))
+
+    def send_message(payload):
+        data = json.dumps(payload).encode('utf-8')
+        replies_out.write(struct.pack('>I', len(data)) + data)
+        replies_out.flush()
+
+    def captured(stream_file):
+        stream_file.seek(0)
+        data = stream_file.read(max_output + 1)
+        stream_file.seek(0)
+        stream_file.truncate()
+        text = data[:max_output].decode('utf-8', 'replace')
+        return text + '\n... output truncated' if len(data) > max_output else text
+
+    while True:
+        request = read_message()
+        if request is None:
+            break
+        code = request['code']
+
+        if resource is not None:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            used = int(usage.ru_utime + usage.ru_stime) + 1
+            resource.setrlimit(resource.RLIMIT_CPU, (used + cpu_seconds, resource.RLIM_INFINITY))
+
+        linecache.cache['<snippet>'] = (len(code), None, code.splitlines(True), '<snippet>')
+        returncode = 0
+        try:
+            exec(compile(code, '<snippet>', 'exec'), {'__name__': '__main__', '__builtins__': __builtins__})
+        except SystemExit as exc:
+            if isinstance(exc.code, int) or exc.code is None:
+                returncode = exc.code or 0
+            else:
+                print(exc.code, file=sys.__stderr__)
+                returncode = 1
+        except BaseException:
+            exc_type, exc_value, exc_tb = sys.exc_info()
+            traceback.print_exception(exc_type, exc_value, exc_tb.tb_next, file=sys.__stderr__)
+            returncode = 1
+
+        for stream in (sys.stdout, sys.stderr, sys.__stdout__, sys.__stderr__):
+            try:
+                stream.flush()
+            except Exception:
+                pass
+        send_message({'returncode': returncode, 'stdout': captured(stdout_file), 'stderr': captured(stderr_file)})
+
+
+def zygote_loop(control):
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)  # forked workers are reaped automatically
+    while True:
+        try:
+            message, fds, _, _ = socket.recv_fds(control, 4096, 2)
+        except OSError:
+            break
+        if not message:
+            break
+        pid = os.fork()
+        if pid == 0:
+            # Restored so the code run in the worker gets the exit status of its own subprocesses
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            control.close()
+            os.setsid()
+            os.chdir(message.decode('utf-8'))
+            try:
+                worker_loop(fds[0], fds[1])
+            finally:
+                os._exit(0)
+        for fd in fds:
+            os.close(fd)
+        control.sendall(struct.pack('>I', pid))
+
+
+if sys.argv[5] == 'zygote':
+    zygote_loop(socket.socket(fileno=int(sys.argv[6])))
+else:
+    worker_loop(0, 1)
+"""
+
+SANDBOX_LIMIT_ARGS = [str(SANDBOX_TIMEOUT), str(SANDBOX_MEMORY_MB * 1024 * 1024), str(SANDBOX_MAX_FILES), str(SANDBOX_MAX_OUTPUT)]
+
+# Forking from a booted zygote needs fork() and fd passing over unix sockets
+SANDBOX_FORK_SERVER = hasattr(os, 'fork') and hasattr(socket, 'send_fds')
+
+
+class SandboxError(Exception):
+    pass
+
+
+class SandboxBusyError(SandboxError):
+    pass
+
+
+# Booted template process that forks new sandbox workers in a few milliseconds instead of paying
+# interpreter startup for every replacement
+class SandboxZygote:
+    def __init__(self):
+        parent_socket, child_socket = socket.socketpair()
+        self.process = subprocess.Popen(
+            [sys.executable, '-c', SANDBOX_WORKER_SOURCE, *SANDBOX_LIMIT_ARGS, 'zygote', str(child_socket.fileno())],
+            pass_fds=[child_socket.fileno()],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+        child_socket.close()
+        self.control = parent_socket
+        self._lock = threading.Lock()
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def fork_worker(self, workdir):
+        """Return the pid and the request / reply pipes of a freshly forked worker"""
+        request_read, request_write = os.pipe()
+        reply_read, reply_write = os.pipe()
+        try:
+            with self._lock:
+                socket.send_fds(self.control, [workdir.encode('utf-8')], [request_read, reply_write])
+                pid_bytes = self.control.recv(4)
+        except OSError:
+            pid_bytes = b''
+        finally:
+            os.close(request_read)
+            os.close(reply_write)
+
+        if len(pid_bytes) < 4:
+            os.close(request_write)
+            os.close(reply_read)
+            raise SandboxError("the sandbox zygote is not running")
+        return struct.unpack('>I', pid_bytes)[0], os.fdopen(request_write, 'wb'), os.fdopen(reply_read, 'rb')
+
+    def close(self):
+        self.control.close()
+        if self.alive():
+            self.process.kill()
+        self.process.wait()
+
+
+# One warm Python process that executes snippets sent over a pipe
+class SandboxWorker:
+    def __init__(self, zygote=None):
+        self.workdir = tempfile.mkdtemp(prefix='figr-sandbox-')
+        self.runs = 0
+        self.process = None
+        try:
+            if zygote is not None:
+                self.pid, self.requests, self.replies = zygote.fork_worker(self.workdir)
+            else:
+                self.process = subprocess.Popen(
+                    [sys.executable, '-c', SANDBOX_WORKER_SOURCE, *SANDBOX_LIMIT_ARGS, 'worker'],
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.DEVNULL,
+                    cwd=self.workdir
+                )
+                self.pid, self.requests, self.replies = self.process.pid, self.process.stdin, self.process.stdout
+        except Exception:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+            raise
+
+    def alive(self):
+        if self.process is not None:
+            return self.process.poll() is None
+        try:
+            os.kill(self.pid, 0)
+            return True
+        except OSError:
+            return False
+
+    def kill(self):
+        try:
+            if self.process is not None:
+                self.process.kill()
+            else:
+                os.kill(self.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def run(self, code, timeout):
+        """Send one snippet and wait for its result, killing the worker when it runs over time"""
+        self.runs += 1
+        timed_out = threading.Event()
+
+        def kill():
+            timed_out.set()
+            self.kill()
+
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+        try:
+            payload = json.dumps({"code": code}).encode('utf-8')
+            self.requests.write(struct.pack('>I', len(payload)) + payload)
+            self.requests.flush()
+            header = self.replies.read(4)
+            if len(header) == 4:
+                return json.loads(self.replies.read(struct.unpack('>I', header)[0]))
+        except (OSError, ValueError):
+            pass
+        finally:
+            timer.cancel()
+
+        if timed_out.is_set():
+            raise SandboxError(f"timed out after {timeout} seconds")
+        raise SandboxError("the sandbox process exited unexpectedly")
+
+    def close(self):
+        self.kill()
+        if self.process is not None:
+            self.process.wait()
+        for pipe in (self.requests, self.replies):
+            try:
+                pipe.close()
+            except OSError:
+                pass
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+# Pool of warm sandbox workers so a test run never waits for interpreter startup. Workers are replaced
+# after SANDBOX_MAX_RUNS runs (every run by default, so snippets can't see each other's state), forked
+# from the zygote where the platform allows it, and callers queue for a free worker when all are busy.
+class SandboxPool:
+    def __init__(self, size=SANDBOX_WORKERS, max_runs=SANDBOX_MAX_RUNS, fork_server=SANDBOX_FORK_SERVER):
+        self.size = size
+        self.max_runs = max_runs
+        self.fork_server = fork_server
+        self._zygote = None
+        self._idle = queue.Queue()
+        self._started = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        for _ in range(self.size):
+            self._idle.put(self._new_worker())
+
+    def _new_worker(self):
+        if not self.fork_server:
+            return SandboxWorker()
+        with self._lock:
+            if self._zygote is None or not self._zygote.alive():
+                if self._zygote is not None:
+                    self._zygote.close()
+                self._zygote = SandboxZygote()
+            zygote = self._zygote
+        try:
+            return SandboxWorker(zygote)
+        except SandboxError:
+            # Fall back to a plain interpreter if the zygote went away between the check and the fork
+            return SandboxWorker()
+
+    def run(self, code, timeout=SANDBOX_TIMEOUT):
+        self.start()
+        try:
+            worker = self._idle.get(timeout=SANDBOX_QUEUE_TIMEOUT)
+        except queue.Empty:
+            raise SandboxBusyError("All sandbox workers are busy, try again shortly")
+
+        try:
+            if not worker.alive():
+                worker.close()
+                worker = self._new_worker()
+            return worker.run(code, timeout)
+        finally:
+            if worker.alive() and worker.runs < self.max_runs:
+                self._idle.put(worker)
+            else:
+                worker.close()
+                self._idle.put(self._new_worker())
+
+    def shutdown(self):
+        with self._lock:
+            self._started = False
+            zygote, self._zygote = self._zygote, None
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+        if zygote is not None:
+            zygote.close()
+
+
+sandbox_pool = SandboxPool()
+atexit.register(sandbox_pool.shutdown)
+
+
+# Modules whose functions give the same output for the same input. Snippets importing anything else, or
+# calling a builtin that reads the outside world, are run every time.
+DETERMINISTIC_MODULES = {
+    'abc', 'array', 'bisect', 'collections', 'copy', 'dataclasses', 'decimal', 'enum', 'fractions', 'functools',
+    'heapq', 'itertools', 'json', 'math', 'operator', 're', 'statistics', 'string', 'textwrap', 'typing'
+}
+NONDETERMINISTIC_CALLS = {'input', 'open', 'id', 'hash', 'eval', 'exec', 'compile', '__import__', 'breakpoint'}
+
+
+def is_deterministic(tree):
+    """Whether a parsed snippet always prints the same thing"""
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            modules = [node.module or ""] if node.level == 0 else [""]
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+            if node.func.id in NONDETERMINISTIC_CALLS or node.func.id in ('set', 'frozenset'):
+                return False
+            continue
+        elif isinstance(node, (ast.Set, ast.SetComp)):
+            # String hashing is randomized per interpreter, and so is the iteration order of sets
+            return False
+        else:
+            continue
+        if any(module.split('.')[0] not in DETERMINISTIC_MODULES for module in modules):
+            return False
+    return True
+
+
+# Syntax errors are reported the way the interpreter would, without starting a run
+def check_syntax(code):
+    """Parse a snippet; returns (tree, None) or (None, error output)"""
+    try:
+        return ast.parse(code, filename="<snippet>"), None
+    except (SyntaxError, ValueError) as e:
+        return None, "".join(traceback.format_exception_only(type(e), e))
+
+
+test_results = LRUCache(TEST_CACHE_SIZE, ttl=TEST_CACHE_TTL)
+
+
+# Runs a snippet in the sandbox and shapes the result like the interface expects it
+def run_code(code):
+    """Run code and return the success flag and its output (stdout, or stderr on failure)"""
+    with span("syntax_check"):
+        tree, syntax_error = check_syntax(code)
+    if syntax_error is not None:
+        sandbox_runs.inc("syntax_error")
+        return {"success": False, "output": syntax_error}
+
+    key = content_hash("test-code", sys.version, code) if is_deterministic(tree) else None
+    if key is not None:
+        cached = test_results.get(key)
+        if cached is not None:
+            sandbox_runs.inc("cached")
+            return dict(cached, cached=True)
+
+    try:
+        with span("sandbox_run"):
+            result = sandbox_pool.run(code)
+    except SandboxBusyError:
+        sandbox_runs.inc("busy")
+        raise
+    except SandboxError as e:
+        sandbox_runs.inc("error")
+        return {"success": False, "output": f"Error executing code: {str(e)}"}
+
+    success = result["returncode"] == 0
+    sandbox_runs.inc("success" if success else "failure")
+    response = {
+        "success": success,
+        "output": result["stdout"] if success else result["stderr"]
+    }
+    if key is not None:
+        test_results.set(key, response)
+    return response
+
+
+# Runs the snippets of a batch side by side, each distinct snippet once
+def run_code_batch(codes, parallelism=TEST_BATCH_PARALLELISM):
+    """Run several snippets; returns their results in order"""
+    distinct = list(dict.fromkeys(codes))
+    results = {}
+    pending = deque(distinct)
+    lock = threading.Lock()
+    trace = current_trace()
+
+    def worker():
+        with use_trace(trace):
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    code = pending.popleft()
+                try:
+                    result = run_code(code)
+                except SandboxBusyError as e:
+                    result = {"success": False, "output": str(e), "busy": True}
+                with lock:
+                    results[code] = result
+
+    threads = [threading.Thread(target=worker) for _ in range(min(parallelism, len(distinct)) - 1)]
+    for thread in threads:
+        thread.start()
+    worker()
+    for thread in threads:
+        thread.join()
+    return [results[code] for code in codes]
+
+
+class QueueFullError(Exception):
+    pass
+
+
+# A unit of LLM work. Tokens emitted while it runs can be polled or streamed by any number of clients.
+class LLMJob:
+    def __init__(self, session_id, work):
+        self.id = uuid.uuid4().hex
+        self.session_id = session_id
+        self.work = work
+        self.key = None
+        self.lane_limit = 1
+        self.trace = current_trace()  # spans of the job count towards the request that queued it
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.chunks = []
+        self.created_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+        self._cond = threading.Condition()
+
+    @property
+    def done(self):
+        return self.status in ("done", "error")
+
+    def emit(self, chunk):
+        with self._cond:
+            self.chunks.append(chunk)
+            self._cond.notify_all()
+
+    def run(self):
+        with self._cond:
+            self.status = "running"
+            self.started_at = time.monotonic()
+        with use_trace(self.trace):
+            record_span("llm_queue_wait", self.started_at - self.created_at)
+            try:
+                result, error, status = self.work(self), None, "done"
+            except Exception as e:
+                result, error, status = None, str(e), "error"
+        with self._cond:
+            self.result, self.error, self.status = result, error, status
+            self.finished_at = time.monotonic()
+            self._cond.notify_all()
+
+    def wait(self, timeout=None):
+        with self._cond:
+            return self._cond.wait_for(lambda: self.done, timeout)
+
+    def iter_chunks(self):
+        """Yield emitted chunks as they arrive until the job finishes"""
+        position = 0
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: position < len(self.chunks) or self.done)
+                new_chunks = self.chunks[position:]
+                finished = self.done
+            position += len(new_chunks)
+            yield from new_chunks
+            if finished and position >= len(self.chunks):
+                return
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+            "partial_response": "".join(self.chunks) if not self.done else None
+        }
+
+
+# Fronts the LLM with a bounded queue and a fixed number of generation slots. Sessions are served
+# round robin with at most one running job each (or lane_limit, for work meant to run in parallel),
+# so one busy chat can't starve the others, and identical requests submitted while the first one is
+# unfinished share its job.
+class LLMScheduler:
+    def __init__(self, concurrency=LLM_CONCURRENCY, max_queue=LLM_QUEUE_SIZE, job_ttl=LLM_JOB_TTL):
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.job_ttl = job_ttl
+        self._queues = OrderedDict()  # session_id -> deque of queued jobs, in round robin order
+        self._running = {}  # session_id -> number of running jobs
+        self._pending = 0
+        self._jobs = OrderedDict()  # job_id -> job, oldest first
+        self._inflight = {}  # coalescing key -> unfinished job
+        self._average_seconds = 5.0
+        self._cond = threading.Condition()
+        self._workers = []
+
+    def submit(self, session_id, work, key=None, lane_limit=1):
+        """Queue work(job) for the LLM, raising QueueFullError when the queue is full"""
+        with self._cond:
+            if key is not None and key in self._inflight:
+                return self._inflight[key]
+            if self._pending >= self.max_queue:
+                raise QueueFullError("The assistant is busy, please retry shortly")
+            job = LLMJob(session_id, work)
+            job.lane_limit = lane_limit
+            self._queues.setdefault(session_id, deque()).append(job)
+            self._pending += 1
+            self._jobs[job.id] = job
+            if key is not None:
+                job.key = key
+                self._inflight[key] = job
+            self._prune()
+            if len(self._workers) < self.concurrency:
+                worker = threading.Thread(target=self._worker, daemon=True, name="llm-worker")
+                self._workers.append(worker)
+                worker.start()
+            self._cond.notify_all()
+        return job
+
+    def run_inline(self, session_id, work):
+        """Run work(job) in the calling thread, for jobs that don't need the LLM"""
+        job = LLMJob(session_id, work)
+        with self._cond:
+            self._jobs[job.id] = job
+            self._prune()
+        job.run()
+        return job
+
+    def get(self, job_id):
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def retry_after(self):
+        """Seconds until a queue slot is likely to free up"""
+        with self._cond:
+            return max(1, math.ceil(self._average_seconds * self._pending / self.concurrency))
+
+    def stats(self):
+        with self._cond:
+            return {"queued": self._pending, "running": sum(self._running.values())}
+
+    def _next_job(self):
+        for session_id, jobs in list(self._queues.items()):
+            if self._running.get(session_id, 0) >= jobs[0].lane_limit:
+                continue
+            del self._queues[session_id]
+            job = jobs.popleft()
+            if jobs:
+                self._queues[session_id] = jobs  # back of the line
+            self._pending -= 1
+            self._running[session_id] = self._running.get(session_id, 0) + 1
+            return job
+        return None
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                job = self._cond.wait_for(self._next_job)
+            job.run()
+            with self._cond:
+                running = self._running.pop(job.session_id) - 1
+                if running:
+                    self._running[job.session_id] = running
+                if job.key is not None:
+                    self._inflight.pop(job.key, None)
+                self._average_seconds = 0.8 * self._average_seconds + 0.2 * (job.finished_at - job.started_at)
+                self._cond.notify_all()
+
+    def _prune(self):
+        """Forget finished jobs nobody polled within job_ttl"""
+        now = time.monotonic()
+        for job_id, job in list(self._jobs.items()):
+            if now - job.created_at <= self.job_ttl:
+                break
+            if job.done and now - job.finished_at > self.job_ttl:
+                del self._jobs[job_id]
+
+
+llm_scheduler = LLMScheduler()
+
+
+# 429 response telling the client when to come back
+def busy_response(payload, retry_after):
+    response = jsonify(payload)
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+# Streams the tokens of an LLM job as newline delimited JSON, ending with a done or error event
+def stream_job_response(job):
+    def generate():
+        yield json.dumps({"type": "queued", "job_id": job.id}) + "\n"
+        for token in job.iter_chunks():
+            yield json.dumps({"type": "token", "content": token}) + "\n"
+
+        if job.error is not None:
+            yield json.dumps({
+                "type": "error",
+                "response": f"An error occurred: {job.error}",
+                "success": False
+            }) + "\n"
+        else:
+            yield json.dumps(dict(job.result, type="done")) + "\n"
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+# Route handlers start from here
+
+
+# State the caches and the scheduler already keep, read on every scrape
+metrics.callback(
+    "figr_cache_hits_total", "Cache lookups that found an entry", "counter", ("cache",),
+    lambda: [(("render",), render_cache.hits), (("session",), session_cache.hits),
+             (("response",), response_cache.hits), (("test",), test_results.hits)]
+)
+metrics.callback(
+    "figr_cache_misses_total", "Cache lookups that found nothing", "counter", ("cache",),
+    lambda: [(("render",), render_cache.misses), (("session",), session_cache.misses),
+             (("response",), response_cache.misses), (("test",), test_results.misses)]
+)
+metrics.callback(
+    "figr_cache_entries", "Entries held by each cache", "gauge", ("cache",),
+    lambda: [(("render",), len(render_cache)), (("session",), len(session_cache._sessions)),
+             (("response",), response_cache.stats()["entries"]), (("test",), len(test_results))]
+)
+metrics.callback(
+    "figr_llm_jobs", "LLM jobs waiting and running", "gauge", ("state",),
+    lambda: [((state,), count) for state, count in llm_scheduler.stats().items()]
+)
+metrics.callback(
+    "figr_startup_seconds", "Seconds spent in each startup phase", "gauge", ("phase",),
+    lambda: [((phase,), seconds) for phase, seconds in startup_timings.items()]
+)
+
+
+inflight_requests = threading.BoundedSemaphore(MAX_INFLIGHT)
+
+
+# Every request gets a trace; its stage timings go to the histograms and, if enabled, the trace log
+# Registered before limit_inflight so shed requests are counted and timed too
+@app.before_request
+def start_trace():
+    g.trace = RequestTrace(request.method, request.path)
+    _trace_local.trace = g.trace
+
 
-    finally:
-        # Clean up temporary files
-        if os.path.exists(temp_input_path):
-            os.remove(temp_input_path)
-        if os.path.exists(temp_output_path):
-            os.remove(temp_output_path)
+# Sheds load once MAX_INFLIGHT requests are being served, instead of queueing them in the server.
+# Streams hold their slot until the last token is sent.
+@app.before_request
+def limit_inflight():
+    if request.endpoint == "get_metrics":
+        return None
+    if not inflight_requests.acquire(blocking=False):
+        response = jsonify({"success": False, "error": "The server is busy, please retry shortly"})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(llm_scheduler.retry_after())
+        return response
+    g.inflight = True
+    return None
 
-    return html_content
 
+@app.after_request
+def finish_trace(response):
+    # The in flight slot is given back once the body is sent, streams included
+    if g.pop("inflight", False):
+        response.call_on_close(inflight_requests.release)
 
-# To allow only .py files in the upload
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    trace = g.get("trace")
+    if trace is None:
+        return response
+    endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    status = response.status_code
 
+    # Runs once the body is sent, so streamed responses are timed to their last token
+    def close():
+        http_requests.inc(endpoint, status)
+        http_seconds.observe(time.perf_counter() - trace.started, endpoint)
+        if TRACE_LOG_PATH:
+            write_trace(trace, status)
 
-def extract_important_info(response):
-    important_items = []
-    for line in response.split('\n'):
-        if '[IMPORTANT]' in line:
-            important_items.append(line.replace('[IMPORTANT]', '').strip())
-    return important_items
+    response.call_on_close(close)
+    return response
 
-# To create new chat in the left panel
-def create_new_chat(session_id: str):
-    """Create a new chat session with metadata in database"""
-    with get_db_connection() as conn:
-        conn.execute(
-            'INSERT INTO chats (id, title, date, last_message) VALUES (?, ?, ?, ?)',
-            (session_id, "New Chat", datetime.now().isoformat(), None)
-        )
-        conn.commit()
 
-    return {
-        "id": session_id,
-        "title": "New Chat",
-        "date": datetime.now().isoformat(),
-        "last_message": None
-    }
+@app.teardown_request
+def clear_trace(exc=None):
+    _trace_local.trace = None
+    # Only still set when the request failed before a response was made
+    if g.pop("inflight", False):
+        inflight_requests.release()
 
 
-def update_chat_metadata(session_id: str, last_message: str):
-    """Update chat metadata in database"""
-    title = last_message[:30] + "..." if len(last_message) > 30 else last_message
-    with get_db_connection() as conn:
-        conn.execute(
-            'UPDATE chats SET title = ?, last_message = ? WHERE id = ?',
-            (title, last_message, session_id)
-        )
-        conn.commit()
+# Prometheus scrape endpoint
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
-# Function to structure the code snippets into specific blocks of code
-def format_response(response):
-    """Format response with proper code block structure"""
-    
-    formatted = re.sub(
-        r'```(\w+)\n(.*?)\n```',
-        lambda
-            m: f'<div class="code-block-wrapper">\n<button class="test-button">Test Code</button>\n<button class="copy-button">Copy Code</button>\n<pre><code class="hljs {m.group(1)}">{m.group(2)}</code></pre>\n<div class="test-results"></div>\n</div>',
-        response,
-        flags=re.DOTALL
-    )
 
-    
-    formatted = re.sub(
-        r'```\n(.*?)\n```',
-        lambda
-            m: f'<div class="code-block-wrapper">\n<button class="test-button">Test Code</button>\n<button class="copy-button">Copy Code</button>\n<pre><code class="hljs">{m.group(1)}</code></pre>\n<div class="test-results"></div>\n</div>',
-        formatted,
-        flags=re.DOTALL
-    )
+# Reads the page size of a paginated endpoint, clamped to MAX_PAGE_SIZE
+def page_limit(default):
+    try:
+        limit = int(request.args.get("limit", default))
+    except ValueError:
+        limit = default
+    return max(1, min(limit, MAX_PAGE_SIZE))
 
-    
-    formatted = re.sub(
-        r'`([^`]+)`',
-        r'<code class="inline-code">\1</code>',
-        formatted
-    )
 
-    return formatted
+def int_arg(name):
+    try:
+        return int(request.args[name])
+    except (KeyError, ValueError):
+        return None
 
 
-# Route handlers start from here
+# Answers 304 Not Modified when the client already holds this version, so the payload isn't even built
+def conditional_json(etag, build_payload):
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(build_payload())
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 
-# To list the history of chats in left panel
+# To list the history of chats in left panel, newest first and one page at a time
 @app.route("/api/chat-list", methods=["GET"])
 def get_chat_list():
-    """Get list of all chats from database"""
+    """Get a page of chats from database"""
+    limit = page_limit(CHAT_LIST_PAGE_SIZE)
+    cursor = request.args.get("before", "")
+
     with get_db_connection() as conn:
-        chats = conn.execute('SELECT * FROM chats ORDER BY date DESC').fetchall()
-        return jsonify({
-            "chats": [dict(chat) for chat in chats]
-        })
+        count, last_update = conn.execute('SELECT COUNT(*), MAX(updated_at) FROM chats').fetchone()
+        etag = content_hash('chat-list', str(count), str(last_update), request.query_string.decode())
+
+        def build_payload():
+            # The cursor is the (date, id) of the last chat on the previous page
+            before_date, _, before_id = cursor.partition(':')
+            if before_date.isdigit():
+                chats = conn.execute(
+                    '''SELECT id, title, date, last_message FROM chats
+                       WHERE date < ? OR (date = ? AND id < ?)
+                       ORDER BY date DESC, id DESC LIMIT ?''',
+                    (int(before_date), int(before_date), before_id, limit + 1)
+                ).fetchall()
+            else:
+                chats = conn.execute(
+                    'SELECT id, title, date, last_message FROM chats ORDER BY date DESC, id DESC LIMIT ?',
+                    (limit + 1,)
+                ).fetchall()
+
+            has_more = len(chats) > limit
+            chats = chats[:limit]
+            return {
+                "chats": [dict(chat, date=ms_to_iso(chat['date'])) for chat in chats],
+                "has_more": has_more,
+                "next_before": f"{chats[-1]['date']}:{chats[-1]['id']}" if has_more else None
+            }
+
+        return conditional_json(etag, build_payload)
 
 
 # To handle message send and receive from the LLM
@@ -378,75 +3257,137 @@ def chat():
     user_input = data.get("message", "")
     session_id = data.get("sessionId", "default")
 
-    # Get or create session
-    session = ChatSession(session_id)
-
     try:
-        # Add user message
-        session.add_message("user", user_input)
-        update_chat_metadata(session_id, user_input)
-
-        # Get memory variables
-        memory_vars = session.get_memory_variables()
-
-        # Generate response
-        raw_response = llm_chain.run(
-            user_request=user_input,
-            chat_history=memory_vars.get("chat_history", ""),
-            important_info="\n".join(session.important_info)
-        )
+        # Get the cached session or load it from the db
+        session = session_cache.get(session_id)
 
-        # Extract and store important information
-        new_important_info = extract_important_info(raw_response)
-        for info in new_important_info:
-            session.add_important_info(info)
-
-        # Format the response properly with code block structure
-        def format_response(response):
-            
-            formatted = re.sub(
-                r'```(\w+)\n(.*?)\n```',
-                lambda
-                    m: f'<div class="code-block-wrapper">\n<button class="test-button">Test Code</button>\n<button class="copy-button">Copy Code</button>\n<pre><code class="hljs {m.group(1)}">{m.group(2)}</code></pre>\n<div class="test-results"></div>\n</div>',
-                response,
-                flags=re.DOTALL
-            )
+        # Answer repeated questions from the response cache without queueing for the LLM, unless the client
+        # asks for a fresh generation (retry sends "cache": false). Only a chat's opening question is
+        # cached: later ones are answered in the context of the conversation, which the key doesn't cover.
+        info_hash = None if session.has_history else content_hash(*session.prompt_important_info)
+        cached_response = (
+            response_cache.get(user_input, info_hash) if info_hash is not None and data.get("cache", True) else None
+        )
 
-            
-            formatted = re.sub(
-                r'```\n(.*?)\n```',
-                lambda
-                    m: f'<div class="code-block-wrapper">\n<button class="test-button">Test Code</button>\n<button class="copy-button">Copy Code</button>\n<pre><code class="hljs">{m.group(1)}</code></pre>\n<div class="test-results"></div>\n</div>',
-                formatted,
-                flags=re.DOTALL
+        if cached_response is not None:
+            job = llm_scheduler.run_inline(
+                session_id,
+                lambda job: run_chat_turn(job, session, user_input, info_hash, cached_response)
             )
-
-            # Handle inline code
-            formatted = re.sub(
-                r'`([^`]+)`',
-                r'<code class="inline-code">\1</code>',
-                formatted
+        else:
+            # The turn runs on the scheduler, so the number of generations hitting Ollama stays bounded
+            # A double submitted message joins the turn already generating instead of running twice
+            job = llm_scheduler.submit(
+                session_id,
+                lambda job: run_chat_turn(job, session, user_input, info_hash),
+                key=content_hash("chat", session_id, user_input)
             )
 
-            return formatted
+    except QueueFullError as e:
+        return busy_response({"response": str(e), "success": False}, llm_scheduler.retry_after())
+    except Exception as e:
+        return jsonify({
+            "response": f"An error occurred: {str(e)}",
+            "success": False
+        })
 
-        # Format the response
-        formatted_response = format_response(raw_response)
+    # Hand back the job id right away, the client polls or subscribes to /api/jobs/<job_id>
+    if data.get("async"):
+        response = jsonify({"success": True, "job_id": job.id, "status": job.status})
+        response.status_code = 202
+        return response
 
-        # Store the formatted response
-        session.add_message("assistant", formatted_response)
+    # Stream tokens back as they are generated when the client asks for it
+    if data.get("stream"):
+        return stream_job_response(job)
 
+    job.wait()
+    if job.error is not None:
         return jsonify({
+            "response": f"An error occurred: {job.error}",
+            "success": False
+        })
+    return jsonify(job.result)
+
+
+# One chat turn: store the user message, stream the response from the LLM (or replay a cached one) and store it
+def run_chat_turn(job, session, user_input, info_hash, cached_response=None):
+    """Generate the response for a chat turn on the LLM scheduler"""
+    try:
+        # The user message is written with the reply, so a failed turn leaves nothing behind
+        turn = session.begin_turn()
+        turn.add_message("user", user_input)
+        if session.has_history:
+            info_hash = None  # an earlier turn of the chat finished while this one was queued
+        with span("compact_memory"):
+            session.compact_memory()
+
+        prefill = None
+        if cached_response is not None:
+            raw_response = cached_response
+            job.emit(raw_response)
+            # The model never saw this exchange, so the next turn starts from a full prompt
+            session.llm_context = None
+        else:
+            kind = "chat_short" if estimate_tokens(user_input) <= SHORT_QUESTION_TOKENS else "chat"
+            model = MODEL_ROUTES.get(kind, DEFAULT_MODEL)
+            with span("prompt_build"):
+                context = session.reusable_llm_context(model, user_input)
+                if context is not None:
+                    prompt_text = followup_prompt.format(user_request=user_input)
+                else:
+                    prompt_text = prompt_template.format(**build_chat_inputs(session, user_input))
+            stats = {}
+            chunks = []
+            for token in llm_stream(prompt_text, kind, context=context, on_done=stats.update):
+                chunks.append(token)
+                job.emit(token)
+            raw_response = "".join(chunks)
+            if info_hash is not None and context is None:
+                response_cache.set(user_input, info_hash, raw_response)
+            session.llm_context = {"model": model, "tokens": stats["context"]} if stats.get("context") else None
+            prefill = {
+                "tokens": stats.get("prompt_eval_count"),
+                "ms": round(stats["prompt_eval_duration"] / 1e6, 1) if stats.get("prompt_eval_duration") else None,
+                "reused_context": context is not None
+            }
+
+        # Important info and code block formatting need the complete response
+        formatted_response = finish_chat_turn(raw_response, turn)
+
+        return {
             "response": formatted_response,
             "success": True,
-            "important_info": session.important_info
-        })
+            "important_info": session.important_info,
+            "prefill": prefill
+        }
+
+    except Exception:
+        # The cached session may be out of sync with the db after a failed turn
+        session_cache.invalidate(session.session_id)
+        raise
 
-    except Exception as e:
-        return jsonify({
-            "response": f"An error occurred: {str(e)}",
-            "success": False
-        })
+
+# Poll an LLM job started with "async": true
+@app.route("/api/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    job = llm_scheduler.get(job_id)
+    if job is None:
+        response = jsonify({"success": False, "error": "Unknown or expired job"})
+        response.status_code = 404
+        return response
+    return jsonify(dict(job.to_dict(), success=True))
+
+
+# Subscribe to the tokens of an LLM job
+@app.route("/api/jobs/<job_id>/stream", methods=["GET"])
+def stream_job(job_id):
+    job = llm_scheduler.get(job_id)
+    if job is None:
+        response = jsonify({"success": False, "error": "Unknown or expired job"})
+        response.status_code = 404
+        return response
+    return stream_job_response(job)
 
 
 # To create a new chat from the left panel
@@ -461,58 +3402,201 @@ def new_chat():
 # Get the history of particular chat from the db
 @app.route("/api/chat-history", methods=["GET"])
 def get_chat_history():
-    """Get chat history for a specific session"""
+    """Get a page of chat history for a specific session"""
     session_id = request.args.get("sessionId", "default")
+    limit = page_limit(HISTORY_PAGE_SIZE)
+    before_id = int_arg("before_id")
+    after_id = int_arg("after_id")
+    restore_archived_chat(session_id)
 
     with get_db_connection() as conn:
-        # Get messages
-        messages = conn.execute(
-            'SELECT role, content, timestamp FROM messages WHERE chat_id = ? ORDER BY timestamp',
-            (session_id,)
-        ).fetchall()
+        # Index only lookups that change whenever a message or important info is added or removed
+        message_count, last_message_id = conn.execute(
+            'SELECT COUNT(*), MAX(id) FROM messages WHERE chat_id = ?', (session_id,)
+        ).fetchone()
+        info_count, last_info_id, info_hits = conn.execute(
+            'SELECT COUNT(*), MAX(id), SUM(hits) FROM important_info WHERE chat_id = ?', (session_id,)
+        ).fetchone()
+        etag = content_hash(
+            'chat-history', str(message_count), str(last_message_id), str(info_count), str(last_info_id),
+            str(info_hits),
+            str(RENDERER_VERSION), request.query_string.decode()
+        )
 
-        # Format assistant messages if they aren't already formatted
-        formatted_messages = []
-        for msg in messages:
-            message_dict = dict(msg)
-            if message_dict['role'] == 'assistant' and '```' in message_dict['content']:
-                # Format the response if it contains code blocks
-                message_dict['content'] = format_response(message_dict['content'])
-            formatted_messages.append(message_dict)
-
-        # Get important info to display separately as explained in demo
-        important_info = conn.execute(
-            'SELECT content FROM important_info WHERE chat_id = ?',
-            (session_id,)
-        ).fetchall()
+        def build_payload():
+            columns = 'SELECT id, role, content, html, render_version, timestamp FROM messages'
+            if after_id is not None:
+                # Incremental sync: the messages the client hasn't seen yet, oldest first
+                messages = conn.execute(
+                    f'{columns} WHERE chat_id = ? AND id > ? ORDER BY id LIMIT ?',
+                    (session_id, after_id, limit + 1)
+                ).fetchall()
+                has_more = len(messages) > limit
+                messages = messages[:limit]
+            else:
+                # The latest page, or the page before before_id, read newest first then put back in order
+                if before_id is not None:
+                    messages = conn.execute(
+                        f'{columns} WHERE chat_id = ? AND id < ? ORDER BY id DESC LIMIT ?',
+                        (session_id, before_id, limit + 1)
+                    ).fetchall()
+                else:
+                    messages = conn.execute(
+                        f'{columns} WHERE chat_id = ? ORDER BY id DESC LIMIT ?',
+                        (session_id, limit + 1)
+                    ).fetchall()
+                has_more = len(messages) > limit
+                messages = messages[:limit][::-1]
 
-        return jsonify({
-            "history": formatted_messages,
-            "important_info": [info['content'] for info in important_info]
-        })
+            # Stored HTML is served as is, only messages rendered by an older renderer are formatted again
+            formatted_messages, stale_renders = [], []
+            for msg in messages:
+                html = msg['html']
+                if msg['render_version'] < RENDERER_VERSION:
+                    html = render_message(msg['role'], msg['content'])
+                    stale_renders.append((html, RENDERER_VERSION, msg['id']))
+                formatted_messages.append({
+                    "id": msg['id'],
+                    "role": msg['role'],
+                    "content": html if html is not None else msg['content'],
+                    "timestamp": ms_to_iso(msg['timestamp'])
+                })
 
+            if stale_renders:
+                with db_transaction():
+                    conn.executemany('UPDATE messages SET html = ?, render_version = ? WHERE id = ?', stale_renders)
 
-# Facilitates the upload of .py files
-@app.route('/api/upload', methods=['POST'])
-def upload_file():
-    if 'file' not in request.files:
-        return jsonify({'success': False, 'error': 'No file part'})
+            # Get important info to display separately as explained in demo
+            info_rows = conn.execute(
+                '''SELECT i.content, i.hits, COALESCE(i.last_seen, c.updated_at, 0) AS last_seen
+                   FROM important_info i LEFT JOIN chats c ON c.id = i.chat_id
+                   WHERE i.chat_id = ? ORDER BY i.id''',
+                (session_id,)
+            ).fetchall()
+            important_info = ImportantInfoStore()
+            for row in info_rows:
+                important_info.add(row['content'], hits=row['hits'], last_seen=row['last_seen'])
 
-    file = request.files['file']
-    if file.filename == '':
-        return jsonify({'success': False, 'error': 'No selected file'})
+            return {
+                "history": formatted_messages,
+                "important_info": important_info.ranked(),
+                "has_more": has_more,
+                "oldest_id": formatted_messages[0]["id"] if formatted_messages else before_id,
+                "newest_id": formatted_messages[-1]["id"] if formatted_messages else (after_id or last_message_id)
+            }
 
-    if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
+        return conditional_json(etag, build_payload)
 
-        # Read the file content
-        with open(filepath, 'r') as f:
-            content = f.read()
 
-        # Custom prompt to get the best out of uploaded .py file
-        analysis_prompt = f"""
+# Turn free text into an FTS5 query: every word must match, the last one as a prefix while the user types
+def fts_query(text):
+    words = re.findall(r"\w+", text.lower())
+    if not words:
+        return None
+    return " ".join(f'"{word}"' for word in words) + "*"
+
+
+# Markers that can't appear in stored text, swapped for <mark> once the snippet is escaped
+SNIPPET_START, SNIPPET_END = '\x02', '\x03'
+
+
+def snippet_html(snippet):
+    return escape(snippet).replace(SNIPPET_START, '<mark>').replace(SNIPPET_END, '</mark>')
+
+
+# Search messages and important info of every chat (or of one with sessionId), best matches first
+@app.route("/api/search", methods=["GET"])
+def search():
+    """Get a page of ranked search results"""
+    query = fts_query(request.args.get("q", ""))
+    if query is None:
+        return jsonify({"success": False, "error": "Empty search query"})
+    limit = page_limit(SEARCH_PAGE_SIZE)
+    offset = max(int_arg("offset") or 0, 0)
+    session_id = request.args.get("sessionId")
+    # The matches of one chat are ranked all at once, global ones a window of SEARCH_RANK_WINDOW at a time
+    window_number = max(int_arg("window") or 0, 0) if not session_id else 0
+    chat_filter = 'AND {alias}.chat_id = :chat_id' if session_id else ''
+    # Rowid range of the matches in the window, a range FTS5 applies while reading the index
+    window = '''AND {fts}.rowid >= COALESCE((
+        SELECT rowid FROM {fts} WHERE {fts} MATCH :query ORDER BY rowid DESC LIMIT 1 OFFSET :window_last
+    ), 0)''' if not session_id else ''
+    if window_number > 0:
+        window += ''' AND {fts}.rowid <= (
+        SELECT rowid FROM {fts} WHERE {fts} MATCH :query ORDER BY rowid DESC LIMIT 1 OFFSET :window_first
+    )'''
+    older_match = 'SELECT rowid FROM {fts} WHERE {fts} MATCH :query ORDER BY rowid DESC LIMIT 1 OFFSET :window_last + 1'
+
+    sources = {
+        "message": f'''
+            SELECT 'message' AS type, m.id, m.chat_id, m.role, m.timestamp,
+                   snippet(messages_fts, 0, :start, :end, '...', 16) AS snippet,
+                   bm25(messages_fts) AS score
+            FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+            WHERE messages_fts MATCH :query {chat_filter.format(alias='m')} {window.format(fts='messages_fts')}
+        ''',
+        "important_info": f'''
+            SELECT 'important_info' AS type, i.id, i.chat_id, NULL AS role, NULL AS timestamp,
+                   snippet(important_info_fts, 0, :start, :end, '...', 16) AS snippet,
+                   bm25(important_info_fts) AS score
+            FROM important_info_fts JOIN important_info i ON i.id = important_info_fts.rowid
+            WHERE important_info_fts MATCH :query {chat_filter.format(alias='i')}
+                  {window.format(fts='important_info_fts')}
+        '''
+    }
+    indexes = {"message": "messages_fts", "important_info": "important_info_fts"}
+    types = [name for name in request.args.get("type", "message,important_info").split(",") if name in sources]
+    if not types:
+        return jsonify({"success": False, "error": "Unknown result type"})
+
+    params = {"query": query, "chat_id": session_id, "start": SNIPPET_START, "end": SNIPPET_END,
+              "window_first": window_number * SEARCH_RANK_WINDOW,
+              "window_last": (window_number + 1) * SEARCH_RANK_WINDOW - 1,
+              "limit": limit + 1, "offset": offset}
+    next_window = None
+    try:
+        with get_db_connection() as conn:
+            rows = conn.execute(
+                " UNION ALL ".join(sources[name] for name in types) + " ORDER BY score LIMIT :limit OFFSET :offset",
+                params
+            ).fetchall()
+            has_more = len(rows) > limit
+            rows = rows[:limit]
+            # Once a window is used up, paging goes on with the older matches
+            if not has_more and not session_id and any(
+                conn.execute(older_match.format(fts=indexes[name]), params).fetchone() for name in types
+            ):
+                next_window = window_number + 1
+
+            chat_ids = sorted({row['chat_id'] for row in rows})
+            titles = dict(conn.execute(
+                f'SELECT id, title FROM chats WHERE id IN ({",".join("?" * len(chat_ids))})', chat_ids
+            ).fetchall()) if chat_ids else {}
+    except sqlite3.OperationalError as e:
+        return jsonify({"success": False, "error": f"Invalid search query: {e}"})
+
+    return jsonify({
+        "success": True,
+        "results": [{
+            "type": row['type'],
+            "id": row['id'],
+            "chat_id": row['chat_id'],
+            "chat_title": titles.get(row['chat_id']),
+            "role": row['role'],
+            "timestamp": ms_to_iso(row['timestamp']),
+            "snippet": snippet_html(row['snippet']),
+            "score": -row['score']
+        } for row in rows],
+        "window": window_number,
+        "has_more": has_more or next_window is not None,
+        "next_offset": offset + len(rows) if has_more else (0 if next_window is not None else None),
+        "next_window": window_number if has_more else next_window
+    })
+
+
+# Custom prompt to get the best out of uploaded .py file
+def analysis_prompt(content):
+    return f"""
         Please analyze this Python code:
 
         {content}
@@ -525,19 +3609,283 @@ def upload_file():
         - Each in separate neat paragraphs with highlighted headings.
         """
 
-        analysis = llm.predict(analysis_prompt)
 
-        # Clean up the uploaded file to save memory
-        os.remove(filepath)
+# Prompt for one function or class of a larger file, with the module's imports for context
+def chunk_analysis_prompt(filename, imports, chunk):
+    return f"""
+        This is the {chunk['kind']} `{chunk['name']}` (lines {chunk['start']}-{chunk['end']}) of the Python file {filename}.
+        The file imports:
+        {imports or "nothing"}
 
-        return jsonify({
-            'success': True,
-            'filename': filename,
-            'content': content,
-            'analysis': analysis
+        {chunk['source']}
+
+        Provide:
+        1. A clear, small explanation
+        2. Any potential errors or improvements
+        3. Suggestions for better practices
+        
+        - Keep it short, each in separate neat paragraphs with highlighted headings.
+        """
+
+
+def _source_chunk(lines, name, kind, start, end):
+    return {"name": name, "kind": kind, "start": start, "end": end, "source": "".join(lines[start - 1:end])}
+
+
+# Split a module into top level functions and classes (methods too for classes over the token budget).
+# Statements between them are grouped into "module" chunks; a file that doesn't parse is split by lines.
+def split_source_chunks(source):
+    lines = source.splitlines(keepends=True)
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        step = max(1, UPLOAD_CHUNK_TOKENS * 4 // 80)  # about 80 characters a line
+        return [
+            _source_chunk(lines, f"lines {start}-{min(start + step - 1, len(lines))}", "part",
+                          start, min(start + step - 1, len(lines)))
+            for start in range(1, len(lines) + 1, step)
+        ]
+
+    chunks = []
+    loose = []  # (start, end) of consecutive module level statements
+
+    def flush_loose():
+        if loose:
+            chunks.append(_source_chunk(lines, "module level code", "module code", loose[0][0], loose[-1][1]))
+            loose.clear()
+
+    for node in tree.body:
+        start = min([node.lineno] + [decorator.lineno for decorator in getattr(node, 'decorator_list', [])])
+        if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            loose.append((start, node.end_lineno))
+            continue
+        flush_loose()
+        kind = "class" if isinstance(node, ast.ClassDef) else "function"
+        chunk = _source_chunk(lines, node.name, kind, start, node.end_lineno)
+        methods = [child for child in node.body if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef))]
+        if kind == "class" and methods and estimate_tokens(chunk["source"]) > UPLOAD_CHUNK_TOKENS:
+            # The class header and attributes, then each method on its own
+            chunks.append(_source_chunk(lines, node.name, "class", start, methods[0].lineno - 1))
+            for method in methods:
+                method_start = min([method.lineno] + [decorator.lineno for decorator in method.decorator_list])
+                chunks.append(_source_chunk(lines, f"{node.name}.{method.name}", "method",
+                                            method_start, method.end_lineno))
+        else:
+            chunks.append(chunk)
+    flush_loose()
+    return chunks
+
+
+def load_chunk_analyses(hashes):
+    placeholders = ",".join("?" * len(hashes))
+    with get_db_connection() as conn:
+        rows = conn.execute(
+            f'SELECT hash, analysis FROM chunk_analyses WHERE hash IN ({placeholders})', list(hashes)
+        ).fetchall()
+    return {row['hash']: row['analysis'] for row in rows}
+
+
+def save_chunk_analyses(analyses):
+    with get_db_connection() as conn:
+        conn.executemany(
+            'INSERT OR REPLACE INTO chunk_analyses (hash, analysis, created_at) VALUES (?, ?, ?)',
+            [(chunk_hash, analysis, now_ms()) for chunk_hash, analysis in analyses.items()]
+        )
+        conn.commit()
+
+
+# Chunks of one file with their prompts and content hashes
+def plan_chunks(filename, content):
+    if estimate_tokens(content) <= UPLOAD_CHUNK_TOKENS:
+        chunks = [{"name": filename, "kind": "file", "start": 1, "end": max(len(content.splitlines()), 1),
+                   "source": content, "prompt": analysis_prompt(content)}]
+    else:
+        chunks = split_source_chunks(content)
+        imports = "\n".join(
+            line.strip() for line in content.splitlines() if line.startswith(("import ", "from "))
+        )
+        for chunk in chunks:
+            chunk["prompt"] = chunk_analysis_prompt(filename, imports, chunk)
+    # Keyed by the code itself: line numbers, the file name and the import list go into the prompt only,
+    # so an edit elsewhere in the file doesn't invalidate the analyses of unchanged functions
+    for chunk in chunks:
+        chunk["hash"] = content_hash("upload-analysis", chunk["kind"], chunk["name"], chunk["source"])
+    return chunks
+
+
+# Analyze chunks on the LLM scheduler, reusing stored analyses of unchanged ones.
+# Returns the analyses and the errors of the chunks that failed, both by chunk hash.
+def analyze_chunks(chunks, session_id):
+    analyses = load_chunk_analyses({chunk["hash"] for chunk in chunks})
+    for chunk in chunks:
+        chunk["cached"] = chunk["hash"] in analyses
+
+    # Keep at most UPLOAD_PARALLELISM chunks queued, all in the chat's upload lane, which runs up to
+    # UPLOAD_PARALLELISM of them at once and still takes its round robin turn with the other chats
+    pending = deque(chunk for chunk in chunks if not chunk["cached"])
+    in_flight = deque()
+    fresh = {}
+    errors = {}
+    while pending or in_flight:
+        while pending and len(in_flight) < UPLOAD_PARALLELISM:
+            chunk = pending.popleft()
+            try:
+                job = llm_scheduler.submit(
+                    f"{session_id}:upload",
+                    lambda job, chunk_prompt=chunk["prompt"]: llm_predict(chunk_prompt, "upload"),
+                    key=chunk["hash"],
+                    lane_limit=UPLOAD_PARALLELISM
+                )
+            except QueueFullError:
+                if not in_flight:
+                    raise
+                pending.appendleft(chunk)
+                break
+            in_flight.append((chunk, job))
+
+        chunk, job = in_flight.popleft()
+        job.wait()
+        if job.error is None:
+            fresh[chunk["hash"]] = job.result
+        else:
+            errors[chunk["hash"]] = job.error
+
+    if errors and not fresh and not analyses:
+        raise RuntimeError(next(iter(errors.values())))
+    if fresh:
+        save_chunk_analyses(fresh)
+    analyses.update(fresh)
+    return analyses, errors
+
+
+# One report per file: the analysis itself for single chunk files, a section per chunk otherwise
+def merge_report(filename, chunks, analyses, errors):
+    def body(chunk):
+        return (analyses.get(chunk["hash"]) or f"Analysis failed: {errors[chunk['hash']]}").strip()
+
+    if len(chunks) == 1:
+        return body(chunks[0])
+    sections = [f"**{filename}** was analyzed in {len(chunks)} parts."]
+    for chunk in chunks:
+        sections.append(
+            f"### {chunk['kind'].capitalize()} `{chunk['name']}` (lines {chunk['start']}-{chunk['end']})"
+            f"\n\n{body(chunk)}"
+        )
+    return "\n\n".join(sections)
+
+
+# Analyze uploaded files, given as (filename, content) pairs, with the chunks of every file queued together.
+# Returns the merged report and, per file, its chunks with their cache status.
+def analyze_sources(files, session_id):
+    planned = [(filename, content, plan_chunks(filename, content)) for filename, content in files]
+    analyses, errors = analyze_chunks([chunk for _, _, chunks in planned for chunk in chunks], session_id)
+
+    reports = []
+    summary = []
+    for filename, content, chunks in planned:
+        report = merge_report(filename, chunks, analyses, errors)
+        reports.append(report if len(planned) == 1 else f"## {filename}\n\n{report}")
+        summary.append({
+            "filename": filename,
+            "content": content,
+            "chunks": [{key: chunk[key] for key in ("name", "kind", "start", "end", "cached")} for chunk in chunks]
         })
+    return "\n\n".join(reports), summary
+
+
+class UploadError(Exception):
+    pass
+
+
+# Decode an uploaded stream as UTF-8 a block at a time, refusing it once it goes over the byte budget
+def read_upload_text(stream, name, budget):
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    parts = []
+    size = 0
+    try:
+        while True:
+            block = stream.read(64 * 1024)
+            if not block:
+                break
+            size += len(block)
+            if size > budget:
+                raise UploadError(f"The upload is over the {UPLOAD_MAX_BYTES // 1024} KB limit at {name}")
+            parts.append(decoder.decode(block))
+        parts.append(decoder.decode(b'', final=True))
+    except UnicodeDecodeError:
+        raise UploadError(f"{name} is not UTF-8 text")
+    return "".join(parts), size
+
+
+# The .py files of an upload, read from memory (or the spooled file werkzeug keeps for large bodies).
+# Zip archives contribute their .py members; every file counts towards UPLOAD_MAX_FILES and UPLOAD_MAX_BYTES.
+def read_uploaded_sources(uploads):
+    files = []
+    remaining = UPLOAD_MAX_BYTES
+
+    def add(name, stream):
+        nonlocal remaining
+        if len(files) >= UPLOAD_MAX_FILES:
+            raise UploadError(f"At most {UPLOAD_MAX_FILES} files can be analyzed at once")
+        content, size = read_upload_text(stream, name, remaining)
+        remaining -= size
+        files.append((name, content))
+
+    for upload in uploads:
+        filename = secure_filename(upload.filename)
+        if filename.lower().endswith('.zip'):
+            try:
+                with zipfile.ZipFile(upload.stream) as archive:
+                    for member in archive.infolist():
+                        if member.is_dir() or not allowed_file(member.filename):
+                            continue
+                        if member.file_size > remaining:
+                            raise UploadError(
+                                f"The upload is over the {UPLOAD_MAX_BYTES // 1024} KB limit at {member.filename}"
+                            )
+                        with archive.open(member) as stream:
+                            add(member.filename, stream)
+            except zipfile.BadZipFile:
+                raise UploadError(f"{filename} is not a valid zip archive")
+        elif allowed_file(filename):
+            add(filename, upload.stream)
+        else:
+            raise UploadError('Invalid file type')
+
+    if not files:
+        raise UploadError('No Python files found in the upload')
+    return files
+
+
+# Facilitates the upload of .py files, several at once or in a .zip
+@app.route('/api/upload', methods=['POST'])
+def upload_file():
+    request.max_content_length = UPLOAD_MAX_BYTES + 64 * 1024  # room for the multipart framing
+    uploads = [upload for upload in request.files.getlist('file') if upload.filename]
+    if 'file' not in request.files:
+        return jsonify({'success': False, 'error': 'No file part'})
+    if not uploads:
+        return jsonify({'success': False, 'error': 'No selected file'})
+
+    try:
+        files = read_uploaded_sources(uploads)
+        # Uploads outside a chat get a lane of their own, so they don't queue behind each other
+        analysis, summary = analyze_sources(files, request.form.get("sessionId") or uuid.uuid4().hex)
+    except UploadError as e:
+        return jsonify({'success': False, 'error': str(e)})
+    except QueueFullError as e:
+        return busy_response({'success': False, 'error': str(e)}, llm_scheduler.retry_after())
+    except Exception as e:
+        return jsonify({'success': False, 'error': f"Error analyzing file: {e}"})
 
-    return jsonify({'success': False, 'error': 'Invalid file type'})
+    return jsonify({
+        'success': True,
+        'filename': ", ".join(file["filename"] for file in summary),
+        'content': summary[0]["content"] if len(summary) == 1 else None,
+        'chunks': summary[0]["chunks"] if len(summary) == 1 else None,
+        'files': summary,
+        'analysis': analysis
+    })
 
 
 # To clear the chat_database.db which leads to model hallucination when extremely long
@@ -547,76 +3895,124 @@ def clear_memory():
     session_id = request.json.get("sessionId", "default")
     clear_option = request.json.get("clearOption", "all")
 
-    with get_db_connection() as conn:
-        try:
-            if clear_option == "all":
-                conn.execute('DELETE FROM messages WHERE chat_id = ?', (session_id,))
-                conn.execute('DELETE FROM important_info WHERE chat_id = ?', (session_id,))
-                message = "All memory cleared successfully"
-            elif clear_option == "chat":
-                conn.execute('DELETE FROM messages WHERE chat_id = ?', (session_id,))
-                message = "Chat history cleared successfully"
-            elif clear_option == "important":
-                conn.execute('DELETE FROM important_info WHERE chat_id = ?', (session_id,))
-                message = "Important information cleared successfully"
-            else:
-                return jsonify({
-                    "success": False,
-                    "message": "Invalid clear option specified"
-                })
+    # What each option clears, as the history and important_info flags of clear_chat_data
+    options = {
+        "all": (True, True, "All memory cleared successfully"),
+        "chat": (True, False, "Chat history cleared successfully"),
+        "important": (False, True, "Important information cleared successfully"),
+    }
+    if clear_option not in options:
+        return jsonify({
+            "success": False,
+            "message": "Invalid clear option specified"
+        })
+    history, important_info, message = options[clear_option]
 
-            conn.commit()
-            return jsonify({
-                "success": True,
-                "message": message
-            })
+    try:
+        with db_transaction() as conn:
+            clear_chat_data(conn, session_id, history=history, important_info=important_info)
+        session_cache.invalidate(session_id)
+        return jsonify({
+            "success": True,
+            "message": message
+        })
 
-        except Exception as e:
-            return jsonify({
-                "success": False,
-                "message": f"Error clearing memory: {str(e)}"
-            })
+    except Exception as e:
+        return jsonify({
+            "success": False,
+            "message": f"Error clearing memory: {str(e)}"
+        })
 
 
-# Tests the generated code using subprocess
+# Tests the generated code in a warm sandbox worker
 @app.route("/api/test-code", methods=["POST"])
 def test_code():
     try:
         data = request.json
         code = data.get("code", "")
+        return jsonify(run_code(code))
 
-        # Create a temporary file to store the code
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False) as f:
-            f.write(code)
-            temp_file = f.name
+    except SandboxBusyError as e:
+        return busy_response({"success": False, "output": str(e)}, 1)
 
-        try:
-            # Run the code using Python
-            result = subprocess.run(
-                ['python', temp_file],
-                capture_output=True,
-                text=True,
-                timeout=5  # 5 second timeout for safety
-            )
+    except Exception as e:
+        return jsonify({
+            "success": False,
+            "output": f"Error executing code: {str(e)}"
+        })
+
+# Tests every code block of a response at once
+@app.route("/api/test-code/batch", methods=["POST"])
+def test_code_batch():
+    try:
+        codes = request.json.get("codes", [])
+        if not isinstance(codes, list) or not all(isinstance(code, str) for code in codes):
+            return jsonify({"success": False, "error": "codes must be a list of strings"}), 400
+        if len(codes) > TEST_BATCH_MAX:
+            return jsonify({"success": False, "error": f"At most {TEST_BATCH_MAX} snippets per batch"}), 400
+
+        results = run_code_batch(codes)
+        if any(result.get("busy") for result in results):
+            return busy_response({"success": False, "results": results}, 1)
+        return jsonify({"success": True, "results": results})
+
+    except Exception as e:
+        return jsonify({
+            "success": False,
+            "error": f"Error executing code: {str(e)}"
+        })
 
-            # Prepare the response
-            success = result.returncode == 0
-            output = result.stdout if success else result.stderr
 
-            return jsonify({
-                "success": success,
-                "output": output
-            })
+# To back up or move every chat: streams an export without holding it in memory. A connection of its own
+# is used, so a slow download doesn't keep a pooled one from the requests.
+@app.route("/api/export", methods=["GET"])
+def export_chats():
+    """Download every chat as gzip compressed NDJSON (plain NDJSON with compress=0)"""
+    compress = request.args.get("compress", "1") != "0"
+    pool = ConnectionPool(DATABASE_PATH, size=1)
 
+    def generate():
+        try:
+            yield from encode_ndjson(export_records(pool), compress=compress)
         finally:
-            # Clean up the temporary file
-            os.unlink(temp_file)
+            pool.close_all()
+
+    filename = f"figr-export-{datetime.now().strftime('%Y%m%d-%H%M%S')}.ndjson" + (".gz" if compress else "")
+    return Response(
+        generate(),
+        mimetype="application/gzip" if compress else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"', "Cache-Control": "no-store"}
+    )
+
+
+# To load an export sent as the request body, read and inserted a batch at a time
+@app.route("/api/import", methods=["POST"])
+def import_chats():
+    """Import chats from an export; mode=replace overwrites chats that already exist"""
+    try:
+        # Far above MAX_CONTENT_LENGTH, which None would fall back to
+        request.max_content_length = IMPORT_MAX_BYTES
+        counts = import_records(
+            decode_ndjson(iter(lambda: request.stream.read(EXPORT_CHUNK_BYTES), b'')),
+            mode=request.args.get("mode", "skip")
+        )
+        if not counts["complete"]:
+            return jsonify({"success": False, "error": "The export is cut short, the records before the cut were imported",
+                            "imported": counts}), 400
+        return jsonify({"success": True, "imported": counts})
+
+    except ValueError as e:  # not an export, or a malformed one
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    except RequestEntityTooLarge:
+        return jsonify({"success": False, "error": f"Exports over {IMPORT_MAX_BYTES} bytes are not accepted"}), 413
 
     except Exception as e:
         return jsonify({
             "success": False,
-            "output": f"Error executing code: {str(e)}"
-        })
+            "error": f"Error importing chats: {str(e)}"
+        }), 500
+
 
 # Main route to render the index.html
 @app.route("/")
@@ -625,6 +4021,160 @@ def home():
     return render_template("index.html")
 
 
+# SQLite connections must not cross a fork: the server process closes its own before starting workers,
+# which then open theirs on first use
+def close_connections():
+    db_pool.close_all()
+    response_cache.close()
+
+
+# Serve the app with gunicorn: a process per worker, each with its own thread pool (gthread) or greenlets (gevent)
+def run_gunicorn(args):
+    from gunicorn.app.base import BaseApplication
+
+    class FigrApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"{args.host}:{args.port}")
+            self.cfg.set("workers", args.workers)
+            self.cfg.set("worker_class", args.worker_class)
+            self.cfg.set("threads", args.threads)
+            self.cfg.set("worker_connections", MAX_INFLIGHT)
+            self.cfg.set("timeout", 120)
+            self.cfg.set("keepalive", 5)
+            self.cfg.set("pre_fork", lambda server, worker: close_connections())
+
+        def load(self):
+            return app
+
+    FigrApplication().run()
+
+
+def run_waitress(args):
+    from waitress import serve
+    serve(app, host=args.host, port=args.port, threads=args.threads, connection_limit=MAX_INFLIGHT)
+
+
+def pick_server():
+    """gunicorn where it runs (not on Windows), then waitress, then the Werkzeug server"""
+    for name, module in (("gunicorn", "gunicorn"), ("waitress", "waitress")):
+        if name == "gunicorn" and sys.platform == "win32":
+            continue
+        try:
+            __import__(module)
+            return name
+        except ImportError:
+            pass
+    return "werkzeug"
+
+
+def serve(args):
+    if PREWARM:
+        prewarm()
+    if OLLAMA_WARMUP:
+        warm_models()
+    if RETENTION_INTERVAL > 0:
+        start_retention_worker()
+    startup_timings["ready"] = time.perf_counter() - IMPORT_STARTED
+
+    if args.debug:
+        app.run(host=args.host, port=args.port, debug=True)
+        return
+
+    server = pick_server() if args.server == "auto" else args.server
+    if server == "gunicorn":
+        run_gunicorn(args)
+    elif server == "waitress":
+        run_waitress(args)
+    else:
+        print("gunicorn and waitress are not installed, using the threaded Werkzeug server", file=sys.stderr)
+        app.run(host=args.host, port=args.port, threaded=True, debug=False)
+
+
+def export_command(args):
+    started = time.perf_counter()
+    output = sys.stdout.buffer if args.path == "-" else open(args.path, "wb")
+    size = 0
+    try:
+        for chunk in encode_ndjson(export_records(), compress=not args.no_compress):
+            output.write(chunk)
+            size += len(chunk)
+    finally:
+        if output is not sys.stdout.buffer:
+            output.close()
+    print(f"Exported {size / 1e6:.1f} MB in {time.perf_counter() - started:.1f} s", file=sys.stderr)
+
+
+def import_command(args):
+    started = time.perf_counter()
+    source = sys.stdin.buffer if args.path == "-" else open(args.path, "rb")
+    try:
+        counts = import_records(decode_ndjson(iter(lambda: source.read(EXPORT_CHUNK_BYTES), b'')), mode=args.mode)
+    except ExportFormatError as e:
+        print(f"Import failed: {e}", file=sys.stderr)
+        return 1
+    finally:
+        if source is not sys.stdin.buffer:
+            source.close()
+    print(json.dumps(counts))
+    print(f"Imported in {time.perf_counter() - started:.1f} s", file=sys.stderr)
+    if not counts["complete"]:
+        print("The export is cut short, the records before the cut were imported", file=sys.stderr)
+        return 1
+    return 0
+
+
+def vacuum_command(args):
+    started = time.perf_counter()
+    with get_db_connection() as conn:
+        switched = enable_incremental_vacuum(conn)
+    if switched:
+        print(f"Switched to incremental auto vacuum in {time.perf_counter() - started:.1f} s", file=sys.stderr)
+    else:
+        print("Incremental auto vacuum is already enabled", file=sys.stderr)
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Figr Code Assistant")
+    subparsers = parser.add_subparsers(dest="command")
+
+    serve_parser = subparsers.add_parser("serve", help="run the web server (the default command)")
+    serve_parser.add_argument("--host", default=SERVER_HOST)
+    serve_parser.add_argument("--port", type=int, default=SERVER_PORT)
+    serve_parser.add_argument("--server", choices=("auto", "gunicorn", "waitress", "werkzeug"), default="auto")
+    serve_parser.add_argument("--workers", type=int, default=SERVER_WORKERS, help="gunicorn worker processes")
+    serve_parser.add_argument("--threads", type=int, default=SERVER_THREADS, help="request threads per process")
+    serve_parser.add_argument("--worker-class", choices=("gthread", "gevent"), default="gthread",
+                              help="gevent serves each request on a greenlet instead of a thread")
+    serve_parser.add_argument("--debug", action="store_true", help="Flask development server with the debugger")
+    serve_parser.set_defaults(func=serve)
+
+    export_parser = subparsers.add_parser("export", help="write every chat to a gzip compressed NDJSON file")
+    export_parser.add_argument("path", nargs="?", default="-", help="output file, - for stdout")
+    export_parser.add_argument("--no-compress", action="store_true", help="plain NDJSON")
+    export_parser.set_defaults(func=export_command)
+
+    import_parser = subparsers.add_parser("import", help="load the chats of an export (gzip compressed or not)")
+    import_parser.add_argument("path", nargs="?", default="-", help="export file, - for stdin")
+    import_parser.add_argument("--mode", choices=("skip", "replace"), default="skip",
+                               help="keep (skip) or overwrite (replace) chats that already exist")
+    import_parser.set_defaults(func=import_command)
+
+    vacuum_parser = subparsers.add_parser("vacuum", help="switch the database to incremental auto vacuum "
+                                                         "(one full VACUUM, stop the server first)")
+    vacuum_parser.set_defaults(func=vacuum_command)
+
+    # Serving stays the default, so `python app.py --port 8000` keeps working
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if not argv or (argv[0] not in subparsers.choices and argv[0] not in ("-h", "--help")):
+        argv = ["serve", *argv]
+    args = parser.parse_args(argv)
+    init_db()
+    return args.func(args)
+
+
+startup_timings["import"] = time.perf_counter() - IMPORT_STARTED
+
 # Start the web flask app
 if __name__ == "__main__":
-    app.run(debug=True)
+    sys.exit(main())
@@ -0,0 +1,1237 @@
+# Benchmarks for the Figr Code Assistant backend.
+# Every benchmark runs against a throwaway database and a stub LLM, so no Ollama server is needed:
+#   python benchmark.py memory --turns 60
+#   python benchmark.py db --chats 5000 --messages 200
+#   python benchmark.py render
+#   python benchmark.py sandbox --runs 200 --concurrency 4
+#   python benchmark.py test-batch --snippets 8
+#   python benchmark.py scheduler --requests 64 --clients 16
+#   python benchmark.py cache
+#   python benchmark.py search --chats 5000 --messages 200
+#   python benchmark.py metrics
+#   python benchmark.py writes --turns 2000 --concurrency 16
+#   python benchmark.py important-info --turns 200
+#   python benchmark.py ollama --requests 500 --concurrency 4
+#   python benchmark.py context --turns 40
+#   python benchmark.py retention --chats 2000 --messages 100
+#   python benchmark.py export --chats 5000 --messages 200
+#   python benchmark.py startup --budget-ms 400
+#   python benchmark.py generate chats.db --chats 10000 --messages 200
+#   python benchmark.py load --database chats.db --requests 2000 --concurrency 32
+import argparse
+import http.client
+import http.server
+import json
+import logging
+import os
+import random
+import requests
+import resource
+import re
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+# Point the app at a scratch database before it is imported
+os.environ.setdefault('FIGR_DATABASE_PATH', os.path.join(tempfile.mkdtemp(prefix='figr-bench-'), 'bench.db'))
+
+import app  # noqa: E402
+from flask.testing import FlaskClient  # noqa: E402
+
+
+# Reads and closes every response, as a WSGI server would, so the app's per response cleanup runs
+class BufferedClient(FlaskClient):
+    def open(self, *args, **kwargs):
+        kwargs.setdefault("buffered", True)
+        return super().open(*args, **kwargs)
+
+
+app.app.test_client_class = BufferedClient
+
+
+# Deterministic stand-in for the Ollama LLM that models prefill and generation cost
+# tokens_per_second is the decoding speed of the backend, shared by every generation running at once,
+# and latency_ms a fixed delay before the first token (model load, network). Like Ollama it hands back a
+# context to continue from, and a generation given one only prefills its new prompt.
+class StubLLM:
+    def __init__(self, prefill_ms_per_token=0.0, response="Sure, here is the code you asked for.",
+                 tokens_per_second=0.0, latency_ms=0.0):
+        self.prefill_ms_per_token = prefill_ms_per_token
+        self.response = response
+        self.tokens_per_second = tokens_per_second
+        self.latency_ms = latency_ms
+        self.prompt_tokens = []
+        self.active = 0
+        self._lock = threading.Lock()
+
+    def _prefill(self, prompt):
+        tokens = app.estimate_tokens(prompt)
+        self.prompt_tokens.append(tokens)
+        delay_ms = self.latency_ms + tokens * self.prefill_ms_per_token
+        if delay_ms:
+            time.sleep(delay_ms / 1000)
+        return tokens, tokens * self.prefill_ms_per_token
+
+    def _decode(self):
+        if self.tokens_per_second:
+            time.sleep(self.active / self.tokens_per_second)
+
+    def predict(self, prompt, model=None, on_done=None):
+        return "".join(self.stream(prompt, model, on_done=on_done))
+
+    def stream(self, prompt, model=None, context=None, on_done=None):
+        with self._lock:
+            self.active += 1
+        try:
+            tokens, prefill_ms = self._prefill(prompt)
+            words = self.response.split(' ')
+            for word in words:
+                self._decode()
+                yield word + ' '
+            if on_done is not None:
+                on_done({"done": True, "context": (context or []) + [0] * (tokens + len(words)),
+                         "prompt_eval_count": tokens, "prompt_eval_duration": int(prefill_ms * 1e6)})
+        finally:
+            with self._lock:
+                self.active -= 1
+
+
+# Local stand-in for the Ollama HTTP API: streams /api/generate as NDJSON over keep-alive connections.
+# A model pays load_ms the first time it's used and stays loaded afterwards, unless keep_alive is "0".
+# models maps a model name to its decoding speed in tokens per second (0 generates instantly), and each
+# prompt token costs prefill_ms_per_token; a request continuing from a context only prefills its own prompt.
+class StubOllamaServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, models=None, tokens=50, load_ms=0.0, prefill_ms_per_token=0.0):
+        self.models = models or {}
+        self.tokens = tokens
+        self.load_ms = load_ms
+        self.prefill_ms_per_token = prefill_ms_per_token
+        self.loaded = set()
+        self.connections = 0
+        self.cold_loads = 0
+        self.requests = {}
+        self.lock = threading.Lock()
+        super().__init__(("127.0.0.1", 0), StubOllamaHandler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def load(self, model, keep_alive):
+        with self.lock:
+            self.requests[model] = self.requests.get(model, 0) + 1
+            cold = model not in self.loaded
+            if cold:
+                self.cold_loads += 1
+            if keep_alive == "0":
+                self.loaded.discard(model)
+            else:
+                self.loaded.add(model)
+        if cold and self.load_ms:
+            time.sleep(self.load_ms / 1000)
+
+
+class StubOllamaHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        model = payload["model"]
+        self.server.load(model, str(payload.get("keep_alive", "5m")))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        done = {"model": model, "response": "", "done": True}
+        if payload.get("prompt") is not None:
+            prompt_tokens = app.estimate_tokens(payload["prompt"])
+            prefill_ms = prompt_tokens * self.server.prefill_ms_per_token
+            time.sleep(prefill_ms / 1000)
+            speed = self.server.models.get(model, 0)
+            for _ in range(self.server.tokens):
+                if speed:
+                    time.sleep(1 / speed)
+                self.write_chunk(json.dumps({"model": model, "response": "token ", "done": False}).encode() + b"\n")
+            done.update(context=payload.get("context", []) + [0] * (prompt_tokens + self.server.tokens),
+                        prompt_eval_count=prompt_tokens, prompt_eval_duration=int(prefill_ms * 1e6))
+        self.write_chunk(json.dumps(done).encode() + b"\n")
+        self.write_chunk(b"")
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def time_calls(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+# Topics and identifiers the varied synthetic messages are made of, common and rare words for search
+TOPICS = [
+    ("read a CSV file with pandas", "pd.read_csv"), ("reverse a linked list", "node.next"),
+    ("sort a dictionary by value", "sorted(d.items())"), ("parse JSON from an API", "json.loads"),
+    ("train a logistic regression model", "LogisticRegression"), ("plot a histogram", "plt.hist"),
+    ("merge two dataframes", "pd.merge"), ("write a unit test", "unittest.TestCase"),
+    ("connect to sqlite", "sqlite3.connect"), ("handle a KeyError", "dict.get"),
+    ("scrape a web page", "BeautifulSoup"), ("compute a moving average", "rolling"),
+    ("read environment variables", "os.environ"), ("run tasks concurrently", "ThreadPoolExecutor"),
+    ("remove duplicates from a list", "dict.fromkeys"), ("format dates", "strftime"),
+]
+
+
+def varied_messages(rng, count):
+    for number in range(count):
+        topic, api = rng.choice(TOPICS)
+        name = f"{rng.choice(['load', 'build', 'clean', 'score'])}_{rng.randint(0, 20000)}"
+        if number % 2 == 0:
+            yield f"How do I {topic} in a function called {name}?"
+        else:
+            yield (f"```python\ndef {name}(data):\n    return {api}(data)\n```\n"
+                   f"This uses {api} to {topic}; call {name} with your data.")
+
+
+# Fills a database with synthetic chats; legacy=True writes the pre-migration schema with ISO text timestamps
+# and varied=True mixes topics and rare identifiers into the text instead of repeating one exchange
+def generate_database(path, chats, messages_per_chat, legacy=False, varied=False, seed=7):
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=OFF')
+    with conn:
+        app.apply_migrations(conn, target=1 if legacy else None)
+
+    start_ms = app.now_ms() - chats * messages_per_chat * 1000
+    user_text = "How do I read a CSV file with pandas and group the rows by a column?"
+    assistant_text = ("```python\nimport pandas as pd\ndf = pd.read_csv('data.csv')\n"
+                      "print(df.groupby('city').size())\n```\nThis reads the file and counts rows per city.")
+    with conn:
+        for chat_number in range(chats):
+            chat_id = f"{1700000000 + chat_number}.{rng.randint(0, 999999):06d}"
+            chat_ms = start_ms + chat_number * messages_per_chat * 1000
+            date = app.ms_to_iso(chat_ms) if legacy else chat_ms
+            if legacy:
+                conn.execute('INSERT INTO chats (id, title, date, last_message) VALUES (?, ?, ?, ?)',
+                             (chat_id, user_text[:30] + "...", date, user_text))
+            else:
+                conn.execute('INSERT INTO chats (id, title, date, last_message, updated_at) VALUES (?, ?, ?, ?, ?)',
+                             (chat_id, user_text[:30] + "...", date, user_text, date))
+            rows = []
+            texts = varied_messages(rng, messages_per_chat) if varied else None
+            for number in range(messages_per_chat):
+                ms = chat_ms + number * 1000
+                role = "user" if number % 2 == 0 else "assistant"
+                text = next(texts) if varied else user_text if role == "user" else assistant_text
+                rows.append((chat_id, role, text, app.ms_to_iso(ms) if legacy else ms))
+            conn.executemany('INSERT INTO messages (chat_id, role, content, timestamp) VALUES (?, ?, ?, ?)', rows)
+            conn.executemany('INSERT INTO important_info (chat_id, content) VALUES (?, ?)',
+                             [(chat_id, "Use pandas.read_csv for CSV input")] * 3)
+    conn.close()
+
+
+# Query times of the per chat and chat list reads before and after the schema migrations
+def bench_db(args):
+    path = os.path.join(tempfile.mkdtemp(prefix='figr-bench-db-'), 'messages.db')
+    started = time.perf_counter()
+    generate_database(path, args.chats, args.messages, legacy=True)
+    print(f"generated {args.chats * args.messages:,} messages in {time.perf_counter() - started:.1f} s")
+
+    conn = sqlite3.connect(path)
+    chat_ids = [row[0] for row in conn.execute('SELECT id FROM chats')]
+    rng = random.Random(11)
+
+    def run(label, queries):
+        for name, sql in queries:
+            timings = []
+            for _ in range(args.repeat):
+                params = (rng.choice(chat_ids),) if '?' in sql else ()
+                started = time.perf_counter()
+                conn.execute(sql, params).fetchall()
+                timings.append((time.perf_counter() - started) * 1000)
+            print(f"{label:<8}{name:<22}p50 {statistics.median(timings):9.2f} ms   p99 {percentile(timings, 99):9.2f} ms")
+
+    run("before", [
+        ("chat history", 'SELECT role, content, timestamp FROM messages WHERE chat_id = ? ORDER BY timestamp'),
+        ("important info", 'SELECT content FROM important_info WHERE chat_id = ?'),
+        ("chat list", 'SELECT * FROM chats ORDER BY date DESC'),
+    ])
+
+    started = time.perf_counter()
+    with conn:
+        conn.execute('BEGIN IMMEDIATE')
+        app.apply_migrations(conn)
+    print(f"migrated in {time.perf_counter() - started:.1f} s")
+
+    run("after", [
+        ("chat history", 'SELECT role, content, timestamp FROM messages WHERE chat_id = ? ORDER BY id'),
+        ("important info", 'SELECT content FROM important_info WHERE chat_id = ? ORDER BY id'),
+        ("chat list", 'SELECT id, title, date, last_message FROM chats ORDER BY date DESC'),
+    ])
+    conn.close()
+
+
+# Compares prompt size and simulated prefill latency of the memory strategies over a long chat
+def bench_memory(args):
+    user_message = "Can you extend the previous function so it also handles " + "edge cases " * 20
+    assistant_message = "```python\n" + "def handler(value):\n    return value\n" * 15 + "```\n" + "Explanation. " * 40
+
+    print(f"{'strategy':<10}{'turn':>6}{'prompt tokens':>16}{'build ms':>10}{'prefill ms':>12}")
+    for strategy in args.strategies:
+        stub = StubLLM(prefill_ms_per_token=args.prefill_ms_per_token, response="Condensed summary. " * 30)
+        app.llm = stub
+        session_id = f"bench-{strategy}-{time.time()}"
+        app.create_new_chat(session_id)
+        session = app.ChatSession(session_id, strategy=strategy, token_budget=args.budget)
+
+        build_ms, prefill_ms = [], []
+        for turn in range(1, args.turns + 1):
+            session.add_message("user", user_message)
+            session.compact_memory()
+            started = time.perf_counter()
+            chat_prompt = app.prompt_template.format(**app.build_chat_inputs(session, user_message))
+            build_ms.append((time.perf_counter() - started) * 1000)
+
+            started = time.perf_counter()
+            stub.predict(chat_prompt)
+            prefill_ms.append((time.perf_counter() - started) * 1000)
+            session.add_message("assistant", assistant_message)
+            session.compact_memory()
+
+            if turn in (1, args.turns // 4, args.turns // 2, args.turns):
+                print(f"{strategy:<10}{turn:>6}{app.estimate_tokens(chat_prompt):>16}"
+                      f"{build_ms[-1]:>10.2f}{prefill_ms[-1]:>12.1f}")
+
+        # A cold load of the same chat is what a fresh worker pays
+        started = time.perf_counter()
+        app.ChatSession(session_id, strategy=strategy, token_budget=args.budget)
+        load_ms = (time.perf_counter() - started) * 1000
+        print(f"{strategy:<10} p50 prefill {statistics.median(prefill_ms):.1f} ms, "
+              f"p99 prefill {percentile(prefill_ms, 99):.1f} ms, cold session load {load_ms:.1f} ms\n")
+
+
+SAMPLE_RESPONSE = """## Reversing a linked list
+
+Here is an **iterative** solution that runs in `O(n)` time:
+
+```python
+class Node:
+    def __init__(self, value, next=None):
+        self.value = value
+        self.next = next
+
+
+def reverse(head):
+    previous = None
+    while head is not None:
+        head.next, previous, head = previous, head, head.next
+    return previous
+```
+
+[IMPORTANT] The function returns the new head, so keep the return value.
+
+1. Walk the list once
+2. Point each node at the previous one
+3. Return the last node visited
+
+- Works for empty lists
+- Uses constant extra memory
+"""
+
+
+# The convert_to_html implementation that forked pandoc for every call, kept here as the baseline
+def pandoc_convert_to_html(raw_text):
+    with tempfile.NamedTemporaryFile(delete=False, mode="w", suffix=".md") as temp_input:
+        temp_input.write(raw_text)
+        temp_input_path = temp_input.name
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".html") as temp_output:
+        temp_output_path = temp_output.name
+    try:
+        subprocess.run(["pandoc", temp_input_path, "-f", "markdown", "-t", "html", "--no-highlight",
+                        "-o", temp_output_path], capture_output=True, text=True)
+        with open(temp_output_path) as f:
+            html_content = f.read()
+        return re.sub(r'<pre><code class="([^"]*)">(.*?)</code></pre>',
+                      lambda m: app.code_block_html(m.group(2), m.group(1)), html_content, flags=re.DOTALL)
+    finally:
+        os.remove(temp_input_path)
+        os.remove(temp_output_path)
+
+
+# Markdown rendering cost of pandoc against the in process renderer, cold and cached
+def bench_render(args):
+    variants = []
+    if shutil.which("pandoc"):
+        variants.append(("pandoc", lambda text: pandoc_convert_to_html(text)))
+    else:
+        print("pandoc not found, skipping the pandoc baseline")
+    variants.append(("in-process", app.render_markdown))
+    variants.append(("cached", app.convert_to_html))
+
+    app.convert_to_html(SAMPLE_RESPONSE)
+    for name, render in variants:
+        timings = time_calls(lambda: render(SAMPLE_RESPONSE), args.repeat)
+        print(f"{name:<12}p50 {statistics.median(timings):9.3f} ms   p99 {percentile(timings, 99):9.3f} ms")
+
+
+# The /api/test-code implementation that forked a fresh interpreter per run, kept here as the baseline
+def subprocess_run_code(code):
+    with tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False) as f:
+        f.write(code)
+        temp_file = f.name
+    try:
+        result = subprocess.run([sys.executable, temp_file], capture_output=True, text=True, timeout=5)
+        return {"success": result.returncode == 0, "output": result.stdout or result.stderr}
+    finally:
+        os.unlink(temp_file)
+
+
+# Runs fn from several threads and reports throughput and latency percentiles
+def run_concurrently(fn, total, concurrency):
+    latencies = []
+    lock = threading.Lock()
+    remaining = iter(range(total))
+
+    def worker():
+        while True:
+            with lock:
+                if next(remaining, None) is None:
+                    return
+            started = time.perf_counter()
+            fn()
+            elapsed = (time.perf_counter() - started) * 1000
+            with lock:
+                latencies.append(elapsed)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return total / (time.perf_counter() - started), latencies
+
+
+# Executions per second and tail latency of the sandbox pool against forking an interpreter per run
+def bench_sandbox(args):
+    code = "import json\nprint(json.dumps({'total': sum(range(1000))}))"
+    pool = app.SandboxPool(size=args.workers, max_runs=args.max_runs)
+    pool.start()
+    time.sleep(1)  # let the workers finish booting, as they would on a running server
+
+    variants = [
+        ("subprocess", lambda: subprocess_run_code(code)),
+        ("pool", lambda: pool.run(code)),
+    ]
+    for name, fn in variants:
+        throughput, latencies = run_concurrently(fn, args.runs, args.concurrency)
+        print(f"{name:<12}{throughput:8.1f} exec/s   p50 {statistics.median(latencies):8.1f} ms   "
+              f"p99 {percentile(latencies, 99):8.1f} ms")
+    pool.shutdown()
+
+
+# The code blocks of one response tested one request at a time against one batch request, cold and cached
+def bench_test_batch(args):
+    snippets = [f"print(sum(i * i for i in range({300000 + number})))" for number in range(args.snippets - 2)]
+    snippets.append("import random\nprint(random.random())")  # never cached
+    snippets.append("def broken(:\n    pass")  # rejected by the syntax check
+    app.sandbox_pool = app.SandboxPool(size=args.workers)
+    app.sandbox_pool.start()
+    time.sleep(1)  # let the workers finish booting, as they would on a running server
+    client = app.app.test_client()
+
+    def one_by_one():
+        for code in snippets:
+            client.post("/api/test-code", json={"code": code})
+
+    def batch():
+        client.post("/api/test-code/batch", json={"codes": snippets})
+
+    for name, send in (("one by one", one_by_one), ("batch", batch)):
+        app.test_results.clear()
+        cold = time_calls(send, 1)[0]
+        warm = statistics.median(time_calls(send, args.repeat))
+        print(f"{name:<12}{len(snippets)} snippets   cold {cold:8.1f} ms   cached {warm:8.1f} ms")
+
+    syntax = time_calls(lambda: app.run_code("def broken(:\n    pass"), 1000)
+    print(f"syntax error rejected in {statistics.mean(syntax) * 1000:.0f} us")
+    app.sandbox_pool.shutdown()
+
+
+# Chat requests per second, tail latency and rejections with every request generating at once
+# against the bounded scheduler, on a stub backend whose decoding speed is shared between generations
+def bench_scheduler(args):
+    app.llm = StubLLM(response=" ".join(["token"] * args.tokens), tokens_per_second=args.tokens_per_second)
+    client = app.app.test_client()
+    session_ids = [app.create_new_chat(f"bench-{number}")["id"] for number in range(args.clients)]
+    counter_lock = threading.Lock()
+
+    variants = [
+        ("unbounded", app.LLMScheduler(concurrency=args.clients, max_queue=args.requests)),
+        ("scheduler", app.LLMScheduler(concurrency=args.concurrency, max_queue=args.queue_size)),
+    ]
+    for name, scheduler in variants:
+        app.llm_scheduler = scheduler
+        rejected = []
+        served = []
+        counter = iter(range(args.requests))
+
+        def send():
+            with counter_lock:
+                number = next(counter, 0)
+            started = time.perf_counter()
+            response = client.post("/api/chat", json={
+                "message": f"question {number}",
+                "sessionId": session_ids[number % len(session_ids)]
+            })
+            if response.status_code == 429:
+                rejected.append(number)
+            else:
+                served.append((time.perf_counter() - started) * 1000)
+
+        started = time.perf_counter()
+        run_concurrently(send, args.requests, args.clients)
+        throughput = len(served) / (time.perf_counter() - started)
+        print(f"{name:<12}{throughput:8.2f} served/s   p50 {statistics.median(served):8.1f} ms   "
+              f"p99 {percentile(served, 99):8.1f} ms   rejected {len(rejected)}")
+
+
+# /api/chat latency for a new question against exact and reworded repeats answered by the response cache
+def bench_response_cache(args):
+    app.llm = StubLLM(response=" ".join(["token"] * args.tokens), tokens_per_second=args.tokens_per_second)
+    app.response_cache.clear()
+    client = app.app.test_client()
+
+    # A chat per question, so summarizing a long history doesn't add to the timings
+    def ask(message):
+        session_id = app.create_new_chat(f"bench-cache-{uuid.uuid4().hex}")["id"]
+        started = time.perf_counter()
+        client.post("/api/chat", json={"message": message, "sessionId": session_id})
+        return (time.perf_counter() - started) * 1000
+
+    rows = {"miss": [], "exact hit": [], "similar hit": []}
+    for number in range(args.repeat):
+        rows["miss"].append(ask(f"Reverse a linked list of {number} nodes"))
+        rows["exact hit"].append(ask(f"How do I reverse a linked list of {number} nodes?"))
+        rows["similar hit"].append(ask(f"reverse the linked lists of {number} nodes"))
+    for name, timings in rows.items():
+        print(f"{name:<12}p50 {statistics.median(timings):9.2f} ms   p99 {percentile(timings, 99):9.2f} ms")
+    print(app.response_cache.stats())
+
+
+# /api/search latency on a large synthetic database for rare, common and prefix queries
+def bench_search(args):
+    path = os.path.join(tempfile.mkdtemp(prefix='figr-bench-search-'), 'search.db')
+    started = time.perf_counter()
+    generate_database(path, args.chats, args.messages, varied=True)
+    print(f"generated and indexed {args.chats * args.messages:,} messages in {time.perf_counter() - started:.1f} s")
+
+    app.db_pool.close_all()
+    app.db_pool = app.ConnectionPool(path)
+    client = app.app.test_client()
+    queries = {
+        "rare identifier": "clean_4242",
+        "two words": "logistic regression",
+        "common word": "data",
+        "prefix": "BeautifulSo",
+        "second page": "sqlite",
+        "older window": "data",
+    }
+    for name, query in queries.items():
+        params = {"q": query}
+        if name == "second page":
+            params["offset"] = 20
+        elif name == "older window":
+            params["window"] = 5
+        timings = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            results = client.get("/api/search", query_string=params).get_json()["results"]
+            timings.append((time.perf_counter() - started) * 1000)
+        print(f"{name:<18}{len(results):>4} results   p50 {statistics.median(timings):8.2f} ms   "
+              f"p99 {percentile(timings, 99):8.2f} ms")
+
+
+# Cost of the instrumentation: each primitive on its own, then /api/chat and /api/chat-history with metrics
+# on and off in alternating rounds. With a stub LLM the request is a few ms, a real generation takes seconds.
+def bench_metrics(args):
+    def timed_span():
+        with app.span("bench"):
+            pass
+
+    for name, primitive in [("span", timed_span), ("counter", app.db_roundtrips.inc)]:
+        timings = time_calls(primitive, 100000)
+        print(f"{name:<14}{statistics.mean(timings) * 1000:7.2f} us per call")
+
+    app.llm = StubLLM(response=" ".join(["token"] * 50))
+    client = app.app.test_client()
+    session_id = app.create_new_chat(f"bench-metrics-{uuid.uuid4().hex}")["id"]
+    requests = {
+        "chat": lambda: client.post("/api/chat", json={
+            "message": f"question {uuid.uuid4().hex}", "sessionId": session_id, "cache": False
+        }),
+        "chat-history": lambda: client.get("/api/chat-history", query_string={"sessionId": session_id}),
+    }
+    for name, send in requests.items():
+        timings = {True: [], False: []}
+        for round_number in range(args.rounds):
+            for enabled in (True, False) if round_number % 2 else (False, True):
+                app.METRICS_ENABLED = enabled
+                timings[enabled].append(statistics.median(time_calls(send, args.repeat)))
+        app.METRICS_ENABLED = True
+        on, off = statistics.median(timings[True]), statistics.median(timings[False])
+        print(f"{name:<14}metrics off {off:7.3f} ms   on {on:7.3f} ms   overhead {(on - off) / off * 100:5.2f} %")
+
+
+# Chat turns persisted per second with a commit per statement, one transaction per turn and group commit
+def bench_writes(args):
+    sessions = {}
+
+    def session():
+        # One session per thread, as a chat is only ever answered by one request at a time
+        thread_id = threading.get_ident()
+        if thread_id not in sessions:
+            sessions[thread_id] = app.ChatSession(app.create_new_chat(f"bench-writes-{uuid.uuid4().hex}")["id"])
+        return sessions[thread_id]
+
+    def separate():
+        chat = session()
+        chat.add_message("user", "How do I reverse a linked list?")
+        app.update_chat_metadata(chat.session_id, "How do I reverse a linked list?")
+        chat.add_important_info("The function returns the new head")
+        chat.add_message("assistant", SAMPLE_RESPONSE, html="<p>reply</p>")
+
+    def unit_of_work():
+        turn = session().begin_turn()
+        turn.add_message("user", "How do I reverse a linked list?")
+        turn.add_important_info("The function returns the new head")
+        turn.add_message("assistant", SAMPLE_RESPONSE, html="<p>reply</p>")
+        turn.commit()
+
+    variants = [
+        ("separate", separate, None),
+        ("unit of work", unit_of_work, None),
+        ("group commit", unit_of_work, app.GroupCommitter(window_ms=args.window_ms)),
+    ]
+    for name, write_turn, committer in variants:
+        app.group_committer = committer
+        throughput, latencies = run_concurrently(write_turn, args.turns, args.concurrency)
+        batches = f"   {committer.writes / max(committer.batches, 1):5.1f} turns/commit" if committer else ""
+        print(f"{name:<14}{throughput:8.1f} turns/s   p50 {statistics.median(latencies):7.2f} ms   "
+              f"p99 {percentile(latencies, 99):7.2f} ms{batches}")
+    app.group_committer = None
+
+
+# The Ollama backend as it was used before: a new connection for every request and models loaded on first use
+class UnpooledBackend(app.OllamaBackend):
+    def _post(self, path, payload, stream=False):
+        response = requests.post(f"{self.base_url}{path}", json=payload, stream=stream, timeout=self.timeout)
+        response.raise_for_status()
+        return response
+
+
+# Generations per second against a stub Ollama server with a connection per request, with pooled
+# keep-alive connections, and pooled after warming the model up; then short and long chat questions
+# routed to a small and a large model
+def bench_ollama(args):
+    def run(backend, label, server):
+        throughput, latencies = run_concurrently(
+            lambda: backend.predict("Explain list comprehensions", model="large"), args.requests, args.concurrency
+        )
+        print(f"{label:<16}{throughput:8.1f} req/s   p50 {statistics.median(latencies):7.2f} ms   "
+              f"max {max(latencies):7.2f} ms   connections {server.connections:4}   cold loads {server.cold_loads}")
+
+    for label, backend_class, keep_alive, warm in [
+        ("per request", UnpooledBackend, "5m", False),
+        ("pooled", app.OllamaBackend, "30m", False),
+        ("pooled + warm", app.OllamaBackend, "30m", True),
+    ]:
+        server = StubOllamaServer(tokens=args.tokens, load_ms=args.load_ms)
+        backend = backend_class(server.url, keep_alive=keep_alive, concurrency={"large": args.concurrency})
+        if warm:
+            backend.warmup("large")
+            server.connections = server.cold_loads = 0
+        run(backend, label, server)
+        server.shutdown()
+
+    server = StubOllamaServer(models={"large": args.large_tps, "small": args.small_tps}, tokens=args.tokens)
+    app.llm = app.OllamaBackend(server.url, concurrency={"large": args.concurrency, "small": args.concurrency})
+    client = app.app.test_client()
+    session_id = app.create_new_chat(f"bench-routing-{uuid.uuid4().hex}")["id"]
+    questions = {"short": "Sort a list?", "long": "Explain how to " + "handle every edge case and " * 30 + "test it"}
+    for routes in ({"chat": "large", "chat_short": "large"}, {"chat": "large", "chat_short": "small"}):
+        app.MODEL_ROUTES.update(routes)
+        timings = {
+            length: time_calls(lambda: client.post("/api/chat", json={
+                "message": question, "sessionId": session_id, "cache": False
+            }), args.repeat)
+            for length, question in questions.items()
+        }
+        print(f"short -> {routes['chat_short']:<6}" + "   ".join(
+            f"{length} p50 {statistics.median(values):7.1f} ms" for length, values in timings.items()
+        ))
+    server.shutdown()
+
+
+# Prefill tokens and time per chat turn against a stub Ollama server, with every turn sending the full prompt
+# and with follow-up turns continuing from the context of the previous one
+def bench_context(args):
+    server = StubOllamaServer(tokens=args.tokens, prefill_ms_per_token=args.prefill_ms_per_token)
+    app.llm = app.OllamaBackend(server.url)
+    client = app.app.test_client()
+    rng = random.Random(args.seed)
+    questions = list(varied_messages(rng, args.turns * 2))[::2]
+
+    print(f"{'mode':<10}{'turn':>6}{'prefill tokens':>16}{'prefill ms':>12}{'turn ms':>10}")
+    for reuse in (False, True):
+        app.LLM_CONTEXT_REUSE = reuse
+        mode = "reuse" if reuse else "full"
+        session_id = app.create_new_chat(f"bench-context-{uuid.uuid4().hex}")["id"]
+        totals = []
+        for turn, question in enumerate(questions, 1):
+            started = time.perf_counter()
+            prefill = client.post("/api/chat", json={
+                "message": question, "sessionId": session_id, "cache": False
+            }).get_json()["prefill"]
+            elapsed = (time.perf_counter() - started) * 1000
+            totals.append((prefill["tokens"], prefill["ms"]))
+            if turn in (1, 2, args.turns // 2, args.turns):
+                print(f"{mode:<10}{turn:>6}{prefill['tokens']:>16}{prefill['ms']:>12.1f}{elapsed:>10.1f}")
+        print(f"{mode:<10}{'mean':>6}{statistics.mean(t for t, _ in totals):>16.0f}"
+              f"{statistics.mean(ms for _, ms in totals):>12.1f}\n")
+    app.LLM_CONTEXT_REUSE = True
+    server.shutdown()
+
+
+# Database size and the cost of a retention run on a synthetic database with a share of idle chats,
+# chat history latency of the active chats while it runs, and the first load of an archived chat
+def bench_retention(args):
+    path = os.path.join(tempfile.mkdtemp(prefix='figr-bench-retention-'), 'retention.db')
+    generate_database(path, args.chats, args.messages, varied=True)
+    idle_ms = app.now_ms() - int((app.RETENTION_ARCHIVE_DAYS + 1) * 86400 * 1000)
+    conn = sqlite3.connect(path)
+    with conn:
+        chat_ids = [row[0] for row in conn.execute('SELECT id FROM chats ORDER BY id')]
+        idle = chat_ids[:int(len(chat_ids) * args.idle_share)]
+        conn.executemany('UPDATE chats SET updated_at = ? WHERE id = ?', [(idle_ms, chat_id) for chat_id in idle])
+    started = time.perf_counter()
+    app.enable_incremental_vacuum(conn)
+    print(f"switched to incremental auto vacuum in {time.perf_counter() - started:.1f} s")
+    conn.close()
+
+    app.db_pool.close_all()
+    app.db_pool = app.ConnectionPool(path)
+    client = app.app.test_client()
+    active = chat_ids[len(idle):]
+
+    def history():
+        client.get("/api/chat-history", query_string={"sessionId": random.choice(active), "limit": 20})
+
+    def size_mb():
+        return sum(os.path.getsize(name) for name in (path, path + '-wal') if os.path.exists(name)) / 1e6
+
+    # Render the stored replies once, so the timed loads only read
+    for chat_id in active:
+        client.get("/api/chat-history", query_string={"sessionId": chat_id, "limit": 20})
+    print(f"{len(chat_ids)} chats, {len(idle)} idle, {size_mb():.1f} MB")
+    quiet = time_calls(history, args.repeat)
+
+    during = []
+    result = {}
+    worker = threading.Thread(target=lambda: result.update(app.run_retention(app.ConnectionPool(path, size=1))))
+    started = time.perf_counter()
+    worker.start()
+    while worker.is_alive():
+        during.extend(time_calls(history, 1))
+    elapsed = time.perf_counter() - started
+    print(f"retention run {elapsed:.1f} s: {result}, {size_mb():.1f} MB after")
+    for label, timings in (("quiet", quiet), ("during run", during)):
+        print(f"chat history {label:<12}p50 {statistics.median(timings):7.2f} ms   p99 {percentile(timings, 99):7.2f} ms")
+
+    restored = time_calls(lambda: client.get("/api/chat-history", query_string={"sessionId": idle.pop()}), 20)
+    print(f"first load of an archived chat p50 {statistics.median(restored):7.2f} ms")
+
+
+# Anonymous resident memory now (not the peak), so phases can be compared within one process. Pages of the
+# database SQLite maps (FIGR_DB_MMAP_SIZE) are page cache and left out.
+def current_rss_mb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("RssAnon:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+# Runs work while a thread samples the resident memory; returns its result, seconds and the memory growth in MB
+def measure(work):
+    baseline = current_rss_mb()
+    peak = [baseline]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(0.05):
+            peak[0] = max(peak[0], current_rss_mb())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    started = time.perf_counter()
+    try:
+        result = work()
+    finally:
+        done.set()
+        sampler.join()
+    return result, time.perf_counter() - started, max(peak[0], current_rss_mb()) - baseline
+
+
+def bench_export(args):
+    directory = tempfile.mkdtemp(prefix='figr-bench-export-')
+    source = os.path.join(directory, 'source.db')
+    started = time.perf_counter()
+    generate_database(source, args.chats, args.messages, varied=True)
+    print(f"generated {args.chats * args.messages:,} messages in {time.perf_counter() - started:.1f} s, "
+          f"{os.path.getsize(source) / 1e6:.0f} MB")
+
+    export_path = os.path.join(directory, 'export.ndjson' + ('' if args.no_compress else '.gz'))
+
+    def export():
+        pool = app.ConnectionPool(source, size=1)
+        with open(export_path, 'wb') as f:
+            for chunk in app.encode_ndjson(app.export_records(pool), compress=not args.no_compress):
+                f.write(chunk)
+        pool.close_all()
+
+    _, seconds, growth = measure(export)
+    print(f"export {seconds:6.1f} s  {os.path.getsize(export_path) / 1e6:7.1f} MB file  memory +{growth:.1f} MB")
+
+    target = os.path.join(directory, 'target.db')
+    pool = app.ConnectionPool(target)
+    with pool.transaction() as conn:
+        app.apply_migrations(conn)
+
+    def load():
+        with open(export_path, 'rb') as f:
+            return app.import_records(app.decode_ndjson(iter(lambda: f.read(app.EXPORT_CHUNK_BYTES), b'')),
+                                      pool=pool, batch_rows=args.batch_rows)
+
+    counts, seconds, growth = measure(load)
+    print(f"import {seconds:6.1f} s  {counts['messages']:,} messages in batches of {args.batch_rows:,}  memory +{growth:.1f} MB")
+    with pool.connection() as conn:
+        messages = conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+        indexed = conn.execute("SELECT COUNT(*) FROM messages_fts WHERE messages_fts MATCH 'pandas'").fetchone()[0]
+    expected = sqlite3.connect(source).execute(
+        "SELECT COUNT(*) FROM messages_fts WHERE messages_fts MATCH 'pandas'").fetchone()[0]
+    print(f"round trip: {messages:,} messages, search hits {indexed:,} (source {expected:,}), complete {counts['complete']}")
+    pool.close_all()
+
+
+# Facts a model keeps flagging as important, repeated with different case and punctuation
+IMPORTANT_FACTS = [
+    "The function returns the new head", "Use a context manager so the file is closed",
+    "pandas reads dates as strings unless parse_dates is set", "The list is modified in place",
+    "Install requests with pip first", "Keys must be hashable", "Indexes start at zero",
+    "Close the database connection when you are done", "Validate user input before using it",
+    "The model must be fitted before predict is called", "Set a random seed for reproducible results",
+    "json.loads expects a string, not bytes",
+]
+
+
+def flagged_fact(rng):
+    fact = IMPORTANT_FACTS[min(int(rng.expovariate(0.35)), len(IMPORTANT_FACTS) - 1)]
+    return rng.choice([fact, fact.lower(), fact + ".", f"**{fact}**", fact.upper()])
+
+
+# Important info tokens in the prompt with every extracted line appended against the deduplicated, capped
+# store, then the background compaction of a database written before deduplication
+def bench_important_info(args):
+    rng = random.Random(args.seed)
+    session_id = app.create_new_chat(f"bench-info-{uuid.uuid4().hex}")["id"]
+    session = app.ChatSession(session_id)
+    appended = []
+
+    print(f"{'turn':>6}{'lines':>8}{'entries':>9}{'appended tokens':>17}{'ranked tokens':>15}")
+    for turn in range(1, args.turns + 1):
+        lines = [flagged_fact(rng) for _ in range(rng.randint(1, 3))]
+        appended.extend(lines)
+        for line in lines:
+            session.add_important_info(line)
+        if turn in (1, args.turns // 4, args.turns // 2, args.turns):
+            ranked = app.build_chat_inputs(session, "next question")["important_info"]
+            print(f"{turn:>6}{len(appended):>8}{len(session.info):>9}"
+                  f"{app.estimate_tokens(chr(10).join(appended)):>17}{app.estimate_tokens(ranked):>15}")
+
+    with app.db_transaction() as conn:
+        chat_ids = [f"bench-legacy-{uuid.uuid4().hex}" for _ in range(args.chats)]
+        conn.executemany('INSERT INTO chats (id, title, date, updated_at) VALUES (?, ?, ?, ?)',
+                         [(chat_id, "Legacy", app.now_ms(), app.now_ms()) for chat_id in chat_ids])
+        conn.executemany('INSERT INTO important_info (chat_id, content) VALUES (?, ?)',
+                         [(chat_id, flagged_fact(rng)) for chat_id in chat_ids for _ in range(args.lines)])
+    started = time.perf_counter()
+    removed = app.compact_important_info()
+    print(f"compacted {args.chats * args.lines} legacy rows in {time.perf_counter() - started:.2f} s, "
+          f"removed {removed} duplicates")
+
+
+# Writes a synthetic database to reuse across load runs
+def bench_generate(args):
+    if os.path.exists(args.path):
+        sys.exit(f"{args.path} already exists")
+    started = time.perf_counter()
+    generate_database(args.path, args.chats, args.messages, varied=True, seed=args.seed)
+    print(f"generated {args.chats * args.messages:,} messages in {time.perf_counter() - started:.1f} s")
+
+
+def multipart_body(files, fields):
+    """Encode form fields and (name, content) files as multipart/form-data"""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for filename, content in files:
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+            f'Content-Type: text/x-python\r\n\r\n'.encode() + content.encode() + b'\r\n'
+        )
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+# One HTTP request of the load mix: endpoint name, method, path, body and headers
+def load_request(endpoint, rng, chat_ids, sequence):
+    chat_id = rng.choice(chat_ids)
+    if endpoint == "chat":
+        body = {"message": f"How do I {rng.choice(TOPICS)[0]}? ({sequence})", "sessionId": chat_id, "cache": False}
+        return "POST", "/api/chat", json.dumps(body).encode(), {"Content-Type": "application/json"}
+    if endpoint == "chat-history":
+        return "GET", f"/api/chat-history?sessionId={chat_id}", None, {}
+    if endpoint == "test-code":
+        code = f"print(sum(range({rng.randint(1000, 100000)})))"
+        return "POST", "/api/test-code", json.dumps({"code": code}).encode(), {"Content-Type": "application/json"}
+    if endpoint == "upload":
+        source = "".join(f"def handler_{sequence}_{number}(value):\n    return value * {number}\n\n"
+                         for number in range(rng.randint(2, 40)))
+        body, content_type = multipart_body([(f"module_{sequence}.py", source)], {"sessionId": chat_id})
+        return "POST", "/api/upload", body, {"Content-Type": content_type}
+    raise ValueError(f"unknown endpoint {endpoint}")
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+# Drives the endpoints over HTTP against a real threaded server, with a stub LLM and a synthetic database,
+# and reports throughput, latency percentiles, errors and peak memory per endpoint
+def bench_load(args):
+    path = args.database
+    if path is None and args.fixture:
+        # An export (of a production database, say) loaded into a scratch database
+        path = os.path.join(tempfile.mkdtemp(prefix='figr-bench-load-'), 'load.db')
+        pool = app.ConnectionPool(path)
+        with pool.transaction() as conn:
+            app.apply_migrations(conn)
+        started = time.perf_counter()
+        with open(args.fixture, 'rb') as f:
+            counts = app.import_records(app.decode_ndjson(iter(lambda: f.read(app.EXPORT_CHUNK_BYTES), b'')), pool=pool)
+        pool.close_all()
+        print(f"imported {counts['messages']:,} messages from {args.fixture} in {time.perf_counter() - started:.1f} s")
+    elif path is None:
+        path = os.path.join(tempfile.mkdtemp(prefix='figr-bench-load-'), 'load.db')
+        started = time.perf_counter()
+        generate_database(path, args.chats, args.messages, varied=True, seed=args.seed)
+        print(f"generated {args.chats * args.messages:,} messages in {time.perf_counter() - started:.1f} s")
+
+    app.db_pool.close_all()
+    app.db_pool = app.ConnectionPool(path)
+    with app.db_transaction() as conn:
+        app.apply_migrations(conn)
+        chat_ids = [row['id'] for row in conn.execute('SELECT id FROM chats ORDER BY id')]
+    app.session_cache.clear()
+    app.llm = StubLLM(response=" ".join(["token"] * args.tokens), tokens_per_second=args.tokens_per_second,
+                      latency_ms=args.latency_ms)
+    app.llm_scheduler = app.LLMScheduler(concurrency=args.llm_concurrency, max_queue=args.llm_queue_size)
+    if "test-code" in parse_mix(args.mix):
+        app.sandbox_pool.start()
+        time.sleep(1)  # let the sandbox workers boot, as they would on a running server
+
+    from werkzeug.serving import make_server
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # The whole request sequence is drawn up front from the seed, so runs are comparable
+    rng = random.Random(args.seed)
+    mix = parse_mix(args.mix)
+    endpoints = rng.choices(list(mix), weights=list(mix.values()), k=args.requests)
+    planned = iter([(endpoint, load_request(endpoint, rng, chat_ids, number))
+                    for number, endpoint in enumerate(endpoints)])
+    results = {endpoint: {"latencies": [], "errors": 0, "rejected": 0} for endpoint in mix}
+    lock = threading.Lock()
+
+    def client():
+        connection = http.client.HTTPConnection("127.0.0.1", server.server_port, timeout=300)
+        while True:
+            with lock:
+                item = next(planned, None)
+            if item is None:
+                break
+            endpoint, (method, url, body, headers) = item
+            started = time.perf_counter()
+            try:
+                connection.request(method, url, body=body, headers=headers)
+                response = connection.getresponse()
+                payload = response.read()
+                status = response.status
+                ok = status == 200 and json.loads(payload).get("success", True)
+            except (OSError, http.client.HTTPException, ValueError):
+                connection.close()
+                connection = http.client.HTTPConnection("127.0.0.1", server.server_port, timeout=300)
+                status, ok = None, False
+            elapsed = (time.perf_counter() - started) * 1000
+            with lock:
+                results[endpoint]["latencies"].append(elapsed)
+                if status == 429:
+                    results[endpoint]["rejected"] += 1
+                elif not ok:
+                    results[endpoint]["errors"] += 1
+        connection.close()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+
+    print(f"{args.requests} requests, {args.concurrency} clients, {len(chat_ids):,} chats, {elapsed:.1f} s")
+    print(f"{'endpoint':<14}{'req/s':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}{'429':>6}")
+    for endpoint, result in results.items():
+        latencies = result["latencies"]
+        if not latencies:
+            continue
+        print(f"{endpoint:<14}{len(latencies) / elapsed:8.1f}{statistics.median(latencies):10.1f}"
+              f"{percentile(latencies, 95):10.1f}{percentile(latencies, 99):10.1f}"
+              f"{result['errors']:8d}{result['rejected']:6d}")
+    everything = [latency for result in results.values() for latency in result["latencies"]]
+    print(f"{'total':<14}{len(everything) / elapsed:8.1f}{statistics.median(everything):10.1f}"
+          f"{percentile(everything, 95):10.1f}{percentile(everything, 99):10.1f}")
+    # ru_maxrss is in kilobytes on Linux; the children are the sandbox workers that already exited
+    print(f"peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB, "
+          f"sandbox workers {resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024:.0f} MB")
+    app.sandbox_pool.shutdown()
+
+
+# Parses the `python -X importtime` report: (self us, cumulative us, depth, module) per imported module
+def import_times(stderr):
+    rows = []
+    for line in stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)", line)
+        if match:
+            rows.append((int(match.group(1)), int(match.group(2)), len(match.group(3)) // 2, match.group(4)))
+    return rows
+
+
+def bench_startup(args):
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, FIGR_DATABASE_PATH=os.path.join(tempfile.mkdtemp(prefix='figr-bench-startup-'), 'startup.db'))
+    totals, rows = [], []
+    for _ in range(args.repeat):
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"], cwd=here, env=env,
+                                capture_output=True, text=True)
+        if result.returncode != 0:
+            print(result.stderr[-2000:], file=sys.stderr)
+            return 1
+        rows = import_times(result.stderr)
+        totals.append(next(cumulative for _, cumulative, depth, name in rows if name == "app" and depth == 0) / 1000)
+    import_ms = statistics.median(totals)
+
+    # The slowest imports app pulls in itself
+    print(f"{'module':<40} {'cumulative ms':>14}")
+    # The report lists the imports of a module right before the module itself
+    end = next(i for i, row in enumerate(rows) if row[3] == "app" and row[2] == 0)
+    start = max((i for i, row in enumerate(rows[:end]) if row[2] == 0), default=-1) + 1
+    children = [row for row in rows[start:end] if row[2] == 1]
+    for _, cumulative, _, name in sorted(children, key=lambda row: -row[1])[:args.top]:
+        print(f"{name:<40} {cumulative / 1000:14.1f}")
+    started = time.perf_counter()
+    app.prewarm()
+    print(f"import app: median {import_ms:.1f} ms over {args.repeat} runs (budget {args.budget_ms:.0f} ms), "
+          f"prewarm {(time.perf_counter() - started) * 1000:.1f} ms")
+    if import_ms > args.budget_ms:
+        print(f"import time is over the budget of {args.budget_ms:.0f} ms", file=sys.stderr)
+        return 1
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Figr Code Assistant benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    memory = subparsers.add_parser("memory", help="prompt growth of the conversation memory strategies")
+    memory.add_argument("--turns", type=int, default=60)
+    memory.add_argument("--budget", type=int, default=app.MEMORY_TOKEN_BUDGET)
+    memory.add_argument("--strategies", nargs="+", default=list(app.MEMORY_STRATEGIES), choices=app.MEMORY_STRATEGIES)
+    memory.add_argument("--prefill-ms-per-token", type=float, default=0.2,
+                        help="simulated prompt processing cost of the model")
+    memory.set_defaults(func=bench_memory)
+
+    db = subparsers.add_parser("db", help="query times before and after the schema migrations")
+    db.add_argument("--chats", type=int, default=5000)
+    db.add_argument("--messages", type=int, default=200, help="messages per chat")
+    db.add_argument("--repeat", type=int, default=50)
+    db.set_defaults(func=bench_db)
+
+    render = subparsers.add_parser("render", help="markdown rendering with pandoc against the in process renderer")
+    render.add_argument("--repeat", type=int, default=200)
+    render.set_defaults(func=bench_render)
+
+    sandbox = subparsers.add_parser("sandbox", help="/api/test-code sandbox pool against a fresh interpreter per run")
+    sandbox.add_argument("--runs", type=int, default=200)
+    sandbox.add_argument("--concurrency", type=int, default=4)
+    sandbox.add_argument("--workers", type=int, default=app.SANDBOX_WORKERS)
+    sandbox.add_argument("--max-runs", type=int, default=app.SANDBOX_MAX_RUNS)
+    sandbox.set_defaults(func=bench_sandbox)
+
+    test_batch = subparsers.add_parser("test-batch", help="/api/test-code/batch against one request per snippet")
+    test_batch.add_argument("--snippets", type=int, default=8)
+    test_batch.add_argument("--workers", type=int, default=4)
+    test_batch.add_argument("--repeat", type=int, default=10)
+    test_batch.set_defaults(func=bench_test_batch)
+
+    scheduler = subparsers.add_parser("scheduler", help="/api/chat under load with and without the LLM scheduler")
+    scheduler.add_argument("--requests", type=int, default=64)
+    scheduler.add_argument("--clients", type=int, default=16, help="concurrent clients, one chat each")
+    scheduler.add_argument("--tokens", type=int, default=40, help="tokens per response")
+    scheduler.add_argument("--tokens-per-second", type=float, default=400.0)
+    scheduler.add_argument("--concurrency", type=int, default=app.LLM_CONCURRENCY)
+    scheduler.add_argument("--queue-size", type=int, default=app.LLM_QUEUE_SIZE)
+    scheduler.set_defaults(func=bench_scheduler)
+
+    cache = subparsers.add_parser("cache", help="/api/chat latency with and without a response cache hit")
+    cache.add_argument("--repeat", type=int, default=20)
+    cache.add_argument("--tokens", type=int, default=200, help="tokens per response")
+    cache.add_argument("--tokens-per-second", type=float, default=40.0)
+    cache.set_defaults(func=bench_response_cache)
+
+    search = subparsers.add_parser("search", help="/api/search latency on a large synthetic database")
+    search.add_argument("--chats", type=int, default=5000)
+    search.add_argument("--messages", type=int, default=200, help="messages per chat")
+    search.add_argument("--repeat", type=int, default=20)
+    search.set_defaults(func=bench_search)
+
+    metrics = subparsers.add_parser("metrics", help="request time with the instrumentation on and off")
+    metrics.add_argument("--rounds", type=int, default=10)
+    metrics.add_argument("--repeat", type=int, default=50)
+    metrics.set_defaults(func=bench_metrics)
+
+    writes = subparsers.add_parser("writes", help="chat turn persistence with and without batched commits")
+    writes.add_argument("--turns", type=int, default=2000)
+    writes.add_argument("--concurrency", type=int, default=16)
+    writes.add_argument("--window-ms", type=float, default=2.0, help="group commit window")
+    writes.set_defaults(func=bench_writes)
+
+    ollama = subparsers.add_parser("ollama", help="Ollama connection reuse, warmup and model routing")
+    ollama.add_argument("--requests", type=int, default=500)
+    ollama.add_argument("--concurrency", type=int, default=4)
+    ollama.add_argument("--tokens", type=int, default=20, help="tokens per response")
+    ollama.add_argument("--load-ms", type=float, default=200.0, help="cold model load time of the stub")
+    ollama.add_argument("--large-tps", type=float, default=200.0, help="decoding speed of the large model")
+    ollama.add_argument("--small-tps", type=float, default=1000.0, help="decoding speed of the small model")
+    ollama.add_argument("--repeat", type=int, default=20)
+    ollama.set_defaults(func=bench_ollama)
+
+    context = subparsers.add_parser("context", help="prefill per chat turn with and without context reuse")
+    context.add_argument("--turns", type=int, default=40)
+    context.add_argument("--tokens", type=int, default=150, help="tokens per response")
+    context.add_argument("--prefill-ms-per-token", type=float, default=0.5)
+    context.add_argument("--seed", type=int, default=7)
+    context.set_defaults(func=bench_context)
+
+    retention = subparsers.add_parser("retention", help="archival, cleanup and vacuum of idle chats")
+    retention.add_argument("--chats", type=int, default=2000)
+    retention.add_argument("--messages", type=int, default=100, help="messages per chat")
+    retention.add_argument("--idle-share", type=float, default=0.7, help="share of chats idle past the archive age")
+    retention.add_argument("--repeat", type=int, default=200)
+    retention.set_defaults(func=bench_retention)
+
+    info = subparsers.add_parser("important-info", help="prompt tokens of the deduplicated important info")
+    info.add_argument("--turns", type=int, default=200)
+    info.add_argument("--chats", type=int, default=2000, help="legacy chats to compact")
+    info.add_argument("--lines", type=int, default=50, help="important info lines per legacy chat")
+    info.add_argument("--seed", type=int, default=7)
+    info.set_defaults(func=bench_important_info)
+
+    export = subparsers.add_parser("export", help="export and import round trip of a large database")
+    export.add_argument("--chats", type=int, default=5000)
+    export.add_argument("--messages", type=int, default=200, help="messages per chat")
+    export.add_argument("--batch-rows", type=int, default=app.IMPORT_BATCH_ROWS, help="records per import transaction")
+    export.add_argument("--no-compress", action="store_true")
+    export.set_defaults(func=bench_export)
+
+    startup = subparsers.add_parser("startup", help="import time of the app against a budget, and the prewarm")
+    startup.add_argument("--repeat", type=int, default=5)
+    startup.add_argument("--top", type=int, default=10, help="slowest imports to list")
+    startup.add_argument("--budget-ms", type=float, default=400,
+                         help="exit with status 1 when the median import time is over this")
+    startup.set_defaults(func=bench_startup)
+
+    generate = subparsers.add_parser("generate", help="write a synthetic chat database for load runs")
+    generate.add_argument("path")
+    generate.add_argument("--chats", type=int, default=10000)
+    generate.add_argument("--messages", type=int, default=200, help="messages per chat")
+    generate.add_argument("--seed", type=int, default=7)
+    generate.set_defaults(func=bench_generate)
+
+    load = subparsers.add_parser("load", help="throughput and latency of the endpoints over HTTP")
+    load.add_argument("--database", help="database written by the generate command, generated when omitted")
+    load.add_argument("--fixture", help="export (python app.py export) to load into a scratch database instead")
+    load.add_argument("--chats", type=int, default=1000)
+    load.add_argument("--messages", type=int, default=200, help="messages per chat")
+    load.add_argument("--requests", type=int, default=1000)
+    load.add_argument("--concurrency", type=int, default=16)
+    load.add_argument("--mix", default="chat=2,chat-history=6,test-code=1,upload=1",
+                      help="endpoints and their weights")
+    load.add_argument("--tokens", type=int, default=100, help="tokens per response")
+    load.add_argument("--tokens-per-second", type=float, default=0.0, help="0 generates instantly")
+    load.add_argument("--latency-ms", type=float, default=0.0, help="delay before the first token")
+    load.add_argument("--llm-concurrency", type=int, default=app.LLM_CONCURRENCY)
+    load.add_argument("--llm-queue-size", type=int, default=app.LLM_QUEUE_SIZE)
+    load.add_argument("--seed", type=int, default=7)
+    load.set_defaults(func=bench_load)
+
+    args = parser.parse_args(argv)
+    app.init_db()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())